@@ -0,0 +1,284 @@
+import sys
+
+import contextlib
+import copy
+import io
+import itertools
+import json
+import os
+import platform
+import tempfile
+import time
+
+import argparse
+import cv2
+import numpy as np
+
+from generate_ball import Ball, BallManager, ScreenWriter, generate_video, get_horizontal_scale
+from generate_batch import scene_args
+import track_ball
+
+# Settings measured by default, as lists of values whose every combination is a benchmark case. Resolutions are given
+# as 'WIDTHxHEIGHT'.
+DEFAULT_GRID = {
+    'balls': [1, 10],
+    'resolution': ['640x360', '1280x720'],
+    'fps': [60.],
+    'deformation': [0.5],
+    'tolerance': [0]
+}
+GRID_SETTINGS = ('balls', 'resolution', 'fps', 'deformation', 'tolerance')
+
+# Stages timed for every case, in ms per frame. The *_cli stages run the whole of generate_ball.generate_video and
+# track_ball.track_video on a .npy frame store.
+BENCHMARK_STAGES = ('next_frame', 'generate_image', 'distinct_contours', 'generate_cli', 'track_cli')
+
+# A stage is a regression when it is more than REGRESSION_THRESHOLD slower than the baseline, as a fraction.
+REGRESSION_THRESHOLD = 0.2
+
+# Every case is generated from the same seed, so runs measure the same scenes.
+BENCHMARK_SEED = 0
+BACKGROUND_COLOR = [50, 50, 50]
+
+
+# Run every case of the grid, save the results as JSON, and compare them to a baseline if one is given. Exits with an
+# error if anything regressed.
+def main():
+    args = parse_args(sys.argv[1:])
+
+    results = run_benchmarks(args['grid'], args['frames'], args['repeats'])
+    with open(args['output'], 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print('Results saved to ' + args['output'])
+
+    if args['baseline'] is not None:
+        with open(args['baseline']) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        regressions = compare_results(results, baseline, args['threshold'])
+        if regressions:
+            sys.exit(1)
+
+
+# Run every combination of the settings in grid, a dictionary of GRID_SETTINGS to lists of values, and return the
+# results with the environment they were measured in. Each stage is timed repeats times over frames frames, and the
+# fastest is kept, since anything slower was slowed down by something else running.
+def run_benchmarks(grid, frames, repeats):
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count()
+        },
+        'frames': frames,
+        'repeats': repeats,
+        'cases': []
+    }
+
+    for values in itertools.product(*[grid[setting] for setting in GRID_SETTINGS]):
+        case = dict(zip(GRID_SETTINGS, values))
+        start = time.perf_counter()
+        timings = benchmark_case(case, frames, repeats)
+
+        results['cases'].append({
+            'name': case_name(case),
+            'settings': case,
+            'timings': timings
+        })
+        print(case_name(case) + ' (' + format(time.perf_counter() - start, '.1f') + 's): ' +
+              ', '.join([stage + ' ' + format(timings[stage], '.3f') + 'ms' for stage in BENCHMARK_STAGES]))
+
+    return results
+
+
+# Name a case after its settings, so results can be matched to a baseline.
+def case_name(case):
+    return ','.join([setting + '=' + str(case[setting]) for setting in GRID_SETTINGS])
+
+
+# Time every one of BENCHMARK_STAGES for one case of the grid, in ms per frame.
+def benchmark_case(case, frames, repeats):
+    timings = {stage: [] for stage in BENCHMARK_STAGES}
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        args = make_scene(case, frames, output_dir)
+        ball_args = get_horizontal_scale(copy.deepcopy(args['balls']), args)
+        path = os.path.join(output_dir, args['title'])
+
+        for i in range(repeats):
+            manager = BallManager(args['acceleration'], args['duration'], args['count_frames'], args['fps'],
+                                  [Ball(ball_arg) for ball_arg in ball_args])
+            balls_info = []
+            start = time.perf_counter()
+            for frame in range(frames):
+                balls_info.append(manager.nextFrame()[0])
+            timings['next_frame'].append(time.perf_counter() - start)
+
+            screenwriter = ScreenWriter(args['background_color'], args['resolution'], args['fps'], None)
+            images = []
+            start = time.perf_counter()
+            for frame_info in balls_info:
+                images.append(screenwriter.generate_image(frame_info))
+            timings['generate_image'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for image in images:
+                track_ball.distinct_contours(image, case['tolerance'], args['background_color'])
+            timings['distinct_contours'].append(time.perf_counter() - start)
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                num_frames = generate_video(args)['frames']
+                timings['generate_cli'].append(time.perf_counter() - start)
+
+                track_args = track_ball.parse_args(['--path', path, '--fps', str(case['fps']), '--tolerance',
+                                                    str(case['tolerance']), '--background_color'] +
+                                                   [str(channel) for channel in args['background_color']] +
+                                                   ['--headless', '--no_video'])
+                start = time.perf_counter()
+                track_ball.track_video(track_args)
+                timings['track_cli'].append(time.perf_counter() - start)
+
+    # The command line runs count their own frames, which include the starting frame.
+    frame_counts = {stage: frames for stage in BENCHMARK_STAGES}
+    frame_counts['generate_cli'] = frame_counts['track_cli'] = num_frames
+
+    return {stage: min(timings[stage]) * 1000 / frame_counts[stage] for stage in BENCHMARK_STAGES}
+
+
+# Make the generate_ball arguments of a case, for a video of frames frames saved as a frame store in output_dir. Balls
+# get distinct colors and starting heights from a generator seeded with BENCHMARK_SEED, so every run draws the same
+# scene.
+def make_scene(case, frames, output_dir):
+    width, height = [int(value) for value in case['resolution'].split('x')]
+    rng = np.random.default_rng(BENCHMARK_SEED)
+
+    radius = max(min(width, height) // 40, 2)
+    colors = set()
+    while len(colors) < case['balls']:
+        color = tuple(rng.integers(100, 256, 3).tolist())
+        colors.add(color)
+
+    balls = []
+    for color in sorted(colors):
+        balls.append({
+            'color': list(color),
+            'starting_height': float(rng.uniform(radius + 1, height - radius)),
+            'radius': radius,
+            'deformation': case['deformation']
+        })
+
+    scene = {
+        'resolution': [width, height],
+        'fps': case['fps'],
+        'acceleration': float(height * 5),
+        'count_frames': True,
+        'duration': frames,
+        'background_color': BACKGROUND_COLOR,
+        'title': 'benchmark.npy',
+        'codec': 'npy',
+        'output_dir': output_dir,
+        'balls': balls
+    }
+
+    return scene_args(scene)
+
+
+# Compare results to a baseline made by run_benchmarks, case by case and stage by stage, and print every stage that
+# is more than threshold slower. Cases missing from either are skipped. Returns a list of the regressions, each a
+# dictionary with the 'case', 'stage', 'baseline' and current 'time' in ms per frame, and their 'ratio'.
+def compare_results(results, baseline, threshold=REGRESSION_THRESHOLD):
+    baseline_cases = {case['name']: case for case in baseline['cases']}
+
+    regressions = []
+    for case in results['cases']:
+        if case['name'] not in baseline_cases:
+            continue
+
+        for stage, stage_time in case['timings'].items():
+            baseline_time = baseline_cases[case['name']]['timings'].get(stage)
+            if not baseline_time:
+                continue
+
+            ratio = stage_time / baseline_time
+            if ratio > 1 + threshold:
+                regressions.append({
+                    'case': case['name'],
+                    'stage': stage,
+                    'baseline': baseline_time,
+                    'time': stage_time,
+                    'ratio': ratio
+                })
+
+    for regression in regressions:
+        print('REGRESSION: ' + regression['case'] + ' ' + regression['stage'] + ': ' +
+              format(regression['baseline'], '.3f') + 'ms -> ' + format(regression['time'], '.3f') + 'ms (' +
+              format(regression['ratio'], '.2f') + 'x)')
+    if not regressions:
+        print('No regressions against the baseline.')
+
+    return regressions
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--balls', dest='balls', nargs="+", type=int, default=DEFAULT_GRID['balls'],
+                        help='Numbers of balls to benchmark.')
+    parser.add_argument('--resolution', dest='resolution', nargs="+", type=str, default=DEFAULT_GRID['resolution'],
+                        help='Resolutions to benchmark, as WIDTHxHEIGHT.')
+    parser.add_argument('--fps', dest='fps', nargs="+", type=float, default=DEFAULT_GRID['fps'],
+                        help='Frames per second to benchmark.')
+    parser.add_argument('--deformation', dest='deformation', nargs="+", type=float,
+                        default=DEFAULT_GRID['deformation'],
+                        help='Ball deformations to benchmark.')
+    parser.add_argument('--tolerance', dest='tolerance', nargs="+", type=int, default=DEFAULT_GRID['tolerance'],
+                        help='Tracking color tolerances to benchmark.')
+    parser.add_argument('--frames', dest='frames', type=int, default=60,
+                        help='Number of frames to time every stage over.')
+    parser.add_argument('--repeats', dest='repeats', type=int, default=3,
+                        help='Number of times to time every stage. The fastest is kept.')
+    parser.add_argument('--output', dest='output', type=str, default='benchmark.json',
+                        help='Path to save the results to as JSON.')
+    parser.add_argument('--baseline', dest='baseline', type=str, default=None,
+                        help='Path to results of an earlier run to compare to. Exits with an error on regressions.')
+    parser.add_argument('--threshold', dest='threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help='How much slower than the baseline a stage can be before it is a regression, as a '
+                             'fraction.')
+
+    args = parser.parse_args(args)
+
+    assert all([balls > 0 for balls in args.balls])
+    assert all([len(resolution.split('x')) == 2 and all([value.isdigit() and int(value) > 0
+                                                         for value in resolution.split('x')])
+                for resolution in args.resolution]) and "Resolutions are given as WIDTHxHEIGHT."
+    assert all([fps > 0 for fps in args.fps])
+    assert all([0 <= deformation <= 1 for deformation in args.deformation])
+    assert all([tolerance >= 0 for tolerance in args.tolerance])
+    assert args.frames > 0
+    assert args.repeats > 0
+    assert args.baseline is None or os.path.exists(args.baseline)
+    assert args.threshold >= 0
+
+    args = {
+        'grid': {
+            'balls': args.balls,
+            'resolution': args.resolution,
+            'fps': args.fps,
+            'deformation': args.deformation,
+            'tolerance': args.tolerance
+        },
+        'frames': args.frames,
+        'repeats': args.repeats,
+        'output': args.output,
+        'baseline': args.baseline,
+        'threshold': args.threshold
+    }
+
+    return args
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,59 @@
 import sys
 
+import collections
+import collections.abc
+import copy
 import cv2
+import heapq
 import math
+import multiprocessing
 import numpy as np
 import os
+import queue
+import struct
+import threading
+import time
 
 import argparse
 
+import profiling
+
+ENGINES = ('object', 'vectorized', 'event')
+
+# Output presets for ScreenWriter, mapping to a fourcc and the file ending it is saved under. 'rgba' is uncompressed,
+# 'ffv1' and 'hfyu' are lossless, 'mjpg' is lossy, and 'npy' skips encoding and writes raw frames to a FrameStore.
+CODECS = {
+    'rgba': ('RGBA', '.avi'),
+    'ffv1': ('FFV1', '.avi'),
+    'hfyu': ('HFYU', '.avi'),
+    'mjpg': ('MJPG', '.avi'),
+    'npy': (None, '.npy')
+}
+
+# Minimum number of seconds between updates of the progress line.
+PROGRESS_INTERVAL = 0.5
+
+# Size in bytes reserved for the .npy header of a FrameStore, so it can be rewritten with the final frame count.
+FRAME_STORE_HEADER = 128
+
+# Fields stored for every ball in every frame by BallManager.simulate_all, in order.
+SIMULATION_FIELDS = ('x', 'y', 'major', 'minor')
+# Number of frames evaluated at once by BallManager.simulate_all.
+SIMULATION_CHUNK = 4096
+
+# Number of impacts and releases a ball may go through in a single frame before the simulation gives up. Mirrors the
+# recursion limit that bounds Ball.nextFrame.
+MAX_SUBSTEPS = 1000
+
+# Stands in for the second ball of an event in BallArrays.collide_frame that is a ball reaching or leaving the ground.
+NO_BALL = -1
+# Least part of a step before a ball's next ground event in BallArrays.collide_frame, so a ball that rounding left just
+# short of reaching or leaving the ground is still moved past it.
+GROUND_EPSILON = 1e-9
+# Grid cells of BallArrays.candidate_pairs are numbered column * CELL_ROW + row + CELL_ROW // 2, which is unique for
+# any row that fits in 32 bits.
+CELL_ROW = 1 << 32
+
 
 class Ball:
     # Initializes Ball with color as an RGB tuple, ball radius, & starting height in px, all in a dictionary.
@@ -42,6 +89,7 @@ class Ball:
         self.ver_vel = 0
         self.deformation_acceleration = -1
 
+        self.starting_height = ball_attr['starting_height']
         self.x = self.radius
         self.y = ball_attr['starting_height']
 
@@ -126,6 +174,564 @@ class Ball:
         return ball_info
 
 
+# Struct-of-arrays version of Ball, used by BallManager when engine='vectorized' or with collisions. The state of every
+# ball is stored in numpy arrays so a frame is simulated with a handful of masked array operations instead of a Python
+# loop over Ball objects.
+class BallArrays:
+    # Initializes BallArrays from a list of Ball objects. Their current state is copied, so the Ball objects are not
+    # updated by nextFrame.
+    #
+    # collisions = True makes balls bounce off each other elastically, as per collide_frame.
+    def __init__(self, balls, collisions=False):
+        self.collisions = collisions
+        self.mass = np.array([ball.radius ** 2 for ball in balls], dtype=float)
+        self.colors = [ball.color for ball in balls]
+        self.radius = np.array([ball.radius for ball in balls], dtype=float)
+        self.deformation = np.array([ball.deformation for ball in balls], dtype=float)
+
+        self.hor_vel = np.array([ball.hor_vel for ball in balls], dtype=float)
+        self.ver_vel = np.array([ball.ver_vel for ball in balls], dtype=float)
+        self.deformation_acceleration = np.array([ball.deformation_acceleration for ball in balls], dtype=float)
+
+        self.x = np.array([ball.x for ball in balls], dtype=float)
+        self.y = np.array([ball.y for ball in balls], dtype=float)
+
+    # Calculate the next frame of every ball given acceleration and step, with or without collisions. Returns a boolean
+    # array of which balls bounced off the ground.
+    def nextFrame(self, acceleration, step):
+        if self.collisions:
+            return self.collide_frame(acceleration, step)
+
+        return self.advance(acceleration, step)
+
+    # Move balls on by step, ignoring the other balls. step must be positive, and is either one step for every ball or
+    # an array with one per ball. balls is an array of the balls to move, or None to move every ball. Follows
+    # Ball.nextFrame, but instead of recursing when a step crosses an impact or a release, the balls that crossed one
+    # are moved up to it and the loop repeats with the remainder of their step. Returns a boolean array of which of the
+    # balls bounced.
+    def advance(self, acceleration, step, balls=None):
+        if balls is None:
+            balls = np.arange(len(self.x))
+        remaining = np.broadcast_to(np.asarray(step, dtype=float), balls.shape).copy()
+        bounced = np.zeros(len(balls), dtype=bool)
+
+        # Positions in balls of the balls that still have some of their step left.
+        active = np.arange(len(balls))
+
+        substeps = 0
+        while len(active):
+            substeps += 1
+            assert substeps <= MAX_SUBSTEPS and "Ball bounces too many times in one frame for the given fps."
+
+            in_flight = self.in_flight(balls[active])
+            flight_pos = active[in_flight]
+            flight = balls[flight_pos]
+            impact_pos = active[~in_flight]
+            impact = balls[impact_pos]
+
+            # Predict change in y for balls that are not in impact. Impact occurs when the expected y is below the
+            # ground, which only a ball that moves down over its step can reach. A ball with nothing left of its step,
+            # having just bounced at the end of it, stays where it is, and a ball just leaving the ground with a tiny
+            # step isn't put back on it by rounding.
+            step_f = remaining[flight_pos]
+            y_delta = self.ver_vel[flight] * step_f + (1 / 2) * acceleration * (step_f ** 2)
+            hits = (self.y[flight] + y_delta <= self.radius[flight]) & (y_delta < 0)
+
+            # If no expected impact, predict values as normal.
+            free = flight[~hits]
+            free_step = step_f[~hits]
+            self.x[free] += free_step * self.hor_vel[free]
+            self.y[free] += y_delta[~hits]
+            self.ver_vel[free] += acceleration * free_step
+
+            # Determine impact speed and length of time til impact, and set x and y accordingly. Unlike Ball.nextFrame,
+            # a ball may still be going up at the start of the step, since collide_frame moves balls on over the time
+            # from one of their events to the next, and it is always falling by the time it reaches the ground.
+            hit_pos = flight_pos[hits]
+            hit = flight[hits]
+            ver_vel = self.ver_vel[hit]
+            impact_vel = -(((ver_vel ** 2) - 2 * acceleration * (self.y[hit] - self.radius[hit])) ** (1 / 2))
+
+            curr_step = (impact_vel - ver_vel) / acceleration
+            self.x[hit] += curr_step * self.hor_vel[hit]
+            self.y[hit] = self.radius[hit]
+            remaining[hit_pos] = np.maximum(remaining[hit_pos] - curr_step, 0)
+
+            # Deformable balls start their impact with the resulting acceleration of the center position, while rigid
+            # balls have their vertical velocity completely reversed and count as bounced.
+            deforms = self.deformation[hit] != 0
+            soft = hit[deforms]
+            deformation_acceleration = (impact_vel[deforms] ** 2) / (2 * (self.radius[soft] - 1))
+            self.deformation_acceleration[soft] = deformation_acceleration / self.deformation[soft]
+            self.ver_vel[soft] = impact_vel[deforms]
+
+            rigid = hit[~deforms]
+            self.ver_vel[rigid] = -impact_vel[~deforms]
+            bounced[hit_pos[~deforms]] = True
+
+            # For balls in the middle of impact, make calculations as per deformation_acceleration.
+            step_i = remaining[impact_pos]
+            deformation_acceleration = self.deformation_acceleration[impact]
+            y_delta = self.ver_vel[impact] * step_i + (1 / 2) * deformation_acceleration * (step_i ** 2)
+            escapes = (self.y[impact] + y_delta >= self.radius[impact]) & (step_i > 0)
+
+            # If not leaving impact, predict values with deformation_acceleration.
+            stay = impact[~escapes]
+            stay_step = step_i[~escapes]
+            self.x[stay] += stay_step * self.hor_vel[stay]
+            self.y[stay] += y_delta[~escapes]
+            self.ver_vel[stay] += deformation_acceleration[~escapes] * stay_step
+
+            # If leaving impact, move to the point of release and calculate the rest with gravity acceleration.
+            escape_pos = impact_pos[escapes]
+            escape = impact[escapes]
+            ver_vel = self.ver_vel[escape]
+            deformation_acceleration = deformation_acceleration[escapes]
+            escape_vel = (ver_vel ** 2 +
+                          2 * deformation_acceleration * (self.radius[escape] - self.y[escape])) ** (1 / 2)
+            curr_step = (escape_vel - ver_vel) / deformation_acceleration
+
+            self.x[escape] += curr_step * self.hor_vel[escape]
+            self.y[escape] = self.radius[escape]
+            self.ver_vel[escape] = escape_vel
+            remaining[escape_pos] = np.maximum(remaining[escape_pos] - curr_step, 0)
+            bounced[escape_pos] = True
+
+            # Balls that reached or left the ground carry on with the rest of their step.
+            active = np.concatenate([hit_pos, escape_pos])
+
+        return bounced
+
+    # Calculate the next frame of every ball given acceleration and step, with balls bouncing off each other. Balls
+    # collide as circles of their radius, elastically and with a mass that goes with their area, so no energy is lost,
+    # the same as bounces off the ground. Balls deforming against the ground pass through other balls, since the model
+    # only knows how to push them back up.
+    #
+    # Like a bounce, a step is split at every collision, and collisions are handled one at a time in order, as events
+    # in a heap. Two balls in flight have the same acceleration, so they move in a straight line relative to each other,
+    # and the time they touch is the root of a quadratic. That only holds until either of them reaches or leaves the
+    # ground, so every ball reaching or leaving the ground is an event as well. Each ball keeps the time within the step
+    # that its state is at, and is only moved on when it takes part in an event, when a ball it may collide with does,
+    # or when the step ends, so an event costs the same however many balls there are. Events queued before a ball's
+    # velocity changed are told apart by a count of the changes, and skipped.
+    #
+    # Which balls may collide is found with a uniform grid over the boxes each ball sweeps through the rest of the step,
+    # as per candidate_pairs. Balls whose velocity changed in a collision are added to the cells of their new box.
+    # Returns a boolean array of which balls bounced off the ground.
+    def collide_frame(self, acceleration, step):
+        self.times = np.zeros(len(self.x))
+        self.changes = np.zeros(len(self.x), dtype=int)
+        self.bounced = np.zeros(len(self.x), dtype=bool)
+        self.events = []
+
+        pairs = self.candidate_pairs(acceleration, step)
+        self.ground = np.maximum(self.ground_times(acceleration), step * GROUND_EPSILON)
+        for ball in np.flatnonzero(self.ground <= step).tolist():
+            heapq.heappush(self.events, (self.ground[ball], ball, NO_BALL, 0, 0))
+
+        limit = np.minimum(np.minimum(self.ground[pairs[:, 0]], self.ground[pairs[:, 1]]), step)
+        times = self.collision_times(pairs, limit)
+        colliding = np.isfinite(times)
+        for (first, second), time in zip(pairs[colliding].tolist(), times[colliding].tolist()):
+            heapq.heappush(self.events, (time, first, second, 0, 0))
+
+        events = 0
+        while self.events:
+            time, first, second, first_changes, second_changes = heapq.heappop(self.events)
+            if self.changes[first] != first_changes or (second != NO_BALL and self.changes[second] != second_changes):
+                continue
+
+            events += 1
+            assert events <= MAX_SUBSTEPS * len(self.x) and "Balls collide too many times in one frame."
+
+            # A ball reaching or leaving the ground only changes which balls it may still collide with and when.
+            if second == NO_BALL:
+                self.advance_to(acceleration, np.array([first]), time)
+                self.schedule(acceleration, step, first)
+                continue
+
+            balls = np.array([first, second])
+            self.advance_to(acceleration, balls, time)
+            self.bounced[self.resolve_collisions(balls.reshape(1, 2))] = True
+
+            self.boxes[balls] = self.swept_boxes(acceleration, step - time, balls)
+            for ball in (first, second):
+                for key in self.cell_keys(self.boxes[ball]).tolist():
+                    self.moved.setdefault(key, []).append(ball)
+            for ball in (first, second):
+                self.schedule(acceleration, step, ball)
+
+        self.advance_to(acceleration, np.arange(len(self.x)), step)
+
+        return self.bounced
+
+    # Move balls on from the time within the step each is at to time.
+    def advance_to(self, acceleration, balls, time):
+        self.bounced[balls] |= self.advance(acceleration, time - self.times[balls], balls)
+        self.times[balls] = time
+
+    # Queue the next event of ball, whose velocity just changed: it reaching or leaving the ground, and it touching any
+    # ball it may collide with before then. The balls it may collide with are moved on to the same time first.
+    def schedule(self, acceleration, step, ball):
+        now = self.times[ball]
+        self.changes[ball] += 1
+        self.ground[ball] = now + max(self.ground_times(acceleration, np.array([ball]))[0], step * GROUND_EPSILON)
+        if self.ground[ball] <= step:
+            heapq.heappush(self.events, (self.ground[ball], ball, NO_BALL, self.changes[ball], 0))
+
+        others = self.neighbours(ball)
+        if not len(others):
+            return
+
+        self.advance_to(acceleration, others, now)
+        pairs = np.stack([np.full(len(others), ball), others], axis=-1)
+        limit = np.minimum(np.minimum(self.ground[ball], self.ground[others]), step) - now
+        times = self.collision_times(pairs, limit) + now
+
+        colliding = np.isfinite(times)
+        for other, time in zip(others[colliding].tolist(), times[colliding].tolist()):
+            heapq.heappush(self.events, (time, ball, other, self.changes[ball], self.changes[other]))
+
+    # Pairs of balls, as an (n, 2) array, whose boxes swept over step overlap, so that they may collide within it.
+    #
+    # Every ball is listed under each cell of a uniform grid that its box covers. Cells are as big as the typical box,
+    # so most boxes cover at most 2 by 2 cells and a few fast or large balls cover more, and the balls under the same
+    # cell are paired up. The grid is kept, as cell keys sorted with the balls listed under them, for neighbours.
+    def candidate_pairs(self, acceleration, step):
+        self.boxes = self.swept_boxes(acceleration, np.full(len(self.x), step))
+        self.cell_size = float(np.median(np.maximum(self.boxes[:, 1] - self.boxes[:, 0],
+                                                    self.boxes[:, 3] - self.boxes[:, 2]))) if len(self.x) else 1.
+        self.moved = {}
+
+        # List every ball under each of the cells its box covers, row by row.
+        cells = np.floor(self.boxes / self.cell_size).astype(np.int64)
+        columns = cells[:, 1] - cells[:, 0] + 1
+        rows = cells[:, 3] - cells[:, 2] + 1
+        counts = columns * rows
+        owners = np.repeat(np.arange(len(self.x)), counts)
+        offsets = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+        keys = (cells[owners, 0] + offsets // rows[owners]) * CELL_ROW + cells[owners, 2] + offsets % rows[owners] + \
+            CELL_ROW // 2
+
+        order = np.argsort(keys, kind='stable')
+        self.grid_keys = keys[order]
+        self.grid_balls = owners[order]
+
+        # Entries under the same cell are next to each other once sorted, so pairing every entry with the one k places
+        # on pairs up every cell with more than k balls.
+        keys, owners = self.grid_keys, self.grid_balls
+        pairs = []
+        for k in range(1, len(keys)):
+            same = keys[k:] == keys[:-k]
+            if not np.any(same):
+                break
+
+            first, second = owners[:-k][same], owners[k:][same]
+            pairs.append(np.stack([np.minimum(first, second), np.maximum(first, second)], axis=-1))
+
+        if not pairs:
+            return np.empty((0, 2), dtype=int)
+
+        # A pair is listed once for every cell both balls cover. Numbering pairs makes dropping repeats a plain sort.
+        pairs = np.unique(np.concatenate(pairs) @ np.array([len(self.x), 1]))
+        pairs = np.stack([pairs // len(self.x), pairs % len(self.x)], axis=-1)
+
+        return pairs[self.boxes_overlap(self.boxes[pairs[:, 0]], self.boxes[pairs[:, 1]])]
+
+    # Balls whose boxes overlap the box of ball, found through the cells the box covers. Balls that moved cells after a
+    # collision are found under both their old and new cells, and the old ones are dropped by comparing boxes.
+    def neighbours(self, ball):
+        keys = self.cell_keys(self.boxes[ball])
+        starts = np.searchsorted(self.grid_keys, keys, side='left')
+        stops = np.searchsorted(self.grid_keys, keys, side='right')
+
+        others = [self.grid_balls[start:stop] for start, stop in zip(starts.tolist(), stops.tolist()) if stop > start]
+        others += [np.array(self.moved[key]) for key in keys.tolist() if key in self.moved]
+        if not others:
+            return np.empty(0, dtype=int)
+
+        others = np.unique(np.concatenate(others))
+        others = others[others != ball]
+
+        return others[self.boxes_overlap(self.boxes[others], self.boxes[ball])]
+
+    # Keys of the grid cells that box covers, as per candidate_pairs.
+    def cell_keys(self, box):
+        cells = np.floor(box / self.cell_size).astype(np.int64)
+        columns = np.arange(cells[0], cells[1] + 1)
+        rows = np.arange(cells[2], cells[3] + 1)
+
+        return (columns.reshape(-1, 1) * CELL_ROW + rows + CELL_ROW // 2).ravel()
+
+    # Boxes that the balls sweep through over remaining, one time per ball, as an array of [x_start, x_end, y_start,
+    # y_end] rows. Over that time a ball goes at most as fast as it does now plus what gravity adds, since bounces only
+    # ever turn it around, or as fast as it will leave the ground if it is deforming against it.
+    def swept_boxes(self, acceleration, remaining, balls=None):
+        if balls is None:
+            balls = np.arange(len(self.x))
+
+        radius = self.radius[balls]
+        ver_vel = self.ver_vel[balls]
+        deformation_acceleration = np.maximum(self.deformation_acceleration[balls], 0)
+        release_vel = (ver_vel ** 2 + 2 * deformation_acceleration * np.maximum(radius - self.y[balls], 0)) ** (1 / 2)
+        speed = np.where(self.in_flight(balls), np.abs(ver_vel), release_vel)
+
+        reach = (speed + abs(acceleration) * remaining) * remaining + radius
+        travel = self.hor_vel[balls] * remaining
+
+        return np.stack([self.x[balls] + np.minimum(travel, 0) - radius, self.x[balls] + np.maximum(travel, 0) + radius,
+                         self.y[balls] - reach, self.y[balls] + reach], axis=-1)
+
+    # Whether each of boxes overlaps the box at the same place in other_boxes, or the one other box.
+    def boxes_overlap(self, boxes, other_boxes):
+        return (boxes[..., 0] <= other_boxes[..., 1]) & (other_boxes[..., 0] <= boxes[..., 1]) & \
+            (boxes[..., 2] <= other_boxes[..., 3]) & (other_boxes[..., 2] <= boxes[..., 3])
+
+    # Which of balls, or every ball if None, are in flight rather than deforming against the ground, the same way
+    # advance tells them apart.
+    def in_flight(self, balls=None):
+        if balls is None:
+            balls = np.arange(len(self.x))
+
+        y = self.y[balls]
+        radius = self.radius[balls]
+
+        return (y > radius) | ((y == radius) & (self.ver_vel[balls] > 0))
+
+    # Time until each of balls, or every ball if None, reaches the ground, if it is in flight, or leaves it, if it is
+    # deforming against it. Balls that are just leaving or reaching it get infinity.
+    def ground_times(self, acceleration, balls=None):
+        if balls is None:
+            balls = np.arange(len(self.x))
+
+        in_flight = self.in_flight(balls)
+        height = self.y[balls] - self.radius[balls]
+        ver_vel = self.ver_vel[balls]
+        deformation_acceleration = self.deformation_acceleration[balls]
+        times = np.full(len(balls), np.inf)
+
+        discriminant = np.maximum(ver_vel[in_flight] ** 2 - 2 * acceleration * height[in_flight], 0)
+        times[in_flight] = (-ver_vel[in_flight] - discriminant ** (1 / 2)) / acceleration
+
+        impact = ~in_flight & (deformation_acceleration > 0)
+        discriminant = np.maximum(ver_vel[impact] ** 2 - 2 * deformation_acceleration[impact] * height[impact], 0)
+        times[impact] = (-ver_vel[impact] + discriminant ** (1 / 2)) / deformation_acceleration[impact]
+
+        return np.where(times > 0, times, np.inf)
+
+    # Time until each of pairs of balls touch, if both are in flight, they are closing in, and it is within limit, one
+    # for every pair or for all of them. Pairs that don't collide get infinity, and pairs that already overlap and are
+    # closing in collide right away.
+    def collision_times(self, pairs, limit):
+        first, second = pairs[:, 0], pairs[:, 1]
+        distance_x = self.x[second] - self.x[first]
+        distance_y = self.y[second] - self.y[first]
+        vel_x = self.hor_vel[second] - self.hor_vel[first]
+        vel_y = self.ver_vel[second] - self.ver_vel[first]
+
+        # Solve |distance + vel * t| = radii for the first time t the balls touch.
+        a = vel_x ** 2 + vel_y ** 2
+        b = 2 * (distance_x * vel_x + distance_y * vel_y)
+        c = distance_x ** 2 + distance_y ** 2 - (self.radius[first] + self.radius[second]) ** 2
+        discriminant = b ** 2 - 4 * a * c
+
+        times = np.full(len(pairs), np.inf)
+        closing = (b < 0) & (discriminant >= 0)
+        times[closing] = (-b[closing] - discriminant[closing] ** (1 / 2)) / (2 * a[closing])
+        times[closing & (c <= 0)] = 0
+
+        valid = self.in_flight(first) & self.in_flight(second) & (times <= limit)
+
+        return np.where(valid, np.maximum(times, 0), np.inf)
+
+    # Bounce every one of pairs of touching balls off each other, in order, conserving momentum and energy. Pairs that
+    # are no longer closing in after an earlier pair was resolved are left alone. A ball knocked down while it touches
+    # the ground starts its impact right away, as advance would have. Returns the balls that bounced off the ground
+    # because of it.
+    def resolve_collisions(self, pairs):
+        for first, second in pairs.tolist():
+            normal = np.array([self.x[second] - self.x[first], self.y[second] - self.y[first]])
+            normal /= max(np.hypot(normal[0], normal[1]), 1e-12)
+
+            closing_vel = (self.hor_vel[second] - self.hor_vel[first]) * normal[0] + \
+                (self.ver_vel[second] - self.ver_vel[first]) * normal[1]
+            if closing_vel >= 0:
+                continue
+
+            total_mass = self.mass[first] + self.mass[second]
+            first_change = 2 * self.mass[second] / total_mass * closing_vel
+            second_change = -2 * self.mass[first] / total_mass * closing_vel
+
+            self.hor_vel[first] += first_change * normal[0]
+            self.ver_vel[first] += first_change * normal[1]
+            self.hor_vel[second] += second_change * normal[0]
+            self.ver_vel[second] += second_change * normal[1]
+
+        touched = np.unique(pairs)
+        landed = touched[(self.y[touched] <= self.radius[touched]) & (self.ver_vel[touched] < 0)]
+        self.y[landed] = self.radius[landed]
+
+        deforms = self.deformation[landed] != 0
+        soft = landed[deforms]
+        self.deformation_acceleration[soft] = (self.ver_vel[soft] ** 2) / (2 * (self.radius[soft] - 1)) / \
+            self.deformation[soft]
+
+        rigid = landed[~deforms]
+        self.ver_vel[rigid] = -self.ver_vel[rigid]
+
+        return rigid
+
+    # Return position, deformation, and color of every ball, formatted as per Ball.get_info.
+    def get_info(self):
+        minor = np.minimum(self.y, self.radius)
+        major = (self.radius ** 2) / minor
+
+        return BallInfo(np.stack([self.x, self.y, major, minor], axis=-1), self.colors)
+
+
+# Info of every ball in a frame, as returned by BallArrays.get_info. The state is kept as one array shaped (balls,
+# fields), where fields are SIMULATION_FIELDS, and the dictionary of a ball, as per Ball.get_info, is only built when it
+# is indexed. ScreenWriter.generate_image draws straight from the array, so frames of many balls make no dictionaries.
+class BallInfo(collections.abc.Sequence):
+    def __init__(self, state, colors):
+        self.state = state
+        self.colors = colors
+
+    def __len__(self):
+        return len(self.state)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(len(self))[index]]
+
+        x, y, major, minor = self.state[index].tolist()
+        return {
+            'x': x,
+            'y': y,
+            'major': major,
+            'minor': minor,
+            'color': self.colors[index]
+        }
+
+
+# Event-driven version of BallArrays, used by BallManager when engine='event'. Between impacts and releases a ball
+# moves with a constant acceleration, gravity in flight and deformation_acceleration in impact, so its state at any time
+# follows from where the current phase started. Every ball keeps the start of its phase and the time of its next impact
+# or release in a heap, and a frame only pops the events it passes before evaluating every ball in its phase at once.
+# Without energy loss, a ball repeats the same period of flight and impact forever, so whole periods that fit in a frame
+# are skipped at once and counted as a bounce each, and a ball takes at most a few events a frame however many times it
+# bounces in it. Nothing recurses either, so very low fps works.
+class BallEvents(BallArrays):
+    def __init__(self, balls):
+        super().__init__(balls)
+
+        self.time = 0
+        self.phase_time = np.zeros(len(balls))
+        self.phase_x = self.x.copy()
+        self.phase_y = self.y.copy()
+        self.phase_vel = self.ver_vel.copy()
+        self.phase_acceleration = np.zeros(len(balls))
+        self.in_impact = np.zeros(len(balls), dtype=bool)
+        self.event_vel = np.zeros(len(balls))
+        self.events = []
+
+    # Calculate the next frame of every ball given acceleration and step, as per BallArrays.nextFrame. Returns an
+    # integer array of how many times each ball bounced, since a ball may bounce more than once in a frame.
+    def nextFrame(self, acceleration, step):
+        if not self.events:
+            self.start(acceleration)
+
+        self.time += step
+        bounces = np.zeros(len(self.x), dtype=int)
+        while self.events and self.events[0][0] <= self.time:
+            event_time, i = heapq.heappop(self.events)
+            bounces[i] += self.next_phase(i, event_time, acceleration)
+
+        elapsed = self.time - self.phase_time
+        self.x = self.phase_x + self.hor_vel * elapsed
+        self.y = self.phase_y + self.phase_vel * elapsed + (1 / 2) * self.phase_acceleration * (elapsed ** 2)
+        self.ver_vel = self.phase_vel + self.phase_acceleration * elapsed
+
+        return bounces
+
+    # Start the phase every ball is in and queue its first event. Balls that are in the middle of impact, such as ones
+    # already stepped by Ball.nextFrame, keep going with their deformation_acceleration.
+    def start(self, acceleration):
+        in_flight = (self.y > self.radius) | ((self.y == self.radius) & (self.ver_vel > 0))
+        self.in_impact = ~in_flight
+        self.phase_acceleration = np.where(in_flight, acceleration, self.deformation_acceleration)
+
+        for i in range(len(self.x)):
+            self.push_event(i)
+
+    # Move ball i to the impact or release at event_time, start its next phase and queue the event that ends it.
+    # Returns 1 if the ball bounced, as rigid balls do on impact and deformable balls on release, and 0 otherwise.
+    def next_phase(self, i, event_time, acceleration):
+        elapsed = event_time - self.phase_time[i]
+        self.phase_x[i] += self.hor_vel[i] * elapsed
+        self.phase_y[i] = self.radius[i]
+        self.phase_vel[i] = self.event_vel[i]
+        self.phase_time[i] = event_time
+
+        bounced = 1
+        if self.in_impact[i]:
+            # Released with the speed it left the ground with, and back in flight.
+            self.in_impact[i] = False
+            self.phase_acceleration[i] = acceleration
+        elif self.deformation[i] != 0:
+            # Deformable balls start their impact with the resulting acceleration of the center position.
+            self.deformation_acceleration[i] = (self.phase_vel[i] ** 2) / (2 * (self.radius[i] - 1)) / \
+                self.deformation[i]
+            self.in_impact[i] = True
+            self.phase_acceleration[i] = self.deformation_acceleration[i]
+            bounced = 0
+        else:
+            # Rigid balls have their vertical velocity completely reversed.
+            self.phase_vel[i] = -self.phase_vel[i]
+
+        bounced += self.skip_periods(i, acceleration)
+        self.push_event(i)
+
+        return bounced
+
+    # Skip ball i, which is on the ground at the start of a phase, ahead by as many whole periods as fit before the end
+    # of the frame. Every period brings it back to the same phase with the same speed, and holds one bounce. The period
+    # is the flight up and back down at that speed, and for deformable balls the impact, which lasts as long as
+    # get_bounce_times' 2 * deform_time. Returns the number of periods skipped.
+    def skip_periods(self, i, acceleration):
+        speed = abs(self.phase_vel[i])
+        if speed == 0:
+            return 0
+
+        period = 2 * speed / abs(acceleration)
+        if self.deformation[i] != 0:
+            period += 4 * (self.radius[i] - 1) * self.deformation[i] / speed
+
+        periods = int((self.time - self.phase_time[i]) // period)
+        if periods > 0:
+            self.phase_time[i] += periods * period
+            self.phase_x[i] += self.hor_vel[i] * periods * period
+
+        return max(periods, 0)
+
+    # Work out when ball i reaches the ground in flight, or leaves it in impact, and queue it. The velocity it does so
+    # with is kept in event_vel for next_phase.
+    def push_event(self, i):
+        velocity = self.phase_vel[i]
+        phase_acceleration = self.phase_acceleration[i]
+        height = self.phase_y[i] - self.radius[i]
+
+        # Falling balls reach the ground as fast as they would have if dropped from their peak, and deforming balls
+        # leave it as fast as they would have if they had just arrived.
+        if self.in_impact[i]:
+            event_vel = (velocity ** 2 - 2 * phase_acceleration * height) ** (1 / 2)
+        else:
+            event_vel = -((velocity ** 2 - 2 * phase_acceleration * height) ** (1 / 2))
+
+        self.event_vel[i] = event_vel
+        heapq.heappush(self.events, (self.phase_time[i] + (event_vel - velocity) / phase_acceleration, i))
+
+
 # Create a separate BallManager class because there are many attributes that are shared between balls, thus making it
 # redundant in the Ball class, that are also relevant to trajectory calculation, making it different from the
 # ScreenWriter class.
@@ -137,7 +743,13 @@ class BallManager:
     # duration should a positive integer regardless of frames or bounces.
     # count_frames = True when counting bounces, False when counting frames.
     # fps is a positive integer
-    def __init__(self, acceleration, duration, count_frames, fps, balls=None):
+    # engine is one of ENGINES. 'object' steps each Ball in turn, 'vectorized' steps every ball at once with
+    # BallArrays, and 'event' jumps from impact to impact with BallEvents, counting every bounce even when several fall
+    # in one frame.
+    # collisions = True makes balls bounce off each other, as per BallArrays.collide_frame, which always steps them with
+    # BallArrays, whatever the engine. Balls that collide no longer repeat the same period forever, so their state can
+    # only be found by stepping through every frame before it.
+    def __init__(self, acceleration, duration, count_frames, fps, balls=None, engine='object', collisions=False):
         if balls is None:
             balls = []
 
@@ -146,6 +758,7 @@ class BallManager:
 
         assert type(count_frames) is bool
         assert type(duration) is int
+        assert engine in ENGINES
 
         self.acceleration = acceleration
         self.count_frames = count_frames
@@ -159,6 +772,15 @@ class BallManager:
         self.fps = fps
         self.balls = balls
 
+        self.engine = engine
+        self.collisions = collisions
+        self.ball_arrays = None
+        self.stepper = None
+        if self.engine == 'vectorized' or self.collisions:
+            self.ball_arrays = BallArrays(balls, collisions)
+        elif self.engine == 'event':
+            self.ball_arrays = BallEvents(balls)
+
     # Simulate next frame of balls and return ball info.
     def nextFrame(self):
         balls_info = []
@@ -170,6 +792,20 @@ class BallManager:
             if self.curr_frames >= self.max_frames:
                 finished = True
 
+        # Step every ball at once, with the same bounce bookkeeping as below, except that BallEvents may count more than
+        # one bounce per frame.
+        if self.ball_arrays is not None:
+            bounced = self.ball_arrays.nextFrame(-self.acceleration, 1 / self.fps)
+            if not self.count_frames:
+                for i in np.flatnonzero(bounced):
+                    self.curr_bounces[i] += int(bounced[i])
+
+                reached = np.array(self.curr_bounces) >= self.max_bounces
+                if np.any(reached & (self.ball_arrays.ver_vel < 0)):
+                    finished = True
+
+            return self.ball_arrays.get_info(), finished
+
         # Iterate though each ball and store info.
         for i, ball in enumerate(self.balls):
             ball_info, bounced = ball.nextFrame(-self.acceleration, 1 / self.fps)
@@ -184,8 +820,178 @@ class BallManager:
 
         return balls_info, finished
 
+    # Evaluate the state of every ball at the given frames analytically, without stepping through the frames before
+    # them. Each ball starts at the peak of a period that it repeats forever (see get_bounce_times), so its state only
+    # depends on how far into the current period the frame falls. Stepping adds up a frame's worth of motion at a time,
+    # so the two only agree up to floating-point rounding, and a ball centered halfway between two pixels can be drawn a
+    # pixel apart by each.
+    #
+    # frame_indices is an integer or an array of non-negative integers, where 0 is the starting frame. Returns a
+    # dictionary of arrays shaped (frames, balls) with keys ['x', 'y', 'major', 'minor', 'ver_vel', 'bounces'].
+    def state_at(self, frame_indices):
+        assert not self.collisions and "Balls that collide can only be simulated by stepping through every frame."
+
+        frames = np.atleast_1d(np.asarray(frame_indices))
+        assert frames.ndim == 1 and np.all(frames >= 0)
+
+        starting_height = np.array([ball.starting_height for ball in self.balls], dtype=float)
+        radius = np.array([ball.radius for ball in self.balls], dtype=float)
+        hor_vel = np.array([ball.hor_vel for ball in self.balls], dtype=float)
+        bounce_times = np.array([get_bounce_times(ball.starting_height, ball.radius, ball.deformation,
+                                                  self.acceleration) for ball in self.balls], dtype=float)
+        fall_time = bounce_times[:, 0]
+        deform_time = bounce_times[:, 1]
+
+        impact_vel = fall_time * self.acceleration
+        deformation_acceleration = np.divide(impact_vel, deform_time, out=np.zeros_like(impact_vel),
+                                             where=deform_time > 0)
+        release_time = fall_time + 2 * deform_time
+        period = release_time + fall_time
+
+        # Split every frame's time into completed periods and the time into the current one.
+        t = frames.reshape(-1, 1) / self.fps
+        periods = np.floor_divide(t, period)
+        phase = t - periods * period
+
+        # Falling from the peak.
+        y = starting_height - (1 / 2) * self.acceleration * (phase ** 2)
+        ver_vel = -self.acceleration * phase
+
+        # In impact, decelerating with deformation_acceleration and then accelerating back up to release.
+        impact_phase = phase - fall_time
+        in_impact = (impact_phase >= 0) & (phase < release_time)
+        y = np.where(in_impact, radius - impact_vel * impact_phase + (1 / 2) * deformation_acceleration *
+                     (impact_phase ** 2), y)
+        ver_vel = np.where(in_impact, deformation_acceleration * impact_phase - impact_vel, ver_vel)
+
+        # Rising back to the peak after release.
+        rise_phase = phase - release_time
+        rising = rise_phase >= 0
+        y = np.where(rising, radius + impact_vel * rise_phase - (1 / 2) * self.acceleration * (rise_phase ** 2), y)
+        ver_vel = np.where(rising, impact_vel - self.acceleration * rise_phase, ver_vel)
+
+        minor = np.minimum(y, radius)
+        major = (radius ** 2) / minor
+
+        state = {
+            'x': radius + hor_vel * t,
+            'y': y,
+            'major': major,
+            'minor': minor,
+            'ver_vel': ver_vel,
+            'bounces': periods.astype(int) + rising
+        }
+
+        return state
+
+    # Return the number of frames in the run, including the starting frame, without simulating it. When counting
+    # bounces, the run finishes on the first frame where a ball that has reached max bounces is falling again, exactly
+    # as nextFrame decides it. Returns None for balls that collide counted in bounces, since then the run is only known
+    # to finish once it is stepped through.
+    def get_num_frames(self):
+        if self.count_frames:
+            return self.max_frames + 1
+
+        if self.collisions:
+            return None
+
+        # A ball's max_bounces-th bounce is followed by a peak after max_bounces whole periods, so the first frame
+        # after that peak is a candidate. Check a few frames around each candidate to guard against rounding.
+        periods = []
+        for ball in self.balls:
+            fall_time, deform_time = get_bounce_times(ball.starting_height, ball.radius, ball.deformation,
+                                                      self.acceleration)
+            periods.append(2 * (fall_time + deform_time))
+
+        candidates = np.floor(np.array(periods) * self.max_bounces * self.fps).astype(int)
+        frames = np.unique(np.maximum(candidates.reshape(-1, 1) + np.arange(-1, 3), 1))
+
+        state = self.state_at(frames)
+        finished = np.any((state['bounces'] >= self.max_bounces) & (state['ver_vel'] < 0), axis=1)
+        while not np.any(finished):
+            frames = np.arange(frames[-1] + 1, frames[-1] + 1 + SIMULATION_CHUNK)
+            state = self.state_at(frames)
+            finished = np.any((state['bounces'] >= self.max_bounces) & (state['ver_vel'] < 0), axis=1)
+
+        return int(frames[np.argmax(finished)]) + 1
+
+    # Precompute the whole run with state_at and return it as a float32 array shaped (frames, balls, fields), where
+    # fields are SIMULATION_FIELDS. If path is given, the array is written to it as a memory-mapped .npy file while it
+    # is filled, so runs larger than memory can be precomputed, and can be read back with load_simulation.
+    def simulate_all(self, path=None):
+        num_frames = self.get_num_frames()
+
+        # A run of unknown length is stepped through chunk by chunk until a chunk comes back short, and only stored
+        # once it is over.
+        chunks = []
+        while num_frames is None:
+            start = len(chunks) * SIMULATION_CHUNK
+            chunks.append(self.simulate_range(start, start + SIMULATION_CHUNK))
+            if len(chunks[-1]) < SIMULATION_CHUNK:
+                num_frames = start + len(chunks[-1])
+
+        shape = (num_frames, len(self.balls), len(SIMULATION_FIELDS))
+        if path is None:
+            simulation = np.empty(shape, dtype='float32')
+        else:
+            simulation = np.lib.format.open_memmap(path, mode='w+', dtype='float32', shape=shape)
+
+        for i, chunk in enumerate(chunks):
+            simulation[i * SIMULATION_CHUNK:i * SIMULATION_CHUNK + len(chunk)] = chunk
+
+        for start in range(0, shape[0] if not chunks else 0, SIMULATION_CHUNK):
+            stop = min(start + SIMULATION_CHUNK, shape[0])
+            simulation[start:stop] = self.simulate_range(start, stop)
+
+        if path is not None:
+            simulation.flush()
+
+        return simulation
+
+    # Precompute frames start up to stop with state_at, formatted as per simulate_all.
+    def simulate_range(self, start, stop):
+        if self.collisions:
+            return self.step_range(start, stop)
+
+        state = self.state_at(np.arange(start, stop))
+
+        simulation = np.empty((stop - start, len(self.balls), len(SIMULATION_FIELDS)), dtype='float32')
+        for i, field in enumerate(SIMULATION_FIELDS):
+            simulation[:, :, i] = state[field]
+
+        return simulation
+
+    # Step a copy of the manager on to frame stop, or to the end of the run if stop is None, and return frames start up
+    # to there, formatted as per simulate_all. Frames past the end of the run are left out. For balls that collide,
+    # whose state can't be worked out analytically. The copy is kept at the frame it stopped on, so consecutive ranges
+    # are stepped through once, and it only starts over from the starting frame when start is behind it. Balls are
+    # always stepped with BallArrays then, which leaves the Ball objects at the starting frame.
+    def step_range(self, start, stop):
+        if self.stepper is None or start < self.stepper_frame:
+            self.stepper = BallManager(self.acceleration, self.max_frames if self.count_frames else self.max_bounces,
+                                       self.count_frames, self.fps, self.balls, self.engine, self.collisions)
+            self.stepper_frame = 0
+            self.stepper_finished = False
+        ball_arrays = self.stepper.ball_arrays
+
+        frames = []
+        while stop is None or self.stepper_frame < stop:
+            if self.stepper_frame >= start:
+                minor = np.minimum(ball_arrays.y, ball_arrays.radius)
+                frames.append(np.stack([ball_arrays.x, ball_arrays.y, ball_arrays.radius ** 2 / minor, minor], axis=-1))
+
+            if self.stepper_finished:
+                break
+            self.stepper_finished = self.stepper.nextFrame()[1]
+            self.stepper_frame += 1
+
+        return np.array(frames, dtype='float32').reshape(-1, len(self.balls), len(SIMULATION_FIELDS))
+
     # Return info of all balls in manager.
     def get_info(self):
+        if self.ball_arrays is not None:
+            return self.ball_arrays.get_info()
+
         output = []
         for ball in self.balls:
             output.append(ball.get_info())
@@ -196,7 +1002,21 @@ class BallManager:
 class ScreenWriter:
     # Initializes ScreenWriter. Only takes in resolution, a 2-dim tuple of positive integers, and fps, a positive
     # integer.
-    def __init__(self, bg_color, resolution, fps, title='test.avi'):
+    #
+    # dirty_rect = True keeps a single frame buffer for the whole video. Every frame only the bounding boxes drawn in
+    # the previous frame are restored from a cached background, so the work per frame scales with the area of the balls
+    # rather than the resolution. The returned image is then overwritten by the next frame.
+    #
+    # sprite_cache is the number of pre-rasterized ellipses to keep, keyed by color and rounded axes. Balls are then
+    # copied into the frame from the cache instead of being rasterized again. 0 disables the cache.
+    #
+    # queue_size is the number of frames that can wait to be encoded. If above 0, frames are handed to a background
+    # thread through a bounded queue, so drawing the next frame overlaps with encoding the last one. 0 encodes inline.
+    #
+    # codec is one of CODECS, and title should end with its file ending. If title is None, frames are only drawn, and
+    # never written anywhere, for when they are consumed straight from generate_image.
+    def __init__(self, bg_color, resolution, fps, title='test.avi', dirty_rect=False, sprite_cache=0, queue_size=0,
+                 codec='rgba'):
         assert (type(bg_color) is list or type(bg_color) is tuple) and len(bg_color) == 3
         assert 0 <= bg_color[0] <= 255 and \
                0 <= bg_color[1] <= 255 and \
@@ -215,24 +1035,259 @@ class ScreenWriter:
         self.fps = fps
         self.imgs = []
 
-        self.writer = cv2.VideoWriter(title, cv2.VideoWriter_fourcc(*'RGBA'), fps, resolution)
+        self.dirty_rect = dirty_rect
+        self.background = None
+        self.dirty = []
+        if self.dirty_rect:
+            self.background = self.curr_display.copy()
+
+        assert type(sprite_cache) is int and sprite_cache >= 0
+        self.sprite_cache = sprite_cache
+        self.sprites = collections.OrderedDict()
+        self.sprite_hits = 0
+        self.sprite_misses = 0
+
+        assert codec in CODECS
+        self.codec = codec
+        self.writer = None
+        if title is not None:
+            self.writer = open_writer(title, codec, fps, resolution)
+
+        # Time spent drawing, time spent encoding, time the producer waited on a full queue, and time the encoder
+        # waited on an empty one.
+        self.raster_time = 0
+        self.encode_time = 0
+        self.producer_stall = 0
+        self.encoder_stall = 0
+
+        assert type(queue_size) is int and queue_size >= 0
+        self.queue_size = queue_size
+        self.frames = None
+        self.encoder = None
+        self.encoder_error = None
+        if self.queue_size and self.writer is not None:
+            self.frames = queue.Queue(maxsize=queue_size)
+            self.encoder = threading.Thread(target=self.encode_frames, daemon=True)
+            self.encoder.start()
         return
 
-    # Generate the image from info about the balls. Balls_info must be a list formatted as per Ball.get_info
+    # Generate the image from info about the balls. Balls_info must be a list formatted as per Ball.get_info, or a
+    # BallInfo, which is drawn straight from its array.
     def generate_image(self, balls_info):
-        self.curr_display = np.zeros((self.resolution[1], self.resolution[0], 3), dtype='uint8')
-        self.curr_display[:] = self.bg_color
-        for ball in balls_info:
-            self.curr_display = cv2.ellipse(self.curr_display,
-                                            np.round((ball['x'], self.resolution[1] - ball['y'])).astype('uint32'),
-                                            np.round((ball['major'], ball['minor'])).astype('uint32'),
-                                            0, 0, 360, ball['color'], thickness=-1)
-
-        self.writer.write(self.curr_display)
+        if isinstance(balls_info, BallInfo):
+            return self.generate_image_from_simulation(balls_info.state, balls_info.colors)
+
+        start = time.perf_counter()
+        with profiling.stage('rasterize'):
+            self.clear_display()
+            for ball in balls_info:
+                self.draw_ball(ball['x'], ball['y'], ball['major'], ball['minor'], ball['color'])
+        self.raster_time += time.perf_counter() - start
+
+        self.write_frame(self.curr_display)
         return self.curr_display
 
+    # Generate the image from one frame of BallManager.simulate_all. frame_state is an array shaped (balls, fields) and
+    # colors is the list of ball colors in the same order.
+    def generate_image_from_simulation(self, frame_state, colors):
+        start = time.perf_counter()
+        with profiling.stage('rasterize'):
+            self.clear_display()
+            for (x, y, major, minor), color in zip(frame_state.tolist(), colors):
+                self.draw_ball(x, y, major, minor, color)
+        self.raster_time += time.perf_counter() - start
+
+        self.write_frame(self.curr_display)
+        return self.curr_display
+
+    # Reset the current display to the background before drawing a frame.
+    def clear_display(self):
+        if not self.dirty_rect:
+            self.curr_display = np.zeros((self.resolution[1], self.resolution[0], 3), dtype='uint8')
+            self.curr_display[:] = self.bg_color
+            return
+
+        for top, bottom, left, right in self.dirty:
+            self.curr_display[top:bottom, left:right] = self.background[top:bottom, left:right]
+        self.dirty = []
+
+    # Draw a single ball onto the current display. x and y are measured from the bottom left of the image.
+    def draw_ball(self, x, y, major, minor, color):
+        center = np.round((x, self.resolution[1] - y)).astype('int32')
+        axes = np.round((major, minor)).astype('uint32')
+        if self.sprite_cache:
+            self.draw_sprite(int(center[0]), int(center[1]), int(axes[0]), int(axes[1]), color)
+        else:
+            self.curr_display = cv2.ellipse(self.curr_display, center, axes, 0, 0, 360, color, thickness=-1)
+
+        # Record the bounding box of the ellipse, with a pixel of margin, so it can be restored next frame.
+        if self.dirty_rect:
+            left, top = (int(center[0]) - int(axes[0]) - 1, int(center[1]) - int(axes[1]) - 1)
+            right, bottom = (int(center[0]) + int(axes[0]) + 2, int(center[1]) + int(axes[1]) + 2)
+            self.dirty.append((max(top, 0), min(bottom, self.resolution[1]),
+                               max(left, 0), min(right, self.resolution[0])))
+
+    # Copy a pre-rasterized ellipse centered at (center_x, center_y) into the current display, rasterizing it into the
+    # cache first if needed. Filled ellipses with integer centers rasterize the same wherever they are placed, so this
+    # matches cv2.ellipse pixel for pixel. Ellipses cut off by the edge of the display are rasterized as usual, since
+    # cv2.ellipse clips their outline slightly differently.
+    def draw_sprite(self, center_x, center_y, major, minor, color):
+        top, left = (center_y - minor - 1, center_x - major - 1)
+        bottom, right = (center_y + minor + 2, center_x + major + 2)
+        if top < 0 or left < 0 or bottom > self.resolution[1] or right > self.resolution[0]:
+            self.curr_display = cv2.ellipse(self.curr_display, (center_x, center_y), (major, minor), 0, 0, 360, color,
+                                            thickness=-1)
+            return
+
+        key = (tuple(color), major, minor)
+        if key in self.sprites:
+            self.sprites.move_to_end(key)
+            self.sprite_hits += 1
+        else:
+            # Rasterize the ellipse at the center of a patch with a pixel of margin on each side.
+            mask = np.zeros((2 * minor + 3, 2 * major + 3), dtype='uint8')
+            mask = cv2.ellipse(mask, (major + 1, minor + 1), (major, minor), 0, 0, 360, 255, thickness=-1)
+            patch = np.empty((mask.shape[0], mask.shape[1], 3), dtype='uint8')
+            patch[:] = color
+
+            self.sprites[key] = (patch, mask)
+            self.sprite_misses += 1
+            if len(self.sprites) > self.sprite_cache:
+                self.sprites.popitem(last=False)
+
+        patch, mask = self.sprites[key]
+        cv2.copyTo(patch, mask, self.curr_display[top:bottom, left:right])
+
+    # Return the hit and miss counts of the sprite cache, along with how many sprites it holds, to help size it.
+    def sprite_cache_info(self):
+        sprite_info = {
+            'hits': self.sprite_hits,
+            'misses': self.sprite_misses,
+            'size': len(self.sprites),
+            'max_size': self.sprite_cache
+        }
+
+        return sprite_info
+
+    # Encode a frame, or queue it for the encoder thread. The frame buffer is reused with dirty_rect, so it is copied
+    # before being queued.
+    def write_frame(self, frame):
+        if self.writer is None:
+            return
+
+        if self.frames is None:
+            start = time.perf_counter()
+            with profiling.stage('encode'):
+                self.writer.write(frame)
+            self.encode_time += time.perf_counter() - start
+            return
+
+        if self.dirty_rect:
+            frame = frame.copy()
+
+        start = time.perf_counter()
+        self.frames.put(frame)
+        self.producer_stall += time.perf_counter() - start
+
+    # Runs on the encoder thread. Encodes queued frames in order until release queues None. If encoding fails, the
+    # error is kept for release to raise and the remaining frames are drained so the producer never blocks forever.
+    def encode_frames(self):
+        while True:
+            start = time.perf_counter()
+            frame = self.frames.get()
+            self.encoder_stall += time.perf_counter() - start
+            if frame is None:
+                return
+
+            if self.encoder_error is not None:
+                continue
+
+            start = time.perf_counter()
+            try:
+                with profiling.stage('encode'):
+                    self.writer.write(frame)
+            except Exception as error:
+                self.encoder_error = error
+            self.encode_time += time.perf_counter() - start
+
+    # Return how long was spent encoding, and how long the producer and encoder thread stalled waiting on each other.
+    # A high producer stall means encoding is the bottleneck, a high encoder stall means drawing is.
+    def writer_stats(self):
+        stats = {
+            'encode_time': self.encode_time,
+            'producer_stall': self.producer_stall,
+            'encoder_stall': self.encoder_stall
+        }
+
+        return stats
+
+    # Flush any queued frames and close the video.
+    def release(self):
+        if self.encoder is not None:
+            self.frames.put(None)
+            self.encoder.join()
+            self.encoder = None
+
+        if self.writer is not None:
+            self.writer.release()
+
+        if self.encoder_error is not None:
+            raise self.encoder_error
+
+
+# Writes frames to a .npy file of shape (frames, height, width, 3) as they come, with the same write and release
+# methods as cv2.VideoWriter. Nothing is encoded, so writing is as fast as the disk, and the result can be memory-mapped
+# with np.load for pipelines that feed frames straight into tracking.
+class FrameStore:
+    # Initializes FrameStore to write to path. resolution is a 2-dim tuple of positive integers.
+    def __init__(self, path, resolution):
+        self.path = path
+        self.resolution = resolution
+        self.num_frames = 0
+
+        self.file = open(path, 'wb')
+        self.write_header()
+
+    # Write the .npy header for the frames written so far, padded to FRAME_STORE_HEADER bytes so it can be rewritten in
+    # place.
+    def write_header(self):
+        header = {
+            'descr': '|u1',
+            'fortran_order': False,
+            'shape': (self.num_frames, self.resolution[1], self.resolution[0], 3)
+        }
+        header = repr(header).ljust(FRAME_STORE_HEADER - 11) + '\n'
+
+        self.file.seek(0)
+        self.file.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1'))
+
+    def isOpened(self):
+        return not self.file.closed
+
+    def write(self, frame):
+        assert frame.shape == (self.resolution[1], self.resolution[0], 3) and frame.dtype == np.uint8
+        self.file.write(np.ascontiguousarray(frame).data)
+        self.num_frames += 1
+
+    # Record the final number of frames in the header and close the file.
     def release(self):
-        self.writer.release()
+        if self.file.closed:
+            return
+
+        self.write_header()
+        self.file.close()
+
+
+# Open a writer for title with one of the CODECS presets.
+def open_writer(title, codec, fps, resolution):
+    fourcc, ending = CODECS[codec]
+    if fourcc is None:
+        return FrameStore(title, resolution)
+
+    writer = cv2.VideoWriter(title, cv2.VideoWriter_fourcc(*fourcc), fps, resolution)
+    assert writer.isOpened() and "OpenCV was not able to open a writer for the given codec."
+
+    return writer
 
 
 # DONE: creates argparse object and passes to parse_args function
@@ -249,44 +1304,260 @@ class ScreenWriter:
 
 def main():
     args = parse_args(sys.argv[1:])
+    with profiling.session(args['profile'], args['cprofile'], args['tracemalloc'], args['profile_report']):
+        generate_video(args)
+
 
-    if not os.path.exists(args['output_dir']):
-        os.mkdir(args['output_dir'])
+# Generate a video from an argument dictionary formatted as per parse_args. Returns the timing summary of the run, as
+# per Progress.summary.
+def generate_video(args):
+    os.makedirs(args['output_dir'], exist_ok=True)
 
     ball_args = args['balls']
-    print('Number of balls: ' + str(len(ball_args)))
+    if not args['quiet']:
+        print('Number of balls: ' + str(len(ball_args)))
 
     ball_args = get_horizontal_scale(ball_args, args)
-    print(ball_args)
+    if not args['quiet']:
+        print(ball_args)
 
     # Initialize balls, manager, and screenwriter
     balls = []
     for ball_arg in ball_args:
         balls.append(Ball(ball_arg))
 
-    manager = BallManager(args['acceleration'], args['duration'], args['count_frames'], args['fps'], balls)
+    manager = BallManager(args['acceleration'], args['duration'], args['count_frames'], args['fps'], balls,
+                          engine=args['engine'], collisions=args['collisions'])
+    progress = Progress(manager.get_num_frames(), args['quiet'])
+
+    # Render contiguous frame ranges in separate processes and join them afterwards. A run whose length isn't known
+    # ahead of time can't be split, and is rendered in this process.
+    if args['workers'] > 1 and progress.num_frames is not None:
+        timings = render_parallel(args, ball_args, progress)
+        return progress.summary(timings)
+
     screenwriter = ScreenWriter(args['background_color'], args['resolution'], args['fps'],
-                                os.path.join(args['output_dir'], args['title']))
+                                os.path.join(args['output_dir'], args['title']), dirty_rect=args['dirty_rect'],
+                                sprite_cache=args['sprite_cache'], queue_size=args['queue_size'],
+                                codec=args['codec'])
+    simulation_time = 0
+
+    # Precompute the whole run up front and render it from the saved array.
+    if args['simulation_path'] is not None:
+        start = time.perf_counter()
+        with profiling.stage('simulate'):
+            simulation = manager.simulate_all(args['simulation_path'])
+        colors = [ball.color for ball in balls]
+        simulation_time += time.perf_counter() - start
+
+        for frame_state in simulation:
+            screenwriter.generate_image_from_simulation(frame_state, colors)
+            progress.update()
 
-    finished = False
-    frame_num = 0
+    else:
+        finished = False
 
-    ball_info = manager.get_info()
-    screenwriter.generate_image(ball_info)
+        ball_info = manager.get_info()
+        screenwriter.generate_image(ball_info)
+        progress.update()
+
+        # Iterate through each timestep until the BallManager reports done. Save the images as a video.
+        while not finished:
+            start = time.perf_counter()
+            with profiling.stage('simulate'):
+                ball_info, finished = manager.nextFrame()
+            simulation_time += time.perf_counter() - start
+
+            img = screenwriter.generate_image(ball_info)
+            progress.update()
 
-    # Iterate through each timestep until the BallManager reports done. Save the images as a video.
-    while not finished:
-        frame_num += 1
-        print(frame_num)
+            # cv2.imshow('test', img)
+            # cv2.waitKey(int(1000/args['fps']))
+
+    screenwriter.release()
+    summary = progress.summary({
+        'simulation': simulation_time,
+        'rasterization': screenwriter.raster_time,
+        'encoding': screenwriter.encode_time
+    })
+
+    if args['sprite_cache'] and not args['quiet']:
+        print('Sprite cache: ' + str(screenwriter.sprite_cache_info()))
+    if args['queue_size'] and not args['quiet']:
+        print('Writer stats: ' + str(screenwriter.writer_stats()))
+
+    return summary
+
+
+# Reports progress of the generation loop on a single line, rewritten at most every PROGRESS_INTERVAL seconds, with the
+# frames per second achieved, the frames remaining and an estimated time left. Nothing is printed if quiet except the
+# final summary.
+class Progress:
+    # num_frames is the expected number of frames in the run, or None if it is not known ahead of time, in which case
+    # neither the frames remaining nor the ETA are printed.
+    def __init__(self, num_frames, quiet=False):
+        self.num_frames = num_frames
+        self.quiet = quiet
+        self.frames_done = 0
+
+        self.start = time.perf_counter()
+        self.last_print = self.start
+
+    # Record that frames more frames are done and print the progress line if it is due.
+    def update(self, frames=1):
+        self.frames_done += frames
+        if self.quiet:
+            return
+
+        now = time.perf_counter()
+        done = self.num_frames is not None and self.frames_done >= self.num_frames
+        if now - self.last_print < PROGRESS_INTERVAL and not done:
+            return
+        self.last_print = now
+
+        fps = self.frames_done / max(now - self.start, 1e-9)
+        if self.num_frames is None:
+            sys.stdout.write('\rFrame ' + str(self.frames_done) + ' | ' + format(fps, '.1f') + ' fps ')
+            sys.stdout.flush()
+            return
+
+        remaining = max(self.num_frames - self.frames_done, 0)
+        sys.stdout.write('\rFrame ' + str(self.frames_done) + '/' + str(self.num_frames) +
+                         ' | ' + format(fps, '.1f') + ' fps | ' + str(remaining) + ' frames remaining' +
+                         ' | ETA ' + format(remaining / fps, '.1f') + 's ')
+        sys.stdout.flush()
+
+    # Print the total time and fps of the run, split into the stages in timings, a dictionary of stage names to
+    # seconds. Returns a dictionary with keys ['frames', 'time', 'fps', 'timings'].
+    def summary(self, timings):
+        total = time.perf_counter() - self.start
+        if not self.quiet:
+            sys.stdout.write('\n')
+
+        summary = {
+            'frames': self.frames_done,
+            'time': total,
+            'fps': self.frames_done / max(total, 1e-9),
+            'timings': timings
+        }
+
+        stages = ', '.join([stage + ' ' + format(seconds, '.2f') + 's' for stage, seconds in timings.items()])
+        print('Rendered ' + str(summary['frames']) + ' frames in ' + format(summary['time'], '.2f') + 's (' +
+              format(summary['fps'], '.1f') + ' fps): ' + stages)
+
+        return summary
+
+
+# Render the video with a pool of processes. The timeline is split into one contiguous range of frames per worker. This
+# process steps the balls through the whole run once, without drawing them, and hands every worker a copy of the
+# BallManager as it is at the start of the worker's range as soon as it gets there, so workers start while the rest of
+# the run is still being stepped and no frame is simulated by more than one worker. Every frame is then rendered from
+# exactly the state a single process steps to, so joining the segments gives the same video.
+#
+# Segments are written with the final codec when joining them is lossless and needs no encoding ('rgba' and 'npy').
+# Otherwise they are written as FrameStores and encoded once while joining, so lossy codecs are not applied twice.
+#
+# args: argument dictionary for totality of video, as formatted in parse_args.
+# ball_args: list of arguments dictionaries for each ball, with 'hor_vel' set by get_horizontal_scale.
+#
+# Returns the time the workers spent on each stage, summed over workers, with the time this process spent stepping to
+# the start of every range added to the simulation.
+def render_parallel(args, ball_args, progress):
+    num_frames = progress.num_frames
+    segment_codec = args['codec'] if args['codec'] in ('rgba', 'npy') else 'npy'
+
+    bounds = np.linspace(0, num_frames, min(args['workers'], num_frames) + 1).astype(int)
+    stem = os.path.join(args['output_dir'], args['title'][:-4])
+    paths = [stem + '.part' + str(i) + CODECS[segment_codec][1] for i in range(len(bounds) - 1)]
+
+    manager = BallManager(args['acceleration'], args['duration'], args['count_frames'], args['fps'],
+                          [Ball(ball_arg) for ball_arg in ball_args], engine=args['engine'],
+                          collisions=args['collisions'])
+
+    timings = {'simulation': 0, 'rasterization': 0, 'encoding': 0}
+    with multiprocessing.Pool(len(paths)) as pool:
+        # The manager is copied before it is handed over, since the pool pickles it later, from another thread.
+        results = []
+        frame = 0
+        for i, path in enumerate(paths):
+            start = time.perf_counter()
+            while frame < bounds[i]:
+                manager.nextFrame()
+                frame += 1
+            timings['simulation'] += time.perf_counter() - start
+
+            results.append(pool.apply_async(render_segment, (args, copy.deepcopy(manager), bounds[i], bounds[i + 1],
+                                                             path, segment_codec)))
+
+        for result in results:
+            start, stop, segment_timings = result.get()
+            progress.update(stop - start)
+            for stage in timings:
+                timings[stage] += segment_timings[stage]
+
+    start = time.perf_counter()
+    join_videos(paths, os.path.join(args['output_dir'], args['title']), args['fps'], args['resolution'], args['codec'])
+    timings['joining'] = time.perf_counter() - start
+
+    for path in paths:
+        os.remove(path)
+
+    return timings
+
+
+# Render frames start up to stop of the video to title with the given codec, stepping on from manager, a BallManager
+# at frame start. Runs in a worker process of render_parallel.
+def render_segment(args, manager, start, stop, title, codec):
+    screenwriter = ScreenWriter(args['background_color'], args['resolution'], args['fps'], title,
+                                dirty_rect=args['dirty_rect'],
+                                sprite_cache=args['sprite_cache'], queue_size=args['queue_size'],
+                                codec=codec)
 
-        ball_info, finished = manager.nextFrame()
-        img = screenwriter.generate_image(ball_info)
+    ball_info = manager.get_info()
+    simulation_time = 0
+    for frame in range(start, stop):
+        if frame > start:
+            simulation_start = time.perf_counter()
+            ball_info = manager.nextFrame()[0]
+            simulation_time += time.perf_counter() - simulation_start
 
-        # cv2.imshow('test', img)
-        # cv2.waitKey(int(1000/args['fps']))
+        screenwriter.generate_image(ball_info)
 
     screenwriter.release()
 
+    timings = {
+        'simulation': simulation_time,
+        'rasterization': screenwriter.raster_time,
+        'encoding': screenwriter.encode_time
+    }
+
+    return start, stop, timings
+
+
+# Join the videos at paths, in order, into a single video saved to title with the given codec. Segments are either
+# FrameStores or uncompressed videos, so reading them back is lossless.
+def join_videos(paths, title, fps, resolution, codec='rgba'):
+    writer = open_writer(title, codec, fps, resolution)
+
+    for path in paths:
+        if path[-4:] == '.npy':
+            for frame in np.load(path, mmap_mode='r'):
+                writer.write(np.asarray(frame))
+            continue
+
+        capture = cv2.VideoCapture(path)
+        assert capture.isOpened() and "Error opening video segment."
+
+        while True:
+            ret, frame = capture.read()
+            if not ret:
+                break
+            writer.write(frame)
+
+        capture.release()
+
+    writer.release()
+
 
 def parse_args(args):
     parser = argparse.ArgumentParser()
@@ -315,10 +1586,44 @@ def parse_args(args):
     parser.add_argument('--output_dir', dest='output_dir', type=str, default='sample_videos',
                         help='Output directory.')
     parser.add_argument('--title', dest='title', type=str, default='test.avi',
-                        help='Title of the video. Make ending ".avi".')
+                        help='Title of the video. Make ending ".avi", or ".npy" with --codec npy.')
     parser.add_argument('--background_color', dest='background_color', nargs="+", type=int, default=[50, 50, 50],
                         help='Color of the background. For optimal detection, avoid choosing too similar ball and '
                              'background colors.')
+    parser.add_argument('--engine', dest='engine', type=str, default='object', choices=ENGINES,
+                        help='Simulation engine. "vectorized" steps every ball at once with numpy arrays, which is '
+                             'much faster for scenes with many balls. "event" jumps from impact to impact, and counts '
+                             'every bounce even at very low fps.')
+    parser.add_argument('--collisions', dest='collisions', action='store_true',
+                        help='Make balls bounce off each other elastically instead of passing through each other.')
+    parser.add_argument('--simulation_path', dest='simulation_path', type=str, default=None,
+                        help='Precompute the whole run before rendering and save it to this path. Make ending ".npy". '
+                             'Renders in one process, so --workers must be 1.')
+    parser.add_argument('--workers', dest='workers', type=int, default=1,
+                        help='Number of processes to render the video with. Each renders a contiguous range of frames.')
+    parser.add_argument('--dirty_rect', dest='dirty_rect', action='store_true',
+                        help='Reuse one frame buffer and only restore the background where balls were last drawn.')
+    parser.add_argument('--sprite_cache', dest='sprite_cache', type=int, default=0,
+                        help='Number of pre-rasterized balls to cache, keyed by color and axes. 0 disables the cache.')
+    parser.add_argument('--queue_size', dest='queue_size', type=int, default=0,
+                        help='Number of frames to queue for a background encoder thread. 0 encodes every frame inline.')
+    parser.add_argument('--codec', dest='codec', type=str, default='rgba', choices=list(CODECS),
+                        help='Output format. "rgba" is uncompressed, "ffv1" and "hfyu" are lossless, "mjpg" is lossy '
+                             'and "npy" writes raw frames to a memory-mappable .npy file.')
+    parser.add_argument('--quiet', dest='quiet', action='store_true',
+                        help='Only print warnings and the final timing summary.')
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        help='Time every stage of generation and print the percentiles of each at the end, with the '
+                             'net change in live Python memory blocks, counted for the whole process including other '
+                             'threads. Also turned on by setting the ' + profiling.PROFILE_ENV +
+                             ' environment variable.')
+    parser.add_argument('--profile_report', dest='profile_report', type=str, default=None,
+                        help='Path to save the timings of every stage to as JSON. Turns on --profile.')
+    parser.add_argument('--cprofile', dest='cprofile', type=str, default=None,
+                        help='Path to save cProfile stats of the run to. Turns on --profile.')
+    parser.add_argument('--tracemalloc', dest='tracemalloc', type=str, default=None,
+                        help='Path to save the lines that allocated the most memory to, traced with tracemalloc. '
+                             'Turns on --profile.')
     parser.add_argument('--additional_ball', dest='additional_ball', action='store_true',
                         help='Input values for another ball after this one.')
 
@@ -334,12 +1639,17 @@ def parse_args(args):
     assert args.acceleration > 0
     assert len(args.resolution) == 2
     assert args.resolution[0] > 0 and args.resolution[1] > 0
-    assert args.title[-4:] == '.avi' and "Ending is not '.avi'"
+    assert args.title[-4:] == CODECS[args.codec][1] and "Ending does not match the codec."
     assert len(args.background_color) == 3
     assert 0 <= args.background_color[0] <= 255 and \
            0 <= args.background_color[1] <= 255 and \
            0 <= args.background_color[2] <= 255
     assert args.fps > 0
+    assert args.workers > 0
+    assert args.sprite_cache >= 0
+    assert args.queue_size >= 0
+    assert args.simulation_path is None or args.simulation_path[-4:] == '.npy' and "Ending is not '.npy'"
+    assert args.simulation_path is None or args.workers == 1 and "--simulation_path renders in one process."
 
     acceleration = args.acceleration
     resolution = args.resolution
@@ -385,7 +1695,20 @@ def parse_args(args):
         'fps': fps,
         'title': title,
         'output_dir': output_dir,
-        'background_color': background_color
+        'background_color': background_color,
+        'engine': args.engine,
+        'collisions': args.collisions,
+        'simulation_path': args.simulation_path,
+        'workers': args.workers,
+        'dirty_rect': args.dirty_rect,
+        'sprite_cache': args.sprite_cache,
+        'queue_size': args.queue_size,
+        'codec': args.codec,
+        'quiet': args.quiet,
+        'profile': args.profile,
+        'profile_report': args.profile_report,
+        'cprofile': args.cprofile,
+        'tracemalloc': args.tracemalloc
     }
 
     return output_args
@@ -466,19 +1789,10 @@ def get_horizontal_scale(ball_args, args):
     # Predicting horizontal scale in bounces is much harder. Find the time from starting height to the flattest possible
     # ball. The quickest time will bounce the most, so calculate time assuming that ball.
     else:
-        min_time = np.Inf
+        min_time = np.inf
         for ball in ball_args:
-            fall_time = ((ball['starting_height'] - ball['radius']) * 2 / args['acceleration']) ** (1 / 2)
-
-            if ball['deformation'] == 0:
-                if min_time > fall_time * args['duration'] * 2:
-                    min_time = fall_time * args['duration'] * 2
-                continue
-
-            impact_vel = fall_time * args['acceleration']
-            deformation_acceleration = (impact_vel ** 2) / (2 * (ball['radius'] - 1))
-            deformation_acceleration = deformation_acceleration / ball['deformation']
-            deform_time = impact_vel / deformation_acceleration
+            fall_time, deform_time = get_bounce_times(ball['starting_height'], ball['radius'], ball['deformation'],
+                                                      args['acceleration'])
 
             if min_time > (fall_time + deform_time) * args['duration'] * 2:
                 min_time = (fall_time + deform_time) * args['duration'] * 2
@@ -490,5 +1804,32 @@ def get_horizontal_scale(ball_args, args):
     return ball_args
 
 
+# Load a run saved by BallManager.simulate_all. The array is memory-mapped rather than read, so rendering or analysis
+# jobs can reuse a simulation of any length without running it again.
+def load_simulation(path):
+    simulation = np.load(path, mmap_mode='r')
+    assert simulation.ndim == 3 and simulation.shape[-1] == len(SIMULATION_FIELDS)
+
+    return simulation
+
+
+# Function to determine how long a ball takes to fall from its starting height to the ground, and how long it takes to
+# go from impact to its flattest point. Under the no-energy-loss model a ball repeats the period of falling, deforming,
+# releasing and rising again forever, which takes 2 * (fall_time + deform_time).
+#
+# acceleration should be a positive value. deform_time is 0 for balls with no deformation.
+def get_bounce_times(starting_height, radius, deformation, acceleration):
+    fall_time = ((starting_height - radius) * 2 / acceleration) ** (1 / 2)
+    if deformation == 0:
+        return fall_time, 0
+
+    impact_vel = fall_time * acceleration
+    deformation_acceleration = (impact_vel ** 2) / (2 * (radius - 1))
+    deformation_acceleration = deformation_acceleration / deformation
+    deform_time = impact_vel / deformation_acceleration
+
+    return fall_time, deform_time
+
+
 if __name__ == "__main__":
     main()
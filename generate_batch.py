@@ -0,0 +1,207 @@
+import sys
+
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import time
+import traceback
+
+import argparse
+
+from generate_ball import CODECS, generate_video, parse_args as parse_video_args, parse_ball_args
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+# Render every scene of a manifest across a pool of processes, skipping scenes whose video already exists, and write a
+# report with the timing of every scene.
+def main():
+    args = parse_args(sys.argv[1:])
+
+    os.makedirs(args['output_dir'], exist_ok=True)
+
+    scenes = load_manifest(args['manifest'], args['output_dir'])
+    print('Number of scenes: ' + str(len(scenes)))
+
+    jobs = [(scene, args['overwrite']) for scene in scenes]
+
+    start = time.perf_counter()
+    results = []
+    with multiprocessing.Pool(args['workers']) as pool:
+        for result in pool.imap_unordered(render_scene, jobs):
+            results.append(result)
+            print('[' + str(len(results)) + '/' + str(len(jobs)) + '] ' + result['title'] + ': ' + result['status'])
+
+    report = write_report(results, time.perf_counter() - start, args['report'])
+    summary = report['summary']
+    print('Rendered ' + str(summary['rendered']) + ', skipped ' + str(summary['skipped']) + ', failed ' +
+          str(summary['failed']) + ' scenes in ' + format(summary['time'], '.2f') + 's. Report saved to ' +
+          args['report'])
+
+
+# Load the list of scenes from a JSON or YAML manifest. The manifest is either a list of scenes, or a dictionary with a
+# 'scenes' list and optional 'defaults' that every scene starts from.
+#
+# Each scene is a dictionary of generate_ball arguments without the leading dashes, such as 'resolution', 'fps',
+# 'duration', 'count_frames' and 'title', plus a 'balls' list of dictionaries with the keys ['color', 'starting_height',
+# 'radius', 'deformation']. Missing values take the same defaults as generate_ball, except that scenes without an
+# 'output_dir' are saved to output_dir, and scenes without a 'title' are named after their place in the manifest, as in
+# 'scene0.avi', so they don't overwrite each other. No two scenes may be saved to the same path.
+def load_manifest(path, output_dir='sample_videos'):
+    with open(path) as manifest_file:
+        if path.endswith('.yaml') or path.endswith('.yml'):
+            assert yaml is not None and "Reading YAML manifests requires PyYAML."
+            manifest = yaml.safe_load(manifest_file)
+        else:
+            manifest = json.load(manifest_file)
+
+    if type(manifest) is list:
+        manifest = {'scenes': manifest}
+
+    assert type(manifest) is dict and type(manifest.get('scenes')) is list
+    defaults = manifest.get('defaults', {})
+
+    scenes = []
+    paths = set()
+    for i, scene in enumerate(manifest['scenes']):
+        assert type(scene) is dict
+        scene = dict(defaults, **scene)
+
+        scene.setdefault('output_dir', output_dir)
+        if 'title' not in scene:
+            assert scene.get('codec', 'rgba') in CODECS and "Unknown codec."
+            scene['title'] = 'scene' + str(i) + CODECS[scene.get('codec', 'rgba')][1]
+
+        scene_path = os.path.normpath(os.path.join(scene['output_dir'], scene['title']))
+        assert scene_path not in paths and "Two scenes are saved to the same path. Give them different titles."
+        paths.add(scene_path)
+
+        scenes.append(scene)
+
+    return scenes
+
+
+# Turn a scene from a manifest into an argument dictionary formatted as per generate_ball.parse_args. The scene is
+# passed through the generate_ball parsers, so it is validated the same way as on the command line.
+def scene_args(scene):
+    balls = scene.get('balls', [{}])
+    assert type(balls) is list and len(balls) > 0
+
+    video_args = {key: value for key, value in scene.items() if key != 'balls'}
+    args = parse_video_args(to_argv(video_args) + to_argv(balls[0]))
+    args['balls'] = [parse_ball_args(to_argv(ball), args['resolution'])[0] for ball in balls]
+
+    # Scenes already run in a pool, so each is rendered by a single process.
+    args['workers'] = 1
+    args['quiet'] = True
+
+    return args
+
+
+# Turn a dictionary of arguments into command line arguments. True adds a flag, and False or None leave it out.
+def to_argv(arguments):
+    argv = []
+    for key, value in arguments.items():
+        if value is True:
+            argv.append('--' + key)
+        elif value is False or value is None:
+            continue
+        elif type(value) is list or type(value) is tuple:
+            argv += ['--' + key] + [str(item) for item in value]
+        else:
+            argv += ['--' + key, str(value)]
+
+    return argv
+
+
+# Render one scene in a worker process. Returns a dictionary with the scene title, its status ('rendered', 'skipped'
+# or 'failed'), anything the scene printed, and the timing summary or error. Errors are reported instead of raised so
+# one bad scene doesn't stop the batch.
+def render_scene(job):
+    scene, overwrite = job
+    result = {
+        'title': scene['title'],
+        'output_dir': scene['output_dir']
+    }
+
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log):
+            args = scene_args(scene)
+            path = os.path.join(args['output_dir'], args['title'])
+            if os.path.exists(path) and not overwrite:
+                result['status'] = 'skipped'
+            else:
+                result['summary'] = generate_video(args)
+                result['status'] = 'rendered'
+    except (Exception, SystemExit):
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+
+    result['log'] = log.getvalue()
+    return result
+
+
+# Write the results of every scene and a summary of the batch to path as JSON, and return the report.
+def write_report(results, total_time, path):
+    rendered = [result for result in results if result['status'] == 'rendered']
+
+    report = {
+        'scenes': results,
+        'summary': {
+            'rendered': len(rendered),
+            'skipped': len([result for result in results if result['status'] == 'skipped']),
+            'failed': len([result for result in results if result['status'] == 'failed']),
+            'frames': sum([result['summary']['frames'] for result in rendered]),
+            'render_time': sum([result['summary']['time'] for result in rendered]),
+            'time': total_time
+        }
+    }
+
+    with open(path, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+
+    return report
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--manifest', dest='manifest', type=str, required=True,
+                        help='Path to a JSON or YAML manifest of scenes to render.')
+    parser.add_argument('--workers', dest='workers', type=int, default=os.cpu_count(),
+                        help='Number of scenes to render at once.')
+    parser.add_argument('--output_dir', dest='output_dir', type=str, default='sample_videos',
+                        help='Output directory for scenes that do not set their own.')
+    parser.add_argument('--report', dest='report', type=str, default=None,
+                        help='Path to save the JSON report under. Defaults to report.json in the output directory.')
+    parser.add_argument('--overwrite', dest='overwrite', action='store_true',
+                        help='Render scenes even if their video already exists.')
+
+    args = parser.parse_args(args)
+
+    assert os.path.exists(args.manifest)
+    assert args.workers > 0
+
+    report = args.report
+    if report is None:
+        report = os.path.join(args.output_dir, 'report.json')
+
+    args = {
+        'manifest': args.manifest,
+        'workers': args.workers,
+        'output_dir': args.output_dir,
+        'report': report,
+        'overwrite': args.overwrite
+    }
+
+    return args
+
+
+if __name__ == "__main__":
+    main()
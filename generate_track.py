@@ -0,0 +1,198 @@
+import sys
+
+import copy
+import json
+import math
+import time
+
+import argparse
+
+from generate_ball import Ball, BallManager, ScreenWriter, get_horizontal_scale, parse_args as parse_video_args
+from track_ball import FULL_SCAN_INTERVAL, ROI_PADDING, SEGMENTATIONS, THUMBNAIL_FACTOR, TRACKING_MODES, \
+    compare_blobs, contour_blobs, find_contours, make_tracker
+
+
+# Generate a video and track it in the same process, comparing what is found in every frame to where the balls were
+# drawn, and print the accuracy and throughput of the run.
+def main():
+    args = parse_args(sys.argv[1:])
+    summary = track_generated(args)
+
+    if args['report'] is not None:
+        with open(args['report'], 'w') as report_file:
+            json.dump(summary, report_file, indent=2)
+
+
+# Track every frame of the video described by args, formatted as per parse_args, as it is generated. Frames are handed
+# from the ScreenWriter to the tracker without being encoded, written or copied, and the state of the balls they were
+# drawn from comes with them, so accuracy and throughput are measured in one pass with no disk I/O.
+#
+# Returns a dictionary with the number of 'frames', the total 'time' and 'fps', the time spent generating and tracking
+# frames and the 'tracking_fps' alone, and the accuracy of the blobs found over all frames as per compare_blobs, along
+# with their 'recall' and 'precision'.
+def track_generated(args):
+    tracker = make_tracker(args)
+
+    totals = {'matched': 0, 'missed': 0, 'extra': 0}
+    centroid_error = 0
+    max_centroid_error = 0
+    area_error = 0
+    max_area_error = 0
+
+    generate_time = 0
+    track_time = 0
+    count = 0
+
+    run_start = time.perf_counter()
+    frames = generate_frames(args)
+    while True:
+        start = time.perf_counter()
+        frame = next(frames, None)
+        generate_time += time.perf_counter() - start
+        if frame is None:
+            break
+
+        frame, balls_info = frame
+        count += 1
+
+        start = time.perf_counter()
+        contours, blobs, tracks = find_contours(frame, args, tracker)
+        if args['segmentation'] == 'color' and tracker is None:
+            blobs = contour_blobs(frame, contours)
+        track_time += time.perf_counter() - start
+
+        accuracy = compare_blobs(blobs, ground_truth_blobs(balls_info, args['resolution']))
+        for key in totals:
+            totals[key] += accuracy[key]
+        centroid_error += accuracy['centroid_error'] * accuracy['matched']
+        max_centroid_error = max(max_centroid_error, accuracy['max_centroid_error'])
+        area_error += accuracy['area_error'] * accuracy['matched']
+        max_area_error = max(max_area_error, accuracy['max_area_error'])
+
+    run_time = time.perf_counter() - run_start
+    matched = max(totals['matched'], 1)
+
+    summary = {
+        'frames': count,
+        'time': run_time,
+        'fps': count / run_time if run_time > 0 else 0.,
+        'generate_time': generate_time,
+        'track_time': track_time,
+        'tracking_fps': count / track_time if track_time > 0 else 0.,
+        'matched': totals['matched'],
+        'missed': totals['missed'],
+        'extra': totals['extra'],
+        'recall': totals['matched'] / max(totals['matched'] + totals['missed'], 1),
+        'precision': totals['matched'] / max(totals['matched'] + totals['extra'], 1),
+        'centroid_error': centroid_error / matched,
+        'max_centroid_error': max_centroid_error,
+        'area_error': area_error / matched,
+        'max_area_error': max_area_error
+    }
+
+    print('Tracked ' + str(count) + ' generated frames in ' + format(run_time, '.2f') + 's (' +
+          format(summary['fps'], '.1f') + ' fps, ' + format(summary['tracking_fps'], '.1f') + ' fps tracking alone).')
+    print('Matched ' + str(summary['matched']) + ' balls, missed ' + str(summary['missed']) + ', ' +
+          str(summary['extra']) + ' extra blobs. Recall ' + format(summary['recall'], '.3f') + ', precision ' +
+          format(summary['precision'], '.3f') + ', mean centroid error ' + format(summary['centroid_error'], '.2f') +
+          'px, max ' + format(summary['max_centroid_error'], '.2f') + 'px.')
+
+    return summary
+
+
+# Generate the frames of the video described by args the same way generate_ball.generate_video does, but yield each
+# frame instead of writing it, along with the info of the balls drawn in it as per Ball.get_info. With
+# args['dirty_rect'] every frame is the same buffer, so it is only valid until the next one is generated.
+def generate_frames(args):
+    ball_args = get_horizontal_scale(copy.deepcopy(args['balls']), args)
+    balls = [Ball(ball_arg) for ball_arg in ball_args]
+
+    manager = BallManager(args['acceleration'], args['duration'], args['count_frames'], args['fps'], balls,
+                          engine=args['engine'], collisions=args['collisions'])
+    screenwriter = ScreenWriter(args['background_color'], args['resolution'], args['fps'], None,
+                                dirty_rect=args['dirty_rect'], sprite_cache=args['sprite_cache'])
+
+    balls_info = manager.get_info()
+    yield screenwriter.generate_image(balls_info), balls_info
+
+    finished = False
+    while not finished:
+        balls_info, finished = manager.nextFrame()
+        yield screenwriter.generate_image(balls_info), balls_info
+
+    screenwriter.release()
+
+
+# Turn ball info as per Ball.get_info into blobs as per track_ball.label_contours, in image coordinates, to compare
+# what is found against. The area is that of the ellipse, and balls entirely outside of the frame are left out.
+def ground_truth_blobs(balls_info, resolution):
+    width, height = resolution
+    blobs = []
+    for ball in balls_info:
+        x, y = ball['x'], height - ball['y']
+        major, minor = round(ball['major']), round(ball['minor'])
+        if y + minor < 0 or y - minor >= height or x + major < 0 or x - major >= width:
+            continue
+
+        blobs.append({
+            'color': [int(channel) for channel in ball['color']],
+            'area': math.pi * ball['major'] * ball['minor'],
+            'centroid': (x, y),
+            'bbox': (round(x) - major, round(y) - minor, 2 * major + 1, 2 * minor + 1)
+        })
+
+    return blobs
+
+
+# Parse the tracking arguments, and pass everything else on to generate_ball.parse_args to describe the video. Video
+# options that only affect how the video is written, such as --title, --codec and --queue_size, have no effect.
+def parse_args(args):
+    # Abbreviations are off, or --color would be taken for --color_table.
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+
+    parser.add_argument('--tolerance', dest='tolerance', type=int, default=0,
+                        help='Tolerance for colors, as per track_ball.')
+    parser.add_argument('--segmentation', dest='segmentation', type=str, default='color', choices=SEGMENTATIONS,
+                        help='How to find blobs, as per track_ball.')
+    parser.add_argument('--pyramid_factor', dest='pyramid_factor', type=int, default=THUMBNAIL_FACTOR,
+                        help='How much the frame is downsampled by with pyramid segmentation.')
+    parser.add_argument('--color_table', dest='color_table', action='store_true',
+                        help='Remember which cluster every color belongs to from frame to frame.')
+    parser.add_argument('--tracking', dest='tracking', type=str, default='full', choices=TRACKING_MODES,
+                        help='How to follow blobs from frame to frame, as per track_ball.')
+    parser.add_argument('--roi_padding', dest='roi_padding', type=int, default=ROI_PADDING,
+                        help='Pixels to search around each blob when tracking with roi or physics.')
+    parser.add_argument('--full_scan_interval', dest='full_scan_interval', type=int, default=FULL_SCAN_INTERVAL,
+                        help='Number of frames between full frame scans when tracking with roi or physics.')
+    parser.add_argument('--report', dest='report', type=str, default=None,
+                        help='Path to save the accuracy and throughput of the run to as JSON.')
+
+    tracking_args, video_args = parser.parse_known_args(args)
+    args = parse_video_args(video_args)
+
+    assert tracking_args.tolerance >= 0
+    assert tracking_args.pyramid_factor >= 1
+    assert tracking_args.roi_padding >= 0
+    assert tracking_args.full_scan_interval >= 1
+    assert args['workers'] == 1 and "Generated frames are tracked by a single process."
+    assert (not tracking_args.color_table or tracking_args.segmentation != 'color' or
+            tracking_args.tracking != 'full') and \
+        "Color tables require label or pyramid segmentation, or roi or physics tracking."
+
+    args.update({
+        'tolerance': tracking_args.tolerance,
+        'segmentation': tracking_args.segmentation,
+        'pyramid_factor': tracking_args.pyramid_factor,
+        'color_table': tracking_args.color_table,
+        'tracking': tracking_args.tracking,
+        'roi_padding': tracking_args.roi_padding,
+        'full_scan_interval': tracking_args.full_scan_interval,
+        'detections': None,
+        'report': tracking_args.report
+    })
+
+    return args
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import sys
+
+import contextlib
+import cProfile
+import json
+import os
+import time
+import tracemalloc
+
+import numpy as np
+
+# Setting this environment variable to anything but '' or '0' turns profiling on for every run, without a flag.
+PROFILE_ENV = 'BALL_PROFILE'
+PERCENTILES = (50, 95, 99)
+
+# Number of lines that allocate the most memory to save from tracemalloc.
+TRACEMALLOC_TOP = 25
+
+
+# Records how long every run of a named stage takes, and the net change in memory blocks the Python allocator holds
+# over it, as per sys.getallocatedblocks. That is not a count of allocations: blocks allocated and freed within the
+# stage cancel out. It is also counted for the whole process, so blocks allocated or freed by other threads meanwhile,
+# such as the stages of a pipeline running at the same time, are included. Memory held by numpy arrays and OpenCV is
+# not counted, only Python objects.
+#
+# When disabled, stage returns the same do-nothing context manager every time, so instrumented code costs a function
+# call and an attribute check per stage.
+class Profiler:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.times = {}
+        self.blocks = {}
+
+    # Context manager timing one run of the stage called name.
+    def stage(self, name):
+        if not self.enabled:
+            return NO_STAGE
+
+        return Stage(self, name)
+
+    def record(self, name, seconds, blocks):
+        self.times.setdefault(name, []).append(seconds)
+        self.blocks.setdefault(name, []).append(blocks)
+
+    def reset(self):
+        self.times = {}
+        self.blocks = {}
+
+    # Return a dictionary of every stage recorded to its number of runs 'count', 'total' time in s, 'mean' and
+    # percentiles of PERCENTILES as 'p50' etc. in ms, and the mean net change in allocated blocks per run and its
+    # total, 'net_blocks' and 'total_net_blocks'.
+    def report(self):
+        report = {}
+        for name, times in self.times.items():
+            times = np.array(times)
+            blocks = np.array(self.blocks[name])
+
+            report[name] = {
+                'count': len(times),
+                'total': float(times.sum()),
+                'mean': float(times.mean()) * 1000
+            }
+            for percentile, value in zip(PERCENTILES, np.percentile(times, PERCENTILES)):
+                report[name]['p' + str(percentile)] = float(value) * 1000
+            report[name]['net_blocks'] = float(blocks.mean())
+            report[name]['total_net_blocks'] = int(blocks.sum())
+
+        return report
+
+    # Print the report, one line per stage, the stage that took longest in total first.
+    def print_report(self):
+        report = self.report()
+        print('Profile (ms per run, net change in allocated blocks per run):')
+        for name in sorted(report, key=lambda name: -report[name]['total']):
+            stats = report[name]
+            print('    ' + name + ': ' + str(stats['count']) + ' runs, ' + format(stats['total'], '.3f') + 's total, ' +
+                  'mean ' + format(stats['mean'], '.3f') + ', ' +
+                  ', '.join(['p' + str(percentile) + ' ' + format(stats['p' + str(percentile)], '.3f')
+                             for percentile in PERCENTILES]) + ', ' + format(stats['net_blocks'], '+.1f') +
+                  ' net blocks')
+
+
+# One run of a stage, recorded to its profiler when it ends.
+class Stage:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+        self.start_blocks = None
+
+    def __enter__(self):
+        self.start_blocks = sys.getallocatedblocks()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        self.profiler.record(self.name, seconds, sys.getallocatedblocks() - self.start_blocks)
+        return False
+
+
+NO_STAGE = contextlib.nullcontext()
+
+# The profiler every instrumented module records to.
+profiler = Profiler(os.environ.get(PROFILE_ENV, '') not in ('', '0'))
+
+
+# Time one run of the stage called name with the shared profiler, as per Profiler.stage.
+def stage(name):
+    return profiler.stage(name)
+
+
+# Profile everything run inside the block with the shared profiler, if enabled is True or PROFILE_ENV is set, and print
+# its report at the end. If cprofile_path is given, the block is also run under cProfile and its stats are dumped to
+# that path, for pstats or snakeviz. If tracemalloc_path is given, every allocation is traced, and the lines that
+# allocated the most memory that is still held at the end are written to that path. Both slow the run down, so the
+# stage timings are only comparable between runs with the same options. report_path saves the report as JSON. The
+# profiler is left enabled or not as it was before the block.
+@contextlib.contextmanager
+def session(enabled=False, cprofile_path=None, tracemalloc_path=None, report_path=None):
+    previous = profiler.enabled
+    profiler.enabled = profiler.enabled or enabled or cprofile_path is not None or tracemalloc_path is not None or \
+        report_path is not None
+
+    profile = None
+    if cprofile_path is not None:
+        profile = cProfile.Profile()
+        profile.enable()
+    if tracemalloc_path is not None:
+        tracemalloc.start()
+
+    try:
+        yield profiler
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(cprofile_path)
+
+        if tracemalloc_path is not None:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            with open(tracemalloc_path, 'w') as tracemalloc_file:
+                for statistic in snapshot.statistics('lineno')[:TRACEMALLOC_TOP]:
+                    tracemalloc_file.write(str(statistic) + '\n')
+
+        if report_path is not None:
+            with open(report_path, 'w') as report_file:
+                json.dump(profiler.report(), report_file, indent=2)
+
+        if profiler.enabled:
+            profiler.print_report()
+
+        profiler.enabled = previous
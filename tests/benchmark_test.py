@@ -0,0 +1,52 @@
+from benchmark import *
+
+import unittest
+
+
+class TestHelperMethods(unittest.TestCase):
+    def test_parse_args(self):
+        args = parse_args(['--balls', '1', '5', '--resolution', '64x48', '--tolerance', '0', '4', '--frames', '10'])
+
+        self.assertTrue(args['grid']['balls'] == [1, 5] and args['grid']['resolution'] == ['64x48'])
+        self.assertTrue(args['grid']['tolerance'] == [0, 4] and args['grid']['fps'] == DEFAULT_GRID['fps'])
+        self.assertTrue(args['frames'] == 10 and args['baseline'] is None)
+
+        with self.assertRaises(AssertionError):
+            parse_args(['--resolution', '64'])
+
+    def test_make_scene(self):
+        case = {'balls': 3, 'resolution': '64x48', 'fps': 30., 'deformation': 0.2, 'tolerance': 0}
+        with tempfile.TemporaryDirectory() as output_dir:
+            args = make_scene(case, 10, output_dir)
+            self.assertTrue(make_scene(case, 10, output_dir) == args)
+
+        self.assertTrue(len(args['balls']) == 3 and len(set([tuple(ball['color']) for ball in args['balls']])) == 3)
+        self.assertTrue(all([ball['deformation'] == 0.2 for ball in args['balls']]))
+        self.assertTrue(args['resolution'] == [64, 48] and args['duration'] == 10 and args['codec'] == 'npy')
+
+    def test_run_benchmarks(self):
+        grid = {'balls': [2], 'resolution': ['64x48', '80x60'], 'fps': [30.], 'deformation': [0.5], 'tolerance': [0]}
+        results = run_benchmarks(grid, 5, 1)
+
+        self.assertTrue(len(results['cases']) == 2)
+        self.assertTrue(results['cases'][1]['name'] == 'balls=2,resolution=80x60,fps=30.0,deformation=0.5,tolerance=0')
+        self.assertTrue(all([sorted(case['timings']) == sorted(BENCHMARK_STAGES) for case in results['cases']]))
+        self.assertTrue(all([value > 0 for case in results['cases'] for value in case['timings'].values()]))
+        json.dumps(results)
+
+    def test_compare_results(self):
+        baseline = {'cases': [{'name': 'a', 'timings': {'next_frame': 1., 'track_cli': 2.}},
+                              {'name': 'b', 'timings': {'next_frame': 1.}}]}
+        results = {'cases': [{'name': 'a', 'timings': {'next_frame': 1.1, 'track_cli': 3.}},
+                             {'name': 'c', 'timings': {'next_frame': 10.}}]}
+
+        regressions = compare_results(results, baseline, 0.2)
+        self.assertTrue(len(regressions) == 1)
+        self.assertTrue(regressions[0]['case'] == 'a' and regressions[0]['stage'] == 'track_cli')
+        self.assertTrue(regressions[0]['ratio'] == 1.5)
+
+        self.assertTrue(compare_results(results, baseline, 0.6) == [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,7 @@
 from generate_ball import *
 
+import io
+import tempfile
 import unittest
 from unittest.mock import patch
 
@@ -46,6 +48,231 @@ class TestBallMethods(unittest.TestCase):
         self.assertTrue(info['color'][0] == 127 and info['color'][1] == 100 and info['color'][2] == 156)
 
 
+class TestBallArraysMethods(unittest.TestCase):
+    def setUp(self):
+        self.ball_attrs = [
+            {
+                'color': [127, 100, 156],
+                'radius': 10,
+                'starting_height': 300,
+                'deformation': 0,
+                'hor_vel': 20
+            }, {
+                'color': [1, 2, 3],
+                'radius': 5,
+                'starting_height': 100,
+                'deformation': 0.4,
+                'hor_vel': 20
+            }, {
+                'color': [4, 5, 6],
+                'radius': 40,
+                'starting_height': 700,
+                'deformation': 1,
+                'hor_vel': 20
+            }
+        ]
+
+    def test_init(self):
+        ball_arrays = BallArrays([Ball(ball_attr) for ball_attr in self.ball_attrs])
+
+        self.assertTrue(np.all(ball_arrays.x == [10, 5, 40]))
+        self.assertTrue(np.all(ball_arrays.y == [300, 100, 700]))
+        self.assertTrue(np.all(ball_arrays.ver_vel == 0))
+        self.assertTrue(np.all(ball_arrays.deformation_acceleration == -1))
+        self.assertTrue(ball_arrays.colors[1] == [1, 2, 3])
+
+    def test_next_frame(self):
+        balls = [Ball(ball_attr) for ball_attr in self.ball_attrs]
+        ball_arrays = BallArrays([Ball(ball_attr) for ball_attr in self.ball_attrs])
+
+        for _ in range(300):
+            bounced = ball_arrays.nextFrame(-500, 1 / 30)
+            info = ball_arrays.get_info()
+
+            for i, ball in enumerate(balls):
+                ball_info, ball_bounced = ball.nextFrame(-500, 1 / 30)
+                self.assertTrue(bounced[i] == ball_bounced)
+                for key in ['x', 'y', 'major', 'minor']:
+                    self.assertAlmostEqual(info[i][key], ball_info[key])
+
+    def test_get_info(self):
+        ball_arrays = BallArrays([Ball(ball_attr) for ball_attr in self.ball_attrs])
+        for _ in range(40):
+            ball_arrays.nextFrame(-500, 1 / 30)
+
+        # Info reads like the list of dictionaries Ball.get_info makes, and draws the same image.
+        info = ball_arrays.get_info()
+        info_list = [dict(ball_info) for ball_info in info]
+        self.assertTrue(len(info) == 3 and info[1]['color'] == [1, 2, 3] and info[-1]['y'] == ball_arrays.y[2])
+        self.assertTrue(info[1:] == info_list[1:])
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            screenwriter = ScreenWriter((100, 100, 100), (320, 240), 60., os.path.join(output_dir, 'info.avi'))
+            image = screenwriter.generate_image(info).copy()
+            self.assertTrue(np.all(image == screenwriter.generate_image(info_list)))
+            screenwriter.release()
+
+    def test_rise_and_land(self):
+        ball_arrays = BallArrays([Ball(self.ball_attrs[0])])
+        ball_arrays.y[0] = 20
+        ball_arrays.ver_vel[0] = 50
+
+        # A ball going up at the start of a step that lands within it hits the ground falling, as fast as energy says.
+        bounced = ball_arrays.advance(-500, 0.35)
+        self.assertTrue(bounced[0])
+        self.assertTrue(ball_arrays.ver_vel[0] > 0)
+        self.assertAlmostEqual(ball_arrays.ver_vel[0] ** 2 + 2 * 500 * (ball_arrays.y[0] - 10), 50 ** 2 + 2 * 500 * 10)
+
+        # A ball leaving the ground with a step too short to move it doesn't land again.
+        ball_arrays.y[0] = 10
+        self.assertFalse(ball_arrays.advance(-500, 1e-19)[0])
+        self.assertTrue(ball_arrays.ver_vel[0] > 0)
+
+    def test_manager(self):
+        manager = BallManager(500, 4, False, 30, [Ball(ball_attr) for ball_attr in self.ball_attrs])
+        vectorized = BallManager(500, 4, False, 30, [Ball(ball_attr) for ball_attr in self.ball_attrs],
+                                 engine='vectorized')
+
+        finished = False
+        while not finished:
+            info, finished = manager.nextFrame()
+            vectorized_info, vectorized_finished = vectorized.nextFrame()
+
+            self.assertTrue(finished == vectorized_finished)
+            self.assertTrue(manager.curr_bounces == vectorized.curr_bounces)
+            for ball_info, vectorized_ball_info in zip(info, vectorized_info):
+                self.assertAlmostEqual(ball_info['x'], vectorized_ball_info['x'])
+                self.assertAlmostEqual(ball_info['y'], vectorized_ball_info['y'])
+
+    def test_collisions(self):
+        balls = [Ball(dict(ball_attr, deformation=0)) for ball_attr in self.ball_attrs]
+        balls[1].x = 30
+        ball_arrays = BallArrays(balls, collisions=True)
+
+        # Rigid balls lose no energy, and bounces off each other keep the horizontal momentum.
+        energy = np.sum(ball_arrays.mass * ((ball_arrays.hor_vel ** 2 + ball_arrays.ver_vel ** 2) / 2 +
+                                            500 * ball_arrays.y))
+        momentum = np.sum(ball_arrays.mass * ball_arrays.hor_vel)
+        collided = False
+        for _ in range(300):
+            ball_arrays.nextFrame(-500, 1 / 30)
+            collided = collided or not np.all(ball_arrays.hor_vel == 20)
+            self.assertTrue(np.all(ball_arrays.y >= ball_arrays.radius))
+
+        self.assertTrue(collided)
+        self.assertAlmostEqual(np.sum(ball_arrays.mass * ((ball_arrays.hor_vel ** 2 + ball_arrays.ver_vel ** 2) / 2 +
+                                                          500 * ball_arrays.y)) / energy, 1)
+        self.assertAlmostEqual(np.sum(ball_arrays.mass * ball_arrays.hor_vel) / momentum, 1)
+
+    def test_head_on(self):
+        balls = [Ball(dict(self.ball_attrs[0], hor_vel=350)), Ball(dict(self.ball_attrs[0], hor_vel=-350))]
+        balls[1].x = 100
+        ball_arrays = BallArrays(balls, collisions=True)
+
+        # Balls of the same size swap velocities, here after touching halfway through the second frame, and are back
+        # where they started by the end of the third.
+        for _ in range(3):
+            ball_arrays.nextFrame(-500, 1 / 15)
+
+        self.assertTrue(np.allclose(ball_arrays.hor_vel, [-350, 350]))
+        self.assertTrue(np.allclose(ball_arrays.x, [10, 100]))
+        self.assertTrue(np.allclose(ball_arrays.y[0], ball_arrays.y[1]))
+
+    def test_candidate_pairs(self):
+        balls = [Ball(dict(self.ball_attrs[0], radius=5, hor_vel=0)) for _ in range(50)]
+        for i, ball in enumerate(balls):
+            ball.x = 20 * i
+        balls[1].x = 8
+        balls[30].x = balls[31].x - 9
+        ball_arrays = BallArrays(balls, collisions=True)
+
+        pairs = ball_arrays.candidate_pairs(-500, 1 / 30)
+        self.assertTrue(pairs.tolist() == [[0, 1], [30, 31]])
+
+
+class TestBallEventsMethods(unittest.TestCase):
+    def setUp(self):
+        self.ball_attrs = [
+            {
+                'color': [127, 100, 156],
+                'radius': 10,
+                'starting_height': 300,
+                'deformation': 0,
+                'hor_vel': 20
+            }, {
+                'color': [1, 2, 3],
+                'radius': 5,
+                'starting_height': 100,
+                'deformation': 0.4,
+                'hor_vel': 20
+            }, {
+                'color': [4, 5, 6],
+                'radius': 40,
+                'starting_height': 700,
+                'deformation': 1,
+                'hor_vel': 20
+            }
+        ]
+
+    def test_next_frame(self):
+        balls = [Ball(ball_attr) for ball_attr in self.ball_attrs]
+        ball_events = BallEvents([Ball(ball_attr) for ball_attr in self.ball_attrs])
+
+        for _ in range(300):
+            bounces = ball_events.nextFrame(-500, 1 / 30)
+            info = ball_events.get_info()
+
+            for i, ball in enumerate(balls):
+                ball_info, ball_bounced = ball.nextFrame(-500, 1 / 30)
+                self.assertTrue(bounces[i] == ball_bounced)
+                for key in ['x', 'y', 'major', 'minor']:
+                    self.assertAlmostEqual(info[i][key], ball_info[key])
+
+    def test_low_fps(self):
+        manager = BallManager(500, 10, True, 0.5, [Ball(ball_attr) for ball_attr in self.ball_attrs], engine='event')
+        state = manager.state_at(np.arange(1, 11))
+
+        # Balls bounce many times a frame, and land exactly where they would analytically.
+        for frame in range(10):
+            info, finished = manager.nextFrame()
+            self.assertTrue(np.allclose([ball_info['y'] for ball_info in info], state['y'][frame]))
+        self.assertTrue(np.allclose(manager.ball_arrays.ver_vel, state['ver_vel'][-1]))
+        self.assertTrue(state['bounces'][-1][1] == 16)
+
+        # Every bounce is counted, so runs counted in bounces end on the frame get_num_frames works out.
+        manager = BallManager(500, 12, False, 2, [Ball(ball_attr) for ball_attr in self.ball_attrs], engine='event')
+        frames = 1
+        finished = False
+        while not finished:
+            info, finished = manager.nextFrame()
+            frames += 1
+
+        self.assertTrue(frames == manager.get_num_frames())
+        self.assertTrue(manager.curr_bounces == manager.state_at(frames - 1)['bounces'][0].tolist())
+
+    def test_many_bounces(self):
+        # Tiny balls dropped from just above the ground bounce hundreds of times a frame.
+        ball_attrs = [dict(self.ball_attrs[0], radius=2, starting_height=2.01),
+                      dict(self.ball_attrs[1], radius=3, starting_height=3.05)]
+        manager = BallManager(500, 10, True, 0.5, [Ball(ball_attr) for ball_attr in ball_attrs])
+        state = manager.state_at(np.arange(1, 11))
+        ball_events = BallEvents([Ball(ball_attr) for ball_attr in ball_attrs])
+
+        # Whole periods are skipped, so every ball only has a few events a frame, and still bounces as often and lands
+        # where it would analytically.
+        bounces = np.zeros(len(ball_attrs), dtype=int)
+        with patch.object(BallEvents, 'next_phase', autospec=True, side_effect=BallEvents.next_phase) as next_phase:
+            for frame in range(10):
+                next_phase.reset_mock()
+                bounces += ball_events.nextFrame(-500, 2)
+                self.assertTrue(next_phase.call_count <= 3 * len(ball_attrs))
+                self.assertTrue(np.allclose(ball_events.y, state['y'][frame]))
+                self.assertTrue(np.all(bounces == state['bounces'][frame]))
+
+        self.assertTrue(bounces.tolist() == [1581, 41])
+        self.assertTrue(np.allclose(ball_events.ver_vel, state['ver_vel'][-1]))
+
+
 class TestBallManagerMethods(unittest.TestCase):
     def test_init1(self):
         manager = BallManager(9.81, 5, False, fps=60)
@@ -130,10 +357,128 @@ class TestBallManagerMethods(unittest.TestCase):
         self.assertTrue(info[1]['major'] == 5 and info[1]['minor'] == 5)
         self.assertTrue(info[1]['color'][0] == 1 and info[1]['color'][1] == 2 and info[1]['color'][2] == 3)
 
+    def test_state_at(self):
+        ball_attrs = [
+            {
+                'color': [127, 100, 156],
+                'radius': 10,
+                'starting_height': 300,
+                'deformation': 0,
+                'hor_vel': 20
+            }, {
+                'color': [1, 2, 3],
+                'radius': 5,
+                'starting_height': 100,
+                'deformation': 0.4,
+                'hor_vel': 20
+            }
+        ]
+
+        manager = BallManager(500, 4, False, 30, [Ball(ball_attr) for ball_attr in ball_attrs])
+        state = manager.state_at(np.arange(400))
+
+        self.assertTrue(state['x'].shape == (400, 2))
+        self.assertTrue(np.all(state['y'][0] == [300, 100]))
+        self.assertTrue(np.all(state['bounces'][0] == 0))
+
+        for frame in range(1, 400):
+            info, finished = manager.nextFrame()
+            self.assertTrue(list(state['bounces'][frame]) == manager.curr_bounces)
+            for i, ball_info in enumerate(info):
+                for key in ['x', 'y', 'major', 'minor']:
+                    self.assertAlmostEqual(state[key][frame, i], ball_info[key], places=6)
+
+        late_state = manager.state_at([399, 0])
+        self.assertTrue(np.allclose(late_state['y'][0], state['y'][399]))
+        self.assertTrue(np.allclose(late_state['y'][1], state['y'][0]))
+
+    def test_get_num_frames(self):
+        ball_attr = {
+            'color': [1, 2, 3],
+            'radius': 5,
+            'starting_height': 100,
+            'deformation': 0.4,
+            'hor_vel': 20
+        }
+
+        manager = BallManager(500, 3, False, 30, [Ball(ball_attr)])
+        num_frames = manager.get_num_frames()
+
+        frames = 1
+        finished = False
+        while not finished:
+            info, finished = manager.nextFrame()
+            frames += 1
+
+        self.assertTrue(num_frames == frames)
+        self.assertTrue(BallManager(500, 50, True, 30, [Ball(ball_attr)]).get_num_frames() == 51)
+
+    def test_simulate_all(self):
+        ball_attr = {
+            'color': [1, 2, 3],
+            'radius': 5,
+            'starting_height': 100,
+            'deformation': 0.4,
+            'hor_vel': 20
+        }
+
+        manager = BallManager(500, 50, True, 30, [Ball(ball_attr), Ball(ball_attr)])
+        simulation = manager.simulate_all()
+
+        self.assertTrue(simulation.shape == (51, 2, len(SIMULATION_FIELDS)))
+        self.assertTrue(simulation.dtype == np.float32)
+        self.assertTrue(np.all(simulation[0, 0] == [5, 100, 5, 5]))
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            path = os.path.join(output_dir, 'simulation.npy')
+            manager.simulate_all(path)
+            loaded = load_simulation(path)
+
+            self.assertTrue(type(loaded) is np.memmap)
+            self.assertTrue(np.all(loaded == simulation))
+            del loaded
+
+    def test_collisions(self):
+        ball_attr = {
+            'color': [1, 2, 3],
+            'radius': 5,
+            'starting_height': 100,
+            'deformation': 0.4,
+            'hor_vel': 20
+        }
+
+        balls = [Ball(ball_attr), Ball(dict(ball_attr, starting_height=80, hor_vel=-20))]
+        balls[1].x = 60
+        manager = BallManager(500, 2, False, 30, balls, collisions=True)
+        self.assertRaises(AssertionError, manager.state_at, 0)
+
+        # Runs are stepped through, and precomputing them gives the same frames as nextFrame. How many frames a run
+        # counted in bounces has is only known once it is stepped through.
+        self.assertTrue(manager.get_num_frames() is None)
+        simulation = manager.simulate_all()
+
+        frames = [[[ball_info[field] for field in SIMULATION_FIELDS] for ball_info in manager.get_info()]]
+        finished = False
+        while not finished:
+            info, finished = manager.nextFrame()
+            frames.append([[ball_info[field] for field in SIMULATION_FIELDS] for ball_info in info])
+
+        self.assertTrue(np.allclose(simulation, np.array(frames, dtype='float32')))
+        self.assertTrue(simulation.shape == (len(frames), 2, len(SIMULATION_FIELDS)))
+        self.assertTrue(np.allclose(manager.simulate_range(3, 6), simulation[3:6]))
+        self.assertTrue(balls[0].y == 100)
+
+        # Consecutive ranges carry on from where the last one stopped instead of starting over.
+        self.assertTrue(np.allclose(manager.simulate_range(6, 9), simulation[6:9]))
+        self.assertTrue(manager.stepper_frame == 9)
+        self.assertTrue(len(manager.simulate_range(len(frames) - 1, len(frames) + 5)) == 1)
+
 
 class TestScreenWriterMethods(unittest.TestCase):
     def test_init(self):
-        screenwriter = ScreenWriter((100, 100, 100), (1280, 720), 60.)
+        with tempfile.TemporaryDirectory() as output_dir:
+            screenwriter = ScreenWriter((100, 100, 100), (1280, 720), 60., os.path.join(output_dir, 'test.avi'))
+            screenwriter.release()
 
         self.assertTrue(screenwriter.bg_color[0] == 100 and
                         screenwriter.bg_color[1] == 100 and
@@ -148,6 +493,108 @@ class TestScreenWriterMethods(unittest.TestCase):
         self.assertTrue(len(screenwriter.imgs) == 0)
         self.assertTrue(type(screenwriter.writer) == cv2.VideoWriter)
 
+    def test_dirty_rect(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            screenwriter = ScreenWriter((100, 100, 100), (320, 240), 60., os.path.join(output_dir, 'full.avi'))
+            dirty_writer = ScreenWriter((100, 100, 100), (320, 240), 60., os.path.join(output_dir, 'dirty.avi'),
+                                        dirty_rect=True)
+
+            rng = np.random.default_rng(0)
+            for _ in range(50):
+                balls_info = []
+                for _ in range(5):
+                    radius = rng.uniform(2, 40)
+                    minor = rng.uniform(1, radius)
+                    balls_info.append({
+                        'x': rng.uniform(0, 320),
+                        'y': rng.uniform(0, 240),
+                        'major': radius ** 2 / minor,
+                        'minor': minor,
+                        'color': [int(c) for c in rng.integers(0, 256, 3)]
+                    })
+
+                img = screenwriter.generate_image(balls_info)
+                dirty_img = dirty_writer.generate_image(balls_info)
+                self.assertTrue(np.all(img == dirty_img))
+
+            screenwriter.release()
+            dirty_writer.release()
+
+    def test_frame_store(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            path = os.path.join(output_dir, 'frames.npy')
+            screenwriter = ScreenWriter((100, 100, 100), (32, 24), 60., path, codec='npy')
+            self.assertTrue(type(screenwriter.writer) == FrameStore)
+
+            imgs = []
+            for frame in range(10):
+                balls_info = [{'x': 5 + frame, 'y': 10, 'major': 4, 'minor': 3, 'color': [255, 0, frame]}]
+                imgs.append(screenwriter.generate_image(balls_info))
+            screenwriter.release()
+
+            frames = np.load(path, mmap_mode='r')
+            self.assertTrue(frames.shape == (10, 24, 32, 3))
+            self.assertTrue(np.all(frames == np.array(imgs)))
+            del frames
+
+    def test_queue_size(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            screenwriter = ScreenWriter((100, 100, 100), (320, 240), 60., os.path.join(output_dir, 'inline.avi'),
+                                        dirty_rect=True)
+            queued_writer = ScreenWriter((100, 100, 100), (320, 240), 60., os.path.join(output_dir, 'queued.avi'),
+                                         dirty_rect=True, queue_size=3)
+
+            for frame in range(30):
+                balls_info = [{'x': 20 + frame * 5, 'y': 100, 'major': 20, 'minor': 20, 'color': [255, 0, 0]}]
+                screenwriter.generate_image(balls_info)
+                queued_writer.generate_image(balls_info)
+
+            screenwriter.release()
+            queued_writer.release()
+
+            stats = queued_writer.writer_stats()
+            self.assertTrue(stats['encode_time'] > 0)
+            self.assertTrue(stats['producer_stall'] >= 0 and stats['encoder_stall'] >= 0)
+
+            with open(os.path.join(output_dir, 'inline.avi'), 'rb') as inline, \
+                    open(os.path.join(output_dir, 'queued.avi'), 'rb') as queued:
+                self.assertTrue(inline.read() == queued.read())
+
+    def test_sprite_cache(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            screenwriter = ScreenWriter((100, 100, 100), (320, 240), 60., os.path.join(output_dir, 'full.avi'))
+            sprite_writer = ScreenWriter((100, 100, 100), (320, 240), 60., os.path.join(output_dir, 'sprite.avi'),
+                                         dirty_rect=True, sprite_cache=8)
+
+            rng = np.random.default_rng(0)
+            for _ in range(50):
+                balls_info = []
+                for color in [[255, 0, 0], [0, 255, 0], [0, 0, 255]]:
+                    radius = rng.choice([3, 10.4, 25])
+                    minor = rng.choice([radius, radius / 2])
+                    balls_info.append({
+                        'x': rng.uniform(100, 220),
+                        'y': rng.uniform(80, 160),
+                        'major': radius ** 2 / minor,
+                        'minor': minor,
+                        'color': color
+                    })
+
+                # Balls cut off by the edge are drawn without the cache.
+                balls_info.append({'x': 5, 'y': 5, 'major': 30, 'minor': 15, 'color': [255, 255, 255]})
+
+                img = screenwriter.generate_image(balls_info)
+                sprite_img = sprite_writer.generate_image(balls_info)
+                self.assertTrue(np.all(img == sprite_img))
+
+            sprite_info = sprite_writer.sprite_cache_info()
+            self.assertTrue(sprite_info['hits'] + sprite_info['misses'] == 150)
+            self.assertTrue(sprite_info['hits'] > 0)
+            self.assertTrue(sprite_info['size'] <= 8)
+
+            screenwriter.release()
+            sprite_writer.release()
+
 
 class TestHelperMethods(unittest.TestCase):
     def test_parse_args1(self):
@@ -174,6 +621,7 @@ class TestHelperMethods(unittest.TestCase):
         self.assertTrue(args['resolution'][0] == 1920 and args['resolution'][1] == 1080)
         self.assertTrue(args['fps'] == 60)
         self.assertTrue(args['title'] == 'bounce.avi')
+        self.assertTrue(not args['collisions'])
         self.assertTrue(args['background_color'][0] == 15 and
                         args['background_color'][1] == 20 and
                         args['background_color'][2] == 25)
@@ -290,6 +738,196 @@ class TestHelperMethods(unittest.TestCase):
         ball_args = get_horizontal_scale(ball_args, args)
         self.assertTrue(42 < ball_args[0]['hor_vel'] < 43)
 
+    def test_render_parallel(self):
+        ball_args = [{
+            'color': [1, 2, 3],
+            'radius': 5,
+            'starting_height': 50,
+            'deformation': 0.4,
+        }]
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            args = {
+                'count_frames': True,
+                'duration': 20,
+                'acceleration': 500,
+                'resolution': [64, 64],
+                'fps': 30.,
+                'background_color': [50, 50, 50],
+                'output_dir': output_dir,
+                'title': 'parallel.avi',
+                'engine': 'object',
+                'workers': 3,
+                'collisions': False,
+                'dirty_rect': True,
+                'sprite_cache': 4,
+                'queue_size': 2,
+                'codec': 'rgba'
+            }
+            ball_args = get_horizontal_scale(ball_args, args)
+
+            timings = render_parallel(args, ball_args, Progress(21, quiet=True))
+            manager = BallManager(args['acceleration'], args['duration'], args['count_frames'], args['fps'],
+                                  [Ball(ball_arg) for ball_arg in ball_args])
+            render_segment(args, manager, 0, 21, os.path.join(output_dir, 'single.avi'), 'rgba')
+            self.assertTrue(set(timings) == {'simulation', 'rasterization', 'encoding', 'joining'})
+
+            self.assertTrue(sorted(os.listdir(output_dir)) == ['parallel.avi', 'single.avi'])
+            with open(os.path.join(output_dir, 'parallel.avi'), 'rb') as parallel, \
+                    open(os.path.join(output_dir, 'single.avi'), 'rb') as single:
+                self.assertTrue(parallel.read() == single.read())
+
+    def test_render_parallel_frame_store(self):
+        ball_args = [{
+            'color': [1, 2, 3],
+            'radius': 5,
+            'starting_height': 50,
+            'deformation': 0.4,
+        }]
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            args = {
+                'count_frames': True,
+                'duration': 20,
+                'acceleration': 500,
+                'resolution': [64, 64],
+                'fps': 30.,
+                'background_color': [50, 50, 50],
+                'output_dir': output_dir,
+                'title': 'parallel.npy',
+                'engine': 'object',
+                'workers': 2,
+                'collisions': False,
+                'dirty_rect': False,
+                'sprite_cache': 0,
+                'queue_size': 0,
+                'codec': 'npy'
+            }
+            ball_args = get_horizontal_scale(ball_args, args)
+
+            render_parallel(args, ball_args, Progress(21, quiet=True))
+            manager = BallManager(args['acceleration'], args['duration'], args['count_frames'], args['fps'],
+                                  [Ball(ball_arg) for ball_arg in ball_args])
+            render_segment(args, manager, 0, 21, os.path.join(output_dir, 'single.npy'), 'npy')
+
+            parallel = np.load(os.path.join(output_dir, 'parallel.npy'))
+            single = np.load(os.path.join(output_dir, 'single.npy'))
+            self.assertTrue(parallel.shape == (21, 64, 64, 3))
+            self.assertTrue(np.all(parallel == single))
+
+    def test_render_parallel_stepped(self):
+        # The ball moves 9.5 px a frame, so it is centered halfway between two pixels every other frame, where state
+        # worked out in closed form can round differently from stepped state.
+        with tempfile.TemporaryDirectory() as output_dir:
+            argv = ['--resolution', '200', '60', '--radius', '5', '--starting_height', '40', '--count_frames',
+                    '--duration', '20', '--fps', '30', '--codec', 'npy', '--output_dir', output_dir, '--quiet']
+            with patch('sys.stdout'):
+                generate_video(parse_args(argv + ['--title', 'single.npy']))
+                generate_video(parse_args(argv + ['--title', 'parallel.npy', '--workers', '3']))
+
+            single = np.load(os.path.join(output_dir, 'single.npy'))
+            parallel = np.load(os.path.join(output_dir, 'parallel.npy'))
+            self.assertTrue(single.shape == parallel.shape == (21, 60, 200, 3))
+            for frame in range(len(single)):
+                self.assertTrue(np.all(single[frame] == parallel[frame]))
+
+    def test_nested_output_dir(self):
+        # Missing parent directories are created, and rendering into a directory that exists again is fine.
+        with tempfile.TemporaryDirectory() as output_dir:
+            nested_dir = os.path.join(output_dir, 'renders', 'scene')
+            argv = ['--count_frames', '--duration', '2', '--codec', 'npy', '--title', 'nested.npy', '--output_dir',
+                    nested_dir, '--quiet']
+            with patch('sys.stdout'):
+                generate_video(parse_args(argv))
+                generate_video(parse_args(argv))
+            self.assertTrue(os.listdir(nested_dir) == ['nested.npy'])
+
+    def test_simulation_path(self):
+        # The same scene as test_render_parallel_stepped, where the closed-form state only agrees with the stepped
+        # state up to rounding, so a ball centered halfway between two pixels may be drawn a pixel to either side.
+        with tempfile.TemporaryDirectory() as output_dir:
+            argv = ['--resolution', '200', '60', '--radius', '5', '--starting_height', '40', '--count_frames',
+                    '--duration', '20', '--fps', '30', '--codec', 'npy', '--output_dir', output_dir, '--quiet']
+            simulation_path = os.path.join(output_dir, 'simulation.npy')
+            with patch('sys.stdout'):
+                generate_video(parse_args(argv + ['--title', 'stepped.npy']))
+                generate_video(parse_args(argv + ['--title', 'simulated.npy', '--simulation_path', simulation_path]))
+
+            args = parse_args(argv + ['--title', 'stepped.npy'])
+            manager = BallManager(args['acceleration'], args['duration'], args['count_frames'], args['fps'],
+                                  [Ball(ball_arg) for ball_arg in get_horizontal_scale(args['balls'], args)])
+            frames = [[[ball_info[field] for field in SIMULATION_FIELDS] for ball_info in manager.get_info()]]
+            for frame in range(20):
+                info, finished = manager.nextFrame()
+                frames.append([[ball_info[field] for field in SIMULATION_FIELDS] for ball_info in info])
+            simulation = load_simulation(simulation_path)
+            self.assertTrue(np.allclose(simulation, frames, rtol=0, atol=1e-4))
+            del simulation
+
+            stepped = np.load(os.path.join(output_dir, 'stepped.npy'))
+            simulated = np.load(os.path.join(output_dir, 'simulated.npy'))
+            self.assertTrue(stepped.shape == simulated.shape == (21, 60, 200, 3))
+            shifted = 0
+            for frame in range(len(stepped)):
+                if np.any(stepped[frame] != simulated[frame]):
+                    shifted += 1
+                    self.assertTrue(any(np.all(np.roll(stepped[frame], offset, axis=1) == simulated[frame])
+                                        for offset in [-1, 1]))
+            self.assertTrue(0 < shifted < len(stepped))
+
+        self.assertTrue(parse_args(argv + ['--title', 'simulated.npy', '--simulation_path', simulation_path,
+                                           '--workers', '1'])['workers'] == 1)
+        self.assertRaises(AssertionError, parse_args, argv + ['--title', 'simulated.npy', '--simulation_path',
+                                                              simulation_path, '--workers', '2'])
+
+    def test_progress(self):
+        # The line is rewritten at most every PROGRESS_INTERVAL seconds, and always once the last frame is done.
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout, \
+                patch('time.perf_counter', side_effect=[0, 0.1, 0.6, 0.7, 0.8, 1]):
+            progress = Progress(10)
+            progress.update()
+            self.assertTrue(stdout.getvalue() == '')
+
+            progress.update()
+            self.assertTrue(stdout.getvalue() == '\rFrame 2/10 | 3.3 fps | 8 frames remaining | ETA 2.4s ')
+
+            progress.update()
+            progress.update(7)
+            self.assertTrue(stdout.getvalue().endswith('\rFrame 10/10 | 12.5 fps | 0 frames remaining | ETA 0.0s '))
+
+            summary = progress.summary({'simulation': 0.25, 'rasterization': 0.5})
+            self.assertTrue(stdout.getvalue().endswith('\nRendered 10 frames in 1.00s (10.0 fps): simulation 0.25s, '
+                                                       'rasterization 0.50s\n'))
+
+        self.assertTrue(summary == {'frames': 10, 'time': 1, 'fps': 10, 'timings': {'simulation': 0.25,
+                                                                                     'rasterization': 0.5}})
+
+        # Runs of unknown length only show the frames done and the fps.
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout, patch('time.perf_counter', side_effect=[0, 1]):
+            Progress(None).update(5)
+            self.assertTrue(stdout.getvalue() == '\rFrame 5 | 5.0 fps ')
+
+        # Quiet runs only print the summary, including when generating a video.
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            progress = Progress(10, quiet=True)
+            progress.update(10)
+            progress.summary({})
+            self.assertTrue(stdout.getvalue().startswith('Rendered 10 frames'))
+
+        with tempfile.TemporaryDirectory() as output_dir, patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            generate_video(parse_args(['--resolution', '200', '60', '--radius', '5', '--starting_height', '40',
+                                       '--count_frames', '--duration', '5', '--sprite_cache', '8', '--queue_size',
+                                       '2', '--output_dir', output_dir, '--quiet']))
+            self.assertTrue(stdout.getvalue().startswith('Rendered 6 frames') and stdout.getvalue().count('\n') == 1)
+
+    def test_get_bounce_times(self):
+        fall_time, deform_time = get_bounce_times(300, 10, 0, 9.81)
+        self.assertAlmostEqual(fall_time, (580 / 9.81) ** (1 / 2))
+        self.assertTrue(deform_time == 0)
+
+        fall_time, deform_time = get_bounce_times(100, 5, 0.4, 9.81)
+        self.assertAlmostEqual(deform_time, 2 * 4 * 0.4 / (fall_time * 9.81))
+
     def test_get_horizontal_scale2(self):
         ball_args = [
             {
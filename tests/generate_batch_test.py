@@ -0,0 +1,104 @@
+from generate_batch import *
+
+import tempfile
+import unittest
+
+
+class TestHelperMethods(unittest.TestCase):
+    def setUp(self):
+        self.manifest = {
+            'defaults': {
+                'resolution': [64, 64],
+                'fps': 30,
+                'acceleration': 500,
+                'count_frames': True,
+                'duration': 10
+            },
+            'scenes': [
+                {
+                    'title': 'one.avi',
+                    'balls': [{'color': [1, 2, 3], 'starting_height': 40, 'radius': 5, 'deformation': 0.2}]
+                }, {
+                    'title': 'two.npy',
+                    'codec': 'npy',
+                    'duration': 5,
+                    'balls': [{'color': [1, 2, 3], 'starting_height': 40, 'radius': 5},
+                              {'color': [4, 5, 6], 'starting_height': 30, 'radius': 3}]
+                }
+            ]
+        }
+
+    def test_load_manifest(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            path = os.path.join(output_dir, 'manifest.json')
+            with open(path, 'w') as manifest_file:
+                json.dump(self.manifest, manifest_file)
+
+            scenes = load_manifest(path)
+
+        self.assertTrue(len(scenes) == 2)
+        self.assertTrue(scenes[0]['duration'] == 10 and scenes[1]['duration'] == 5)
+        self.assertTrue(scenes[1]['resolution'] == [64, 64])
+        self.assertTrue(scenes[0]['output_dir'] == 'sample_videos')
+
+    def test_load_manifest_titles(self):
+        untitled = {'balls': [{'color': [1, 2, 3], 'starting_height': 40, 'radius': 5}]}
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            path = os.path.join(output_dir, 'manifest.json')
+
+            # Scenes without a title are named after their place in the manifest, with the ending of their codec.
+            self.manifest['scenes'] += [untitled, dict(untitled, codec='npy'), dict(untitled, output_dir='other')]
+            with open(path, 'w') as manifest_file:
+                json.dump(self.manifest, manifest_file)
+
+            scenes = load_manifest(path, output_dir)
+            self.assertTrue([scene['title'] for scene in scenes] ==
+                            ['one.avi', 'two.npy', 'scene2.avi', 'scene3.npy', 'scene4.avi'])
+            self.assertTrue([scene['output_dir'] for scene in scenes] == [output_dir] * 4 + ['other'])
+
+            # Scenes saved to the same path are rejected, as they would overwrite each other.
+            self.manifest['scenes'].append({'title': 'one.avi', 'output_dir': os.path.join(output_dir, '.')})
+            with open(path, 'w') as manifest_file:
+                json.dump(self.manifest, manifest_file)
+
+            self.assertRaises(AssertionError, load_manifest, path, output_dir)
+
+    def test_scene_args(self):
+        args = scene_args(dict(self.manifest['defaults'], **self.manifest['scenes'][1]))
+
+        self.assertTrue(args['codec'] == 'npy')
+        self.assertTrue(args['duration'] == 5)
+        self.assertTrue(args['count_frames'])
+        self.assertTrue(args['resolution'] == [64, 64])
+        self.assertTrue(len(args['balls']) == 2)
+        self.assertTrue(args['balls'][1]['color'] == [4, 5, 6] and args['balls'][1]['radius'] == 3)
+        self.assertTrue(args['balls'][1]['deformation'] == 0.5)
+        self.assertTrue(args['workers'] == 1)
+
+    def test_render_scene(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            scene = dict(self.manifest['defaults'], **self.manifest['scenes'][0])
+            scene['output_dir'] = output_dir
+
+            result = render_scene((scene, False))
+            self.assertTrue(result['status'] == 'rendered')
+            self.assertTrue(result['summary']['frames'] == 11)
+            self.assertTrue(os.path.exists(os.path.join(output_dir, 'one.avi')))
+
+            result = render_scene((scene, False))
+            self.assertTrue(result['status'] == 'skipped')
+
+            scene['radius'] = 100
+            scene['balls'] = [{'radius': 100}]
+            result = render_scene((scene, True))
+            self.assertTrue(result['status'] == 'failed')
+
+            report = write_report([result], 1., os.path.join(output_dir, 'report.json'))
+            self.assertTrue(report['summary']['failed'] == 1)
+            with open(os.path.join(output_dir, 'report.json')) as report_file:
+                self.assertTrue(json.load(report_file)['summary']['failed'] == 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+from generate_track import *
+
+import unittest
+
+
+class TestHelperMethods(unittest.TestCase):
+    def setUp(self):
+        self.argv = ['--resolution', '160', '120', '--fps', '30', '--acceleration', '500', '--count_frames',
+                     '--duration', '40', '--color', '0', '0', '255', '--starting_height', '100', '--radius', '10']
+
+    def test_parse_args(self):
+        args = parse_args(self.argv + ['--segmentation', 'label', '--tolerance', '2'])
+
+        self.assertTrue(args['segmentation'] == 'label' and args['tolerance'] == 2)
+        self.assertTrue(args['balls'][0]['color'] == [0, 0, 255] and args['resolution'] == [160, 120])
+        self.assertTrue(args['tracking'] == 'full' and not args['color_table'] and args['detections'] is None)
+
+    def test_generate_frames(self):
+        args = parse_args(self.argv + ['--dirty_rect'])
+        frames = list(generate_frames(args))
+
+        # Every frame shares the one buffer of the ScreenWriter.
+        self.assertTrue(len(frames) == 41)
+        self.assertTrue(all([frame is frames[0][0] for frame, balls_info in frames]))
+        self.assertTrue(frames[0][1][0]['y'] == 100 and frames[-1][1][0]['y'] != 100)
+
+    def test_ground_truth_blobs(self):
+        balls_info = [{'x': 20., 'y': 30., 'major': 10., 'minor': 5., 'color': (1, 2, 3)},
+                      {'x': 20., 'y': 200., 'major': 10., 'minor': 10., 'color': (1, 2, 3)},
+                      {'x': -20., 'y': 30., 'major': 10., 'minor': 10., 'color': (1, 2, 3)}]
+        blobs = ground_truth_blobs(balls_info, [100, 100])
+
+        self.assertTrue(len(blobs) == 1)
+        self.assertTrue(blobs[0]['color'] == [1, 2, 3] and blobs[0]['centroid'] == (20., 70.))
+        self.assertTrue(blobs[0]['bbox'] == (10, 65, 21, 11))
+
+    def test_track_generated(self):
+        for segmentation in SEGMENTATIONS:
+            summary = track_generated(parse_args(self.argv + ['--segmentation', segmentation]))
+
+            self.assertTrue(summary['frames'] == 41)
+            self.assertTrue(summary['matched'] == 41 and summary['missed'] == 0 and summary['extra'] == 0)
+            self.assertTrue(summary['recall'] == 1 and summary['precision'] == 1)
+            self.assertTrue(summary['max_centroid_error'] < 1)
+
+        summary = track_generated(parse_args(self.argv + ['--tracking', 'physics']))
+        self.assertTrue(summary['matched'] == 41 and summary['missed'] == 0 and summary['extra'] == 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+from profiling import *
+
+import io
+import profiling
+import tempfile
+import unittest
+from unittest.mock import patch
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.enabled = profiling.profiler.enabled
+        profiling.profiler.enabled = False
+        profiling.profiler.reset()
+
+    def tearDown(self):
+        profiling.profiler.enabled = self.enabled
+        profiling.profiler.reset()
+
+    def test_disabled(self):
+        test_profiler = Profiler()
+        self.assertTrue(test_profiler.stage('mask') is NO_STAGE)
+        with test_profiler.stage('mask'):
+            pass
+
+        self.assertTrue(test_profiler.report() == {})
+
+    def test_report(self):
+        test_profiler = Profiler(enabled=True)
+        for i in range(100):
+            with test_profiler.stage('mask'):
+                pass
+        for seconds in range(1, 101):
+            test_profiler.record('draw', seconds / 1000, 2)
+
+        report = test_profiler.report()
+        self.assertTrue(sorted(report) == ['draw', 'mask'])
+        self.assertTrue(report['mask']['count'] == 100 and report['mask']['p99'] >= report['mask']['p50'] >= 0)
+        self.assertTrue(abs(report['draw']['total'] - 5.05) < 1e-9 and abs(report['draw']['mean'] - 50.5) < 1e-9)
+        self.assertTrue(abs(report['draw']['p50'] - 50.5) < 1e-9 and abs(report['draw']['p95'] - 95.05) < 1e-9)
+        self.assertTrue(report['draw']['net_blocks'] == 2 and report['draw']['total_net_blocks'] == 200)
+
+    def test_session(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            with session():
+                with stage('mask'):
+                    pass
+            self.assertTrue(profiling.profiler.report() == {})
+
+            paths = [os.path.join(output_dir, name) for name in ['run.prof', 'run.txt', 'run.json']]
+            with session(cprofile_path=paths[0], tracemalloc_path=paths[1], report_path=paths[2]):
+                with stage('mask'):
+                    blocks = [[] for i in range(100)]
+
+            self.assertTrue(all([os.path.exists(path) for path in paths]))
+            self.assertTrue(not profiling.profiler.enabled)
+            with open(paths[2]) as report_file:
+                self.assertTrue(json.load(report_file)['mask']['count'] == 1)
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_session_enabled(self, stdout):
+        with session(enabled=True):
+            self.assertTrue(profiling.profiler.enabled)
+        self.assertTrue(not profiling.profiler.enabled)
+
+        # A profiler that was already enabled stays so, even if the block raises.
+        profiling.profiler.enabled = True
+        with self.assertRaises(ValueError):
+            with session():
+                raise ValueError
+        self.assertTrue(profiling.profiler.enabled)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,7 @@
 from track_ball import *
+from generate_ball import Ball, FrameStore
 
+import tempfile
 import unittest
 
 
@@ -21,6 +23,223 @@ class TestHelperMethods(unittest.TestCase):
         self.assertTrue(args['output_dir'] == 'random_folder')
         self.assertTrue(args['save_name'] == 'random.avi')
 
+    def test_frame_store_capture(self):
+        frames = np.zeros((4, 24, 32, 3), dtype='uint8')
+        frames[:] = np.arange(4).reshape(-1, 1, 1, 1)
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            path = os.path.join(output_dir, 'frames.npy')
+            np.save(path, frames)
+
+            capture = open_video(path, 30.)
+            self.assertTrue(capture.isOpened())
+            self.assertTrue(capture.get(cv2.CAP_PROP_FPS) == 30)
+            self.assertTrue(capture.get(cv2.CAP_PROP_FRAME_COUNT) == 4)
+            self.assertTrue(capture.get(cv2.CAP_PROP_FRAME_WIDTH) == 32)
+            self.assertTrue(capture.get(cv2.CAP_PROP_FRAME_HEIGHT) == 24)
+
+            for i in range(4):
+                ret, frame = capture.read()
+                self.assertTrue(ret and np.all(frame == i))
+
+            ret, frame = capture.read()
+            self.assertFalse(ret)
+            capture.release()
+
+    def test_track_video_headless(self):
+        frames = np.full((10, 120, 160, 3), 50, dtype='uint8')
+        for i in range(len(frames)):
+            frames[i] = cv2.ellipse(frames[i], (20 + 5 * i, 60), (10, 10), 0, 0, 360, (0, 0, 255), -1)
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            path = os.path.join(output_dir, 'frames.npy')
+            np.save(path, frames)
+
+            for tracking in TRACKING_MODES:
+                args = parse_args(['--path', path, '--output_dir', output_dir, '--save_name', tracking + '.avi',
+                                   '--tracking', tracking, '--headless'])
+                summary = track_video(args)
+
+                self.assertTrue(summary['frames'] == 10 and summary['fps'] > 0)
+                self.assertTrue(os.path.exists(os.path.join(output_dir, tracking + '.avi')))
+
+            args = parse_args(['--path', path, '--output_dir', output_dir, '--save_name', 'skipped.avi', '--headless',
+                               '--no_video'])
+            self.assertTrue(track_video(args)['frames'] == 10)
+
+            args = parse_args(['--path', path, '--output_dir', output_dir, '--headless', '--queue_size', '4'])
+            summary = track_video(args)
+            self.assertTrue(summary['frames'] == 10 and set(summary['stages']) == set(PIPELINE_STAGES))
+            self.assertFalse(os.path.exists(os.path.join(output_dir, 'skipped.avi')))
+
+    def test_tracking_pipeline(self):
+        class FrameList(list):
+            def write(self, frame):
+                self.append(frame)
+
+        frames = np.full((20, 120, 160, 3), 50, dtype='uint8')
+        for i in range(len(frames)):
+            frames[i] = cv2.ellipse(frames[i], (20 + 5 * i, 60), (10, 10), 0, 0, 360, (0, 0, 255), -1)
+            frames[i] = cv2.ellipse(frames[i], (140 - 3 * i, 30 + i), (8, 8), 0, 0, 360, (0, 255, 0), -1)
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            path = os.path.join(output_dir, 'frames.npy')
+            np.save(path, frames)
+            args = parse_args(['--path', path, '--tracking', 'physics', '--headless', '--queue_size', '2'])
+
+            writer = FrameList()
+            pipeline = TrackingPipeline(open_video(path, 60.), args, make_tracker(args), writer, 2)
+            self.assertTrue(pipeline.run() == 20)
+
+        # Frames come out in order, the same as tracking one frame at a time.
+        tracker = make_tracker(args)
+        self.assertTrue(len(writer) == 20)
+        for i, frame in enumerate(frames):
+            contours, blobs, tracks = find_contours(frame.copy(), args, tracker)
+            self.assertTrue(np.array_equal(writer[i], annotate_frame(frame.copy(), contours, tracks, i + 1, 2)))
+
+        stats = pipeline.stage_stats()
+        for stage in PIPELINE_STAGES:
+            self.assertTrue(stats[stage]['frames'] == 20 and stats[stage]['latency'] > 0)
+
+    def test_tracking_pipeline_error(self):
+        class FailingWriter:
+            def write(self, frame):
+                raise IOError('Disk full.')
+
+        frames = np.full((200, 120, 160, 3), 50, dtype='uint8')
+        for i in range(len(frames)):
+            frames[i] = cv2.ellipse(frames[i], (20 + i % 120, 60), (10, 10), 0, 0, 360, (0, 0, 255), -1)
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            path = os.path.join(output_dir, 'frames.npy')
+            np.save(path, frames)
+            args = parse_args(['--path', path, '--headless', '--queue_size', '2'])
+
+            pipeline = TrackingPipeline(open_video(path, 60.), args, make_tracker(args), FailingWriter(), 3)
+            self.assertRaises(IOError, pipeline.run)
+
+        # The first failed write stops detecting and decoding within a few frames, instead of going on to the end.
+        self.assertTrue(pipeline.stopped)
+        self.assertTrue(pipeline.stats['detect']['frames'] < 10)
+        self.assertTrue(pipeline.stats['decode']['frames'] < 20)
+
+    def test_track_parallel(self):
+        height, width, fps, acceleration = 240, 320, 60, 1000
+        balls = []
+        for color, radius, starting_height, hor_vel, x, deformation in [([0, 0, 255], 15, 200, 50, 30, 0.3),
+                                                                        ([0, 255, 0], 12, 150, -40, 290, 0)]:
+            ball = Ball({'color': color, 'radius': radius, 'starting_height': starting_height,
+                         'deformation': deformation, 'hor_vel': hor_vel})
+            ball.x = x
+            balls.append(ball)
+
+        frames = np.full((150, height, width, 3), 50, dtype='uint8')
+        for frame in frames:
+            for ball in balls:
+                info = ball.nextFrame(-acceleration, 1 / fps)[0]
+                center = np.round((info['x'], height - info['y'])).astype('int')
+                axes = np.round((info['major'], info['minor'])).astype('int')
+                cv2.ellipse(frame, center.tolist(), axes.tolist(), 0, 0, 360, info['color'], -1)
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            path = os.path.join(output_dir, 'frames.npy')
+            np.save(path, frames)
+
+            args = parse_args(['--path', path, '--output_dir', output_dir, '--tracking', 'physics', '--headless',
+                               '--workers', '3'])
+            writer = FrameStore(os.path.join(output_dir, 'tracking.npy'), (width, height))
+            tracks = track_parallel(args, len(frames), writer, 3)
+            writer.release()
+
+            # The segments are joined into the one video and removed.
+            self.assertTrue(sorted(os.listdir(output_dir)) == ['frames.npy', 'tracking.npy'])
+            tracking = np.load(os.path.join(output_dir, 'tracking.npy'))
+            self.assertTrue(tracking.shape == frames.shape)
+
+            # Segments are lossless, so the background nothing is drawn on comes back exactly.
+            self.assertTrue(np.all(tracking[:, :5, -5:] == 50))
+
+        # Every ball keeps the id it has when tracked in a single process, across every chunk.
+        tracker = make_tracker(args)
+        self.assertTrue(len(tracks) == len(frames))
+        for frame, frame_tracks in zip(frames, tracks):
+            expected = find_contours(frame.copy(), args, tracker)[2]
+            self.assertTrue(sorted([(track['id'], track['color']) for track in frame_tracks]) ==
+                            sorted([(track['id'], track['color']) for track in expected]))
+
+    def test_stitch_tracks(self):
+        previous = [[{'id': 4, 'color': [0, 0, 255], 'centroid': (10, 10)},
+                     {'id': 7, 'color': [0, 255, 0], 'centroid': (50, 50)}]] * 3
+        overlap = [[{'id': 0, 'color': [0, 255, 0], 'centroid': (51, 50)},
+                    {'id': 1, 'color': [0, 0, 255], 'centroid': (11, 10)},
+                    {'id': 2, 'color': [0, 0, 255], 'centroid': (90, 90)}]] * 3
+        rest = [[{'id': 3, 'color': [255, 0, 0], 'centroid': (0, 0)}]]
+
+        ids, next_id = stitch_tracks(previous, overlap, rest, 8)
+        self.assertTrue(ids == {0: 7, 1: 4, 2: 8, 3: 9} and next_id == 10)
+
+    def test_detection_sink(self):
+        frames = np.full((12, 120, 160, 3), 50, dtype='uint8')
+        for i in range(len(frames)):
+            frames[i] = cv2.ellipse(frames[i], (20 + 5 * i, 60), (12, 8), 0, 0, 360, (0, 0, 255), -1)
+            frames[i] = cv2.ellipse(frames[i], (140 - 3 * i, 30), (6, 6), 0, 0, 360, (0, 255, 0), -1)
+
+        formats = ['.csv', '.npz'] + (['.parquet'] if pyarrow is not None else [])
+        with tempfile.TemporaryDirectory() as output_dir:
+            path = os.path.join(output_dir, 'frames.npy')
+            np.save(path, frames)
+
+            for extension in formats:
+                # The same detections come out one frame at a time, in stages and in parallel.
+                results = []
+                for options in [[], ['--queue_size', '2'], ['--workers', '2']]:
+                    detections = os.path.join(output_dir, 'detections' + str(len(results)) + extension)
+                    args = parse_args(['--path', path, '--segmentation', 'label', '--headless', '--no_video',
+                                       '--output_dir', output_dir, '--detections', detections] + options)
+                    track_video(args)
+                    results.append(load_detections(detections))
+
+                for result in results:
+                    self.assertTrue(len(result['frame']) == 24)
+                    for name, dtype in DETECTION_FIELDS:
+                        self.assertTrue(result[name].dtype == dtype)
+                        self.assertTrue(np.allclose(result[name], results[0][name]))
+
+                ball = results[0]['color_r'] == 255
+                self.assertTrue(np.array_equal(results[0]['frame'][ball], np.arange(12)))
+                self.assertTrue(np.allclose(results[0]['x'][ball], 20 + 5 * np.arange(12), atol=0.1))
+                self.assertTrue(np.allclose(results[0]['major'][ball], 12, atol=0.5))
+                self.assertTrue(np.allclose(results[0]['minor'][ball], 8, atol=0.5))
+
+            # Rows are written once a frame brings them up to the batch size, so two balls a frame make batches of 6.
+            detections = os.path.join(output_dir, 'batches.npz')
+            sink = DetectionSink(detections, batch_size=5)
+            for i, frame in enumerate(frames):
+                sink.write(i, label_contours(frame, 0, [50, 50, 50])[1])
+            sink.release()
+
+            self.assertTrue([len(batch['frame']) for batch in read_detections(detections)] == [6, 6, 6, 6])
+            self.assertTrue(np.allclose(load_detections(detections)['area'], results[0]['area']))
+
+    def test_count_colors(self):
+        rng = np.random.default_rng(0)
+        pixel_sets = [
+            rng.integers(0, 256, (5000, 3)).astype('uint8'),
+            rng.integers(0, 4, (5000, 3)).astype('uint8'),
+            np.array([[255, 0, 0], [0, 0, 255], [255, 0, 0]], dtype='uint8'),
+            np.array([[7, 8, 9]] * 10, dtype='uint8'),
+            np.empty((0, 3), dtype='uint8')
+        ]
+
+        for pixels in pixel_sets:
+            colors, counts = count_colors(pixels)
+            expected_colors, expected_counts = np.unique(pixels, return_counts=True, axis=0)
+
+            self.assertTrue(colors.dtype == np.uint8)
+            self.assertTrue(np.array_equal(colors, expected_colors.reshape(-1, 3)))
+            self.assertTrue(np.array_equal(counts, expected_counts))
+
     def test_distinct_contours(self):
         img = cv2.imread('contour_test.png')
         contours = distinct_contours(img, 0, [50, 50, 50])
@@ -40,6 +259,179 @@ class TestHelperMethods(unittest.TestCase):
 
         self.assertFalse(possible_centers)
 
+    def test_label_contours(self):
+        img = np.full((200, 300, 3), 50, dtype='uint8')
+        cv2.ellipse(img, (60, 60), (30, 20), 0, 0, 360, (0, 0, 255), -1)
+        cv2.ellipse(img, (60, 150), (20, 20), 0, 0, 360, (0, 0, 255), -1)
+
+        # Touching balls of different colors, and a ball cut off by the frame.
+        cv2.ellipse(img, (150, 60), (25, 25), 0, 0, 360, (0, 255, 0), -1)
+        cv2.ellipse(img, (190, 60), (25, 25), 0, 0, 360, (255, 0, 0), -1)
+        cv2.ellipse(img, (299, 199), (20, 20), 0, 0, 360, (0, 200, 255), -1)
+
+        expected = distinct_contours(img, 0, [50, 50, 50])
+        contours, blobs = label_contours(img, 0, [50, 50, 50])
+
+        self.assertTrue(len(contours) == len(expected) == len(blobs) == 5)
+        self.assertTrue(sorted([c.tobytes() for c in contours]) == sorted([c.tobytes() for c in expected]))
+
+        for blob in blobs:
+            x, y, width, height = blob['bbox']
+            mask = np.all(img[y:y + height, x:x + width] == blob['color'], axis=-1)
+            self.assertTrue(blob['area'] <= np.count_nonzero(mask))
+            self.assertTrue(x <= blob['centroid'][0] < x + width and y <= blob['centroid'][1] < y + height)
+
+        centers = sorted([(round(blob['centroid'][0]), round(blob['centroid'][1])) for blob in blobs
+                          if blob['color'] == [0, 0, 255]])
+        self.assertTrue(centers == [(60, 60), (60, 150)])
+
+    def test_pyramid_contours(self):
+        img = np.full((300, 400, 3), 50, dtype='uint8')
+        cv2.ellipse(img, (60, 60), (30, 20), 0, 0, 360, (0, 0, 255), -1)
+        cv2.ellipse(img, (150, 60), (25, 25), 0, 0, 360, (0, 255, 0), -1)
+        cv2.ellipse(img, (190, 60), (25, 25), 0, 0, 360, (255, 0, 0), -1)
+        cv2.ellipse(img, (399, 299), (20, 20), 0, 0, 360, (0, 200, 255), -1)
+        cv2.ellipse(img, (304, 154), (2, 2), 0, 0, 360, (255, 255, 0), -1)
+
+        expected_contours, expected_blobs = label_contours(img, 0, [50, 50, 50])
+        contours, blobs = pyramid_contours(img, 0, [50, 50, 50], 5)
+
+        # Contours are refined at full resolution, so they are exactly the same.
+        self.assertTrue(sorted([c.tobytes() for c in contours]) == sorted([c.tobytes() for c in expected_contours]))
+        accuracy = compare_blobs(blobs, expected_blobs)
+        self.assertTrue(accuracy['matched'] == 5 and accuracy['missed'] == 0 and accuracy['extra'] == 0)
+        self.assertTrue(accuracy['max_centroid_error'] == 0 and accuracy['max_area_error'] == 0)
+
+        # With a large factor the corner ball is cut off by its region, so the frame is scanned again in full.
+        accuracy = compare_blobs(pyramid_contours(img, 0, [50, 50, 50], 10)[1], expected_blobs)
+        self.assertTrue(accuracy['matched'] == 5 and accuracy['missed'] == 0 and accuracy['extra'] == 0)
+
+        # Without it, the small ball falls between the pixels sampled with a large factor.
+        cv2.ellipse(img, (399, 299), (20, 20), 0, 0, 360, (50, 50, 50), -1)
+        expected_blobs = label_contours(img, 0, [50, 50, 50])[1]
+        accuracy = compare_blobs(pyramid_contours(img, 0, [50, 50, 50], 10)[1], expected_blobs)
+        self.assertTrue(accuracy['matched'] == 3 and accuracy['missed'] == 1 and accuracy['extra'] == 0)
+
+    def test_group_colors(self):
+        colors = np.array([[0, 0, 100], [0, 0, 104], [0, 0, 108], [0, 100, 0]], dtype='uint8')
+        counts = np.array([5, 10, 5, 1])
+
+        cluster_colors, color_clusters = group_colors(colors, counts, 4)
+        self.assertTrue(cluster_colors.tolist() == [[0, 0, 104], [0, 100, 0]])
+        self.assertTrue(color_clusters.tolist() == [0, 0, 0, 1])
+
+        cluster_colors, color_clusters = group_colors(colors, counts, 4, seeds=[[0, 0, 108]])
+        self.assertTrue(cluster_colors.tolist() == [[0, 0, 108], [0, 0, 100], [0, 100, 0]])
+        self.assertTrue(color_clusters.tolist() == [1, 0, 0, 2])
+
+    def test_color_table(self):
+        table = ColorTable(4)
+        pixels = np.array([[0, 0, 104], [0, 0, 100], [0, 0, 104], [0, 100, 0]], dtype='uint8')
+        self.assertTrue(table.classify(pixels).tolist() == [0, 0, 0, 1])
+        self.assertTrue(table.colors.tolist() == [[0, 0, 104], [0, 100, 0]])
+
+        # Colors keep their clusters, and new colors join the clusters found so far first.
+        pixels = np.array([[0, 100, 0], [0, 0, 108], [0, 0, 100], [0, 0, 109], [0, 0, 109]], dtype='uint8')
+        self.assertTrue(table.classify(pixels).tolist() == [1, 0, 0, 2, 2])
+        self.assertTrue(table.colors.tolist() == [[0, 0, 104], [0, 100, 0], [0, 0, 109]])
+
+        # Labelling frames with a table finds the same blobs as grouping the colors of every frame.
+        img = np.full((120, 160, 3), 50, dtype='uint8')
+        cv2.ellipse(img, (40, 40), (20, 15), 0, 0, 360, (0, 0, 255), -1)
+        cv2.ellipse(img, (70, 40), (15, 15), 0, 0, 360, (0, 255, 0), -1)
+        cv2.ellipse(img, (120, 90), (10, 10), 0, 0, 360, (255, 0, 0), -1)
+
+        table = ColorTable(0)
+        for frame in [img, img[:, ::-1].copy()]:
+            contours, blobs = label_contours(frame, 0, [50, 50, 50], color_table=table)
+            expected_contours, expected_blobs = label_contours(frame, 0, [50, 50, 50])
+            self.assertTrue(sorted([(blob['color'], blob['area'], blob['bbox']) for blob in blobs]) ==
+                            sorted([(blob['color'], blob['area'], blob['bbox']) for blob in expected_blobs]))
+            self.assertTrue(sorted([c.tobytes() for c in contours]) ==
+                            sorted([c.tobytes() for c in expected_contours]))
+
+            contours = pyramid_contours(frame, 0, [50, 50, 50], 5, table)[0]
+            self.assertTrue(sorted([c.tobytes() for c in contours]) ==
+                            sorted([c.tobytes() for c in expected_contours]))
+        self.assertTrue(len(table.colors) == 3)
+
+    def test_region_tracker(self):
+        def draw_frame(t):
+            img = np.full((240, 320, 3), 50, dtype='uint8')
+            cv2.ellipse(img, (20 + 3 * t, 60 + t), (15, 15), 0, 0, 360, (0, 0, 255), -1)
+            cv2.ellipse(img, (200 - 2 * t, 120), (20, 12), 0, 0, 360, (0, 255, 0), -1)
+            cv2.ellipse(img, (226 - 2 * t, 120), (10, 10), 0, 0, 360, (0, 255, 255), -1)
+
+            # One ball enters the frame, and one leaves it.
+            if t >= 5:
+                cv2.ellipse(img, (100, 200), (10, 10), 0, 0, 360, (255, 0, 0), -1)
+            if t < 9:
+                cv2.ellipse(img, (280, 40), (10, 10), 0, 0, 360, (255, 255, 0), -1)
+            return img
+
+        tracker = RegionTracker(0, [50, 50, 50], full_scan_interval=4)
+        for t in range(12):
+            frame = draw_frame(t)
+            contours, blobs = tracker.detect(frame)
+            expected_contours, expected_blobs = label_contours(frame, 0, [50, 50, 50])
+
+            # The entering ball is only found by the next full scan.
+            if 5 <= t < 8:
+                self.assertTrue(len(blobs) == len(expected_blobs) - 1)
+                continue
+
+            self.assertTrue(sorted([(blob['color'], blob['area'], blob['bbox']) for blob in blobs]) ==
+                            sorted([(blob['color'], blob['area'], blob['bbox']) for blob in expected_blobs]))
+            self.assertTrue(sorted([c.tobytes() for c in contours]) ==
+                            sorted([c.tobytes() for c in expected_contours]))
+
+        # Full scans at frames 0, 4 and 8, and again at 9 when a ball leaves.
+        self.assertTrue(tracker.full_scans == 4 and tracker.region_scans == 8)
+
+    def test_physics_tracker(self):
+        height, width, fps, acceleration = 360, 480, 60, 1000
+
+        # Two balls of the same color cross each other, while a third bounces without deforming and gets partly hidden.
+        balls = []
+        for color, radius, starting_height, hor_vel, x, deformation in [([0, 0, 255], 20, 300, 120, 30, 0.3),
+                                                                        ([0, 0, 255], 20, 200, -120, 450, 0.3),
+                                                                        ([0, 255, 0], 15, 250, 40, 240, 0)]:
+            ball = Ball({'color': color, 'radius': radius, 'starting_height': starting_height,
+                         'deformation': deformation, 'hor_vel': hor_vel})
+            ball.x = x
+            balls.append(ball)
+
+        tracker = PhysicsTracker(0, [50, 50, 50])
+        matches = {}
+        for frame_num in range(200):
+            frame = np.full((height, width, 3), 50, dtype='uint8')
+            truth = []
+            for ball in balls:
+                info = ball.nextFrame(-acceleration, 1 / fps)[0]
+                center = np.round((info['x'], height - info['y'])).astype('int')
+                axes = np.round((info['major'], info['minor'])).astype('int')
+                frame = cv2.ellipse(frame, center.tolist(), axes.tolist(), 0, 0, 360, info['color'], -1)
+                truth.append((info['x'], height - info['y']))
+
+            contours, tracks = tracker.track(frame)
+            for track in tracks:
+                distances = [math.hypot(track['centroid'][0] - x, track['centroid'][1] - y) for x, y in truth]
+                if sorted(distances)[1] > 60:
+                    matches.setdefault(track['id'], set()).add(int(np.argmin(distances)))
+
+        # Every ball keeps the same id the whole way through, even after crossing.
+        self.assertTrue(matches == {0: {0}, 1: {2}, 2: {1}})
+
+        # The fitted model matches the one that generated the video.
+        for track in tracker.tracks:
+            self.assertTrue(abs(track.acceleration + acceleration / fps ** 2) < 0.01 * acceleration / fps ** 2)
+        self.assertTrue(abs(tracker.tracks[0].ball.deformation - 0.3) < 0.05)
+        self.assertTrue(tracker.tracks[1].ball.deformation == 0)
+
+    def test_merge_regions(self):
+        regions = merge_regions([(-5, -5, 10, 10), (5, 5, 20, 20), (30, 30, 40, 40), (90, 90, 120, 120)], 100, 100)
+        self.assertTrue(sorted(regions) == [(0, 0, 20, 20), (30, 30, 40, 40), (90, 90, 100, 100)])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,22 +1,85 @@
+import copy
+import csv
 import cv2
 import math
+import multiprocessing
 import numpy as np
 import os
+import queue
+import threading
+import zipfile
 
 import argparse
 import sys
 import time
 
+import profiling
+from generate_ball import CODECS, Ball, open_writer
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 CONTOUR_THRESHOLD = 2
 THUMBNAIL_FACTOR = 5
+SEGMENTATIONS = ('color', 'label', 'pyramid')
+TRACKING_MODES = ('full', 'roi', 'physics')
+
+# Incremental tracking searches this many pixels around each blob from the last frame, and scans the full frame every
+# FULL_SCAN_INTERVAL frames.
+ROI_PADDING = 16
+FULL_SCAN_INTERVAL = 30
+
+# Physics tracking fits the vertical motion of a ball once it has been seen in the air for FIT_FRAMES frames since its
+# last bounce, and forgets balls that have not been seen for MAX_MISSES frames. A blob squashed by at least
+# SQUASH_THRESHOLD px is deforming against the ground, and one whose area is off from its prediction by more than a
+# factor of OCCLUSION_RATIO is partly hidden or merged with another. A ball more than RESET_DISTANCE px from its
+# prediction is fit again from scratch.
+FIT_FRAMES = 5
+MAX_MISSES = 30
+SQUASH_THRESHOLD = 1
+OCCLUSION_RATIO = 0.8
+RESET_DISTANCE = 3
+TRACK_ID_COLOR = (255, 255, 255)
+
+PIPELINE_STAGES = ('decode', 'detect', 'annotate')
+
+# Each worker of a parallel run starts tracking CHUNK_OVERLAP frames before its chunk, so its tracker has settled by the
+# time its chunk starts, and the ids of tracks that are within STITCH_DISTANCE px of a track of the previous chunk over
+# those frames are joined to it.
+CHUNK_OVERLAP = 30
+STITCH_DISTANCE = 5
+
+# Columns of the detections saved with --detections, and their types. Colors are in the channel order of the frames.
+DETECTION_FIELDS = (('frame', 'int64'), ('color_b', 'int64'), ('color_g', 'int64'), ('color_r', 'int64'),
+                    ('x', 'float64'), ('y', 'float64'), ('area', 'float64'), ('bbox_x', 'int64'), ('bbox_y', 'int64'),
+                    ('bbox_width', 'int64'), ('bbox_height', 'int64'), ('major', 'float64'), ('minor', 'float64'),
+                    ('angle', 'float64'))
+DETECTION_FORMATS = ('.csv', '.npz', '.parquet')
+DETECTION_BATCH = 4096
 
 BORDER_COLOR = (0, 255, 0)
 THUMBNAIL_COLOR = (0, 255, 0)
 
+# count_colors counts packed colors with a histogram when the range they span is at most HISTOGRAM_SPAN_FACTOR times the
+# number of pixels, or at most HISTOGRAM_MIN_SPAN, and sorts them otherwise.
+HISTOGRAM_SPAN_FACTOR = 8
+HISTOGRAM_MIN_SPAN = 1 << 16
+
 
 def main():
     args = parse_args(sys.argv[1:])
-    capture = cv2.VideoCapture(args['path'])
+    with profiling.session(args['profile'], args['cprofile'], args['tracemalloc'], args['profile_report']):
+        track_video(args)
+
+
+# Track the balls in the video at args['path'], formatted as per parse_args, save the annotated video unless
+# args['no_video'], and save every blob found to args['detections'] if given. Returns a dictionary with the number of
+# frames tracked, the time taken and the frames per second.
+def track_video(args):
+    capture = open_video(args['path'], args['fps'])
 
     assert capture.isOpened() and "Error opening video. Could be a multitude of problems, but likely corruption."
 
@@ -25,25 +88,418 @@ def main():
     width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
     num_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
 
-    highest_frame_place = int(np.log10(num_frames)) + 1
+    highest_frame_place = int(np.log10(max(num_frames, 1))) + 1
     error_shown = False
     count = 0
 
-    if not os.path.exists(args['output_dir']):
-        os.mkdir(args['output_dir'])
+    tracker = make_tracker(args)
 
-    writer = cv2.VideoWriter(os.path.join(args['output_dir'], args['save_name']), cv2.VideoWriter_fourcc(*'MJPG'), fps,
-                             (width, height))
+    writer = None
+    if not args['no_video']:
+        if not os.path.exists(args['output_dir']):
+            os.mkdir(args['output_dir'])
 
-    # Iterate through frames of video
-    while capture.isOpened():
-        ret, frame = capture.read()
+        writer = cv2.VideoWriter(os.path.join(args['output_dir'], args['save_name']), cv2.VideoWriter_fourcc(*'MJPG'),
+                                 fps, (width, height))
+
+    sink = None
+    if args['detections'] is not None:
+        sink = DetectionSink(args['detections'])
+
+    # Iterate through frames of video, either in stages running on their own threads, or one frame at a time.
+    run_start = time.perf_counter()
+    stages = None
+    if args['workers'] > 1:
+        count = len(track_parallel(args, num_frames, writer, highest_frame_place, sink))
+        stages = {}
+    elif args['queue_size']:
+        pipeline = TrackingPipeline(capture, args, tracker, writer, highest_frame_place, sink)
+        count = pipeline.run()
+        stages = pipeline.stage_stats()
+
+    while stages is None and capture.isOpened():
+        with profiling.stage('decode'):
+            ret, frame = capture.read()
         if not ret:
             break
 
         start = time.time()
         count += 1
 
+        with profiling.stage('detect'):
+            contours, blobs, tracks = find_contours(frame, args, tracker)
+        if sink is not None:
+            sink.write(count - 1, blobs)
+        if writer is None and args['headless']:
+            continue
+
+        frame = annotate_frame(frame, contours, tracks, count, highest_frame_place)
+        if writer is not None:
+            with profiling.stage('encode'):
+                writer.write(frame)
+
+        # Headless runs never touch the display, and go as fast as frames can be read.
+        if args['headless']:
+            continue
+
+        end = time.time()
+        time_to_run = end - start
+
+        cv2.imshow('Frame', frame)
+
+        # Try to show the image in time with the fps. If not able to, show an error.
+        if int((1/fps - time_to_run) * 1000) > 0:
+            cv2.waitKey(int((1/fps - time_to_run) * 1000))
+        else:
+            if not error_shown:
+                print("WARNING: Scene too difficult to draw with given fps. Saved video will be in correct speed.")
+                error_shown = True
+            cv2.waitKey(1)
+
+    run_time = time.perf_counter() - run_start
+    capture.release()
+    if writer is not None:
+        writer.release()
+    if sink is not None:
+        sink.release()
+
+    summary = {
+        'frames': count,
+        'time': run_time,
+        'fps': count / run_time if run_time > 0 else 0.
+    }
+    print('Tracked ' + str(count) + ' frames in ' + format(run_time, '.2f') + 's (' + format(summary['fps'], '.1f') +
+          ' fps).')
+
+    if stages:
+        summary['stages'] = stages
+        for stage in PIPELINE_STAGES:
+            print('    ' + stage + ': ' + format(stages[stage]['latency'] * 1000, '.2f') + 'ms per frame, waited ' +
+                  format(stages[stage]['stall'], '.2f') + 's on other stages')
+
+    return summary
+
+
+# Tracks a video in three stages connected by bounded queues, so reading, detecting and drawing frames overlap. A
+# decode thread reads frames, the calling thread finds their contours, and an annotate thread saves their detections to
+# sink, if any, and draws on them and writes them. Each queue has a single thread on either end, so frames stay in
+# order. Frames are never shown, so this is only used for headless runs.
+class TrackingPipeline:
+    def __init__(self, capture, args, tracker, writer, highest_frame_place, sink=None):
+        assert args['queue_size'] > 0
+
+        self.capture = capture
+        self.args = args
+        self.tracker = tracker
+        self.writer = writer
+        self.highest_frame_place = highest_frame_place
+        self.sink = sink
+
+        self.decoded = queue.Queue(maxsize=args['queue_size'])
+        self.detected = queue.Queue(maxsize=args['queue_size'])
+        self.stopped = False
+        self.errors = []
+
+        # Time each stage spent working and waiting on the other stages, and the frames it handled.
+        self.stats = {stage: {'time': 0., 'stall': 0., 'frames': 0} for stage in PIPELINE_STAGES}
+
+    # Track every frame and return how many there were. An error in any stage stops the pipeline and is raised here.
+    def run(self):
+        decoder = threading.Thread(target=self.decode_frames, daemon=True)
+        annotator = threading.Thread(target=self.annotate_frames, daemon=True)
+        decoder.start()
+        annotator.start()
+
+        count = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                item = self.decoded.get()
+                self.stats['detect']['stall'] += time.perf_counter() - start
+                if item is None or self.errors:
+                    break
+
+                count, frame = item
+                start = time.perf_counter()
+                with profiling.stage('detect'):
+                    contours, blobs, tracks = find_contours(frame, self.args, self.tracker)
+                self.add_time('detect', start)
+
+                start = time.perf_counter()
+                self.detected.put((count, frame, contours, blobs, tracks))
+                self.stats['detect']['stall'] += time.perf_counter() - start
+        finally:
+            # Let the decoder finish, even if detection failed.
+            self.stopped = True
+            while item is not None:
+                item = self.decoded.get()
+
+            self.detected.put(None)
+            decoder.join()
+            annotator.join()
+
+        if self.errors:
+            raise self.errors[0]
+
+        return count
+
+    # Runs on the decode thread. Reads frames until the video ends or the pipeline stops, then queues None. An error
+    # stops the pipeline, as it does in every stage.
+    def decode_frames(self):
+        try:
+            count = 0
+            while not self.stopped:
+                start = time.perf_counter()
+                with profiling.stage('decode'):
+                    ret, frame = self.capture.read()
+                if not ret:
+                    break
+                self.add_time('decode', start)
+
+                count += 1
+                start = time.perf_counter()
+                self.decoded.put((count, frame))
+                self.stats['decode']['stall'] += time.perf_counter() - start
+        except Exception as error:
+            self.errors.append(error)
+            self.stopped = True
+        finally:
+            self.decoded.put(None)
+
+    # Runs on the annotate thread. Draws and writes frames until detection queues None. After an error, the remaining
+    # frames are drained so detection never blocks forever.
+    def annotate_frames(self):
+        while True:
+            start = time.perf_counter()
+            item = self.detected.get()
+            self.stats['annotate']['stall'] += time.perf_counter() - start
+            if item is None:
+                return
+
+            if self.errors or (self.writer is None and self.sink is None):
+                continue
+
+            count, frame, contours, blobs, tracks = item
+            start = time.perf_counter()
+            try:
+                if self.sink is not None:
+                    self.sink.write(count - 1, blobs)
+                if self.writer is not None:
+                    frame = annotate_frame(frame, contours, tracks, count, self.highest_frame_place)
+                    with profiling.stage('encode'):
+                        self.writer.write(frame)
+            except Exception as error:
+                self.errors.append(error)
+                self.stopped = True
+            self.add_time('annotate', start)
+
+    def add_time(self, stage, start):
+        self.stats[stage]['time'] += time.perf_counter() - start
+        self.stats[stage]['frames'] += 1
+
+    # Return the time every stage spent working and waiting on the others, and how long it took per frame on average.
+    # The stage with the highest latency is the bottleneck, and the others mostly wait on it.
+    def stage_stats(self):
+        stats = {}
+        for stage in PIPELINE_STAGES:
+            stats[stage] = dict(self.stats[stage])
+            stats[stage]['latency'] = self.stats[stage]['time'] / max(self.stats[stage]['frames'], 1)
+
+        return stats
+
+
+# Track a video across args['workers'] processes, each reading its own chunk of frames after seeking to it. Workers
+# find contours and write annotated frames to their own segment, encoded with the lossless 'ffv1' codec so segments
+# take a fraction of the disk raw frames would, and the segments are joined in order into writer afterwards. Every
+# worker starts its own tracker, so a ball has a different id in every chunk. The ids are stitched together across
+# chunks with the frames the chunks overlap on, then drawn while joining. If sink is given, workers also save their
+# detections to their own file, which are appended to sink in order.
+#
+# Returns the stitched tracks of every frame, in order.
+def track_parallel(args, num_frames, writer, highest_frame_place, sink=None):
+    bounds = np.linspace(0, num_frames, min(args['workers'], max(num_frames, 1)) + 1).astype(int)
+    stem = os.path.join(args['output_dir'], args['save_name'][:-4])
+    chunks = []
+    for i in range(len(bounds) - 1):
+        segment = None if writer is None else stem + '.part' + str(i) + CODECS['ffv1'][1]
+        detections = None if sink is None else sink.path[:sink.path.rindex('.')] + '.part' + str(i) + sink.extension
+        chunks.append((args, int(bounds[i]), int(bounds[i + 1]), max(int(bounds[i]) - CHUNK_OVERLAP, 0), segment,
+                       highest_frame_place, detections))
+
+    with multiprocessing.Pool(len(chunks)) as pool:
+        results = pool.starmap(track_chunk, chunks)
+
+    # Stitch ids chunk by chunk, matching each chunk to the previous one on the frames they share.
+    all_tracks = []
+    next_id = 0
+    previous_tracks = []
+    for start, overlap_start, chunk_tracks in results:
+        overlap = start - overlap_start
+        ids, next_id = stitch_tracks(previous_tracks[len(previous_tracks) - overlap:], chunk_tracks[:overlap],
+                                     chunk_tracks[overlap:], next_id)
+        chunk_tracks = [[dict(track, id=ids[track['id']]) for track in tracks] for tracks in chunk_tracks]
+
+        all_tracks += chunk_tracks[overlap:]
+        previous_tracks = chunk_tracks
+
+    if writer is not None:
+        frame_num = 0
+        for chunk in chunks:
+            capture = open_video(chunk[4], args['fps'])
+            while True:
+                ret, frame = capture.read()
+                if not ret:
+                    break
+                writer.write(draw_tracks(frame, all_tracks[frame_num]))
+                frame_num += 1
+            capture.release()
+            os.remove(chunk[4])
+
+    if sink is not None:
+        for chunk in chunks:
+            sink.append_file(chunk[6])
+            os.remove(chunk[6])
+
+    return all_tracks
+
+
+# Track frames overlap_start up to stop of the video in a worker process of track_parallel, and write annotated frames
+# from start onwards to the 'ffv1' video at segment, and their detections to a DetectionSink at detections, unless they
+# are None. Track ids are drawn after stitching, so they are left out. Returns start, overlap_start, and the tracks of
+# every frame read.
+def track_chunk(args, start, stop, overlap_start, segment, highest_frame_place, detections=None):
+    capture = open_video(args['path'], args['fps'])
+    assert capture.isOpened() and "Error opening video. Could be a multitude of problems, but likely corruption."
+    capture.set(cv2.CAP_PROP_POS_FRAMES, overlap_start)
+
+    writer = None
+    if segment is not None:
+        writer = open_writer(segment, 'ffv1', args['fps'], (int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                                                             int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))))
+
+    sink = None
+    if detections is not None:
+        sink = DetectionSink(detections)
+
+    tracker = make_tracker(args)
+    chunk_tracks = []
+    for frame_num in range(overlap_start, stop):
+        ret, frame = capture.read()
+        if not ret:
+            break
+
+        contours, blobs, tracks = find_contours(frame, args, tracker)
+        chunk_tracks.append(tracks)
+        if frame_num < start:
+            continue
+
+        if sink is not None:
+            sink.write(frame_num, blobs)
+        if writer is not None:
+            writer.write(annotate_frame(frame, contours, [], frame_num + 1, highest_frame_place))
+
+    capture.release()
+    if writer is not None:
+        writer.release()
+    if sink is not None:
+        sink.release()
+
+    return start, overlap_start, chunk_tracks
+
+
+# Give the tracks of a chunk ids that carry on from the previous chunk. previous and overlap are the tracks of the
+# frames the chunks share, as seen by the previous chunk and by this one, and rest is the tracks of this chunk after
+# them. Pairs of tracks of the same color are matched nearest first by their median distance over the shared frames,
+# if it is within STITCH_DISTANCE. Tracks that aren't matched get new ids starting from next_id.
+#
+# Returns a dictionary from the ids of this chunk to the stitched ids, and the next unused id.
+def stitch_tracks(previous, overlap, rest, next_id):
+    distances = {}
+    for previous_tracks, tracks in zip(previous, overlap):
+        for track in tracks:
+            for previous_track in previous_tracks:
+                if track['color'] != previous_track['color']:
+                    continue
+
+                distance = math.hypot(track['centroid'][0] - previous_track['centroid'][0],
+                                      track['centroid'][1] - previous_track['centroid'][1])
+                distances.setdefault((track['id'], previous_track['id']), []).append(distance)
+
+    pairs = sorted([(float(np.median(pair_distances)), pair) for pair, pair_distances in distances.items()])
+    ids = {}
+    for distance, (track_id, previous_id) in pairs:
+        if distance <= STITCH_DISTANCE and track_id not in ids and previous_id not in ids.values():
+            ids[track_id] = previous_id
+
+    for tracks in overlap + rest:
+        for track in tracks:
+            if track['id'] not in ids:
+                ids[track['id']] = next_id
+                next_id += 1
+
+    return ids, next_id
+
+
+# Make the tracker selected by args['tracking'], or None when every frame is searched in full. A color table has to
+# last from frame to frame, so with one every frame is searched in full by a RegionTracker that always does full scans.
+def make_tracker(args):
+    pyramid_factor = args['pyramid_factor'] if args['segmentation'] == 'pyramid' else None
+    color_table = ColorTable(args['tolerance']) if args['color_table'] else None
+    if args['tracking'] == 'roi':
+        return RegionTracker(args['tolerance'], args['background_color'], args['roi_padding'],
+                             args['full_scan_interval'], pyramid_factor, color_table)
+    elif args['tracking'] == 'physics':
+        return PhysicsTracker(args['tolerance'], args['background_color'], args['roi_padding'],
+                              args['full_scan_interval'], pyramid_factor, color_table)
+    elif color_table is not None:
+        return RegionTracker(args['tolerance'], args['background_color'], args['roi_padding'], 1, pyramid_factor,
+                             color_table)
+
+    return None
+
+
+# Find the contours in a frame with the segmentation and tracker selected by args. Returns the contours, the stats of
+# every blob as per label_contours, and the tracks of a PhysicsTracker, which are empty for other trackers. The color
+# segmentation only finds contours, so its blobs are worked out from them when they are being saved.
+def find_contours(frame, args, tracker):
+    if args['tracking'] == 'physics':
+        contours, tracks = tracker.track(frame)
+        return contours, tracker.blobs, tracks
+    elif tracker is not None:
+        return tracker.detect(frame) + ([],)
+    elif args['segmentation'] == 'label':
+        return label_contours(frame, args['tolerance'], args['background_color']) + ([],)
+    elif args['segmentation'] == 'pyramid':
+        return pyramid_contours(frame, args['tolerance'], args['background_color'], args['pyramid_factor']) + ([],)
+
+    contours = distinct_contours(frame, args['tolerance'], args['background_color'])
+    blobs = []
+    if args['detections'] is not None:
+        blobs = contour_blobs(frame, contours)
+
+    return contours, blobs, []
+
+
+# Work out blob stats as per label_contours from contours found by distinct_contours. Each contour runs along the edge
+# of its blob, so the color under its first point is the color of the blob. The area is that of the contour.
+def contour_blobs(frame, contours):
+    blobs = []
+    for contour in contours:
+        moments = cv2.moments(contour)
+        if moments['m00'] == 0:
+            continue
+
+        x, y = contour[0, 0]
+        blobs.append(blob_stats(frame[y, x], moments['m00'], (moments['m10'] / moments['m00'],
+                                                             moments['m01'] / moments['m00']),
+                                cv2.boundingRect(contour), contour))
+
+    return blobs
+
+
+# Draw the contours, track ids, a thumbnail of the original frame and the frame number onto frame.
+def annotate_frame(frame, contours, tracks, count, highest_frame_place):
+    with profiling.stage('draw'):
         # Copy the original image, resized. Add a border.
         thumbnail = frame[::THUMBNAIL_FACTOR, ::THUMBNAIL_FACTOR].copy()
         thumbnail[:, :2] = THUMBNAIL_COLOR
@@ -51,32 +507,435 @@ def main():
         thumbnail[-2:] = THUMBNAIL_COLOR
         thumbnail[:2] = THUMBNAIL_COLOR
 
-        # Find contours and draw them.
-        contours = distinct_contours(frame, args['tolerance'], args['background_color'])
+        # Draw the contours and label the tracks.
         frame = cv2.drawContours(frame, contours, -1, BORDER_COLOR, 2)
+        frame = draw_tracks(frame, tracks)
 
         # Added thumbnail and frame number to video.
         frame[:thumbnail.shape[0], :thumbnail.shape[1]] = thumbnail
         frame = cv2.putText(frame, str(count).zfill(highest_frame_place), (0, frame.shape[0] - 5),
                             cv2.FONT_HERSHEY_SIMPLEX, 1, color=THUMBNAIL_COLOR)
 
-        writer.write(frame)
+    return frame
 
-        end = time.time()
-        time_to_run = end - start
 
-        cv2.imshow('Frame', frame)
+# Write the id of every track at its centroid.
+def draw_tracks(frame, tracks):
+    for track in tracks:
+        frame = cv2.putText(frame, str(track['id']), (int(track['centroid'][0]), int(track['centroid'][1])),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.5, color=TRACK_ID_COLOR)
 
-        # Try to show the image in time with the fps. If not able to, show an error.
-        if int((1/fps - time_to_run) * 1000) > 0:
-            cv2.waitKey(int((1/fps - time_to_run) * 1000))
+    return frame
+
+
+# Reads frames from a .npy frame store written by generate_ball with --codec npy, with the parts of the
+# cv2.VideoCapture interface that main uses. Frames are memory-mapped, so nothing is decoded.
+class FrameStoreCapture:
+    def __init__(self, path, fps):
+        self.frames = np.load(path, mmap_mode='r')
+        assert self.frames.ndim == 4 and self.frames.shape[-1] == 3
+
+        self.fps = fps
+        self.position = 0
+
+    def isOpened(self):
+        return self.frames is not None
+
+    # Return a copy of the next frame, since main draws on it.
+    def read(self):
+        if self.frames is None or self.position >= len(self.frames):
+            return False, None
+
+        frame = np.array(self.frames[self.position])
+        self.position += 1
+        return True, frame
+
+    def get(self, prop):
+        properties = {
+            cv2.CAP_PROP_FPS: self.fps,
+            cv2.CAP_PROP_FRAME_HEIGHT: self.frames.shape[1],
+            cv2.CAP_PROP_FRAME_WIDTH: self.frames.shape[2],
+            cv2.CAP_PROP_FRAME_COUNT: self.frames.shape[0],
+            cv2.CAP_PROP_POS_FRAMES: self.position
+        }
+
+        return properties[prop]
+
+    # Only seeking with cv2.CAP_PROP_POS_FRAMES is supported.
+    def set(self, prop, value):
+        if prop != cv2.CAP_PROP_POS_FRAMES:
+            return False
+
+        self.position = int(value)
+        return True
+
+    def release(self):
+        self.frames = None
+
+
+# Finds blobs with label_contours, but only searches padded regions around the blobs found last frame, so the cost of a
+# frame follows the area of the balls rather than the frame. The whole frame is scanned on the first frame, every
+# full_scan_interval frames to catch balls entering the frame, and whenever a region search loses a blob or finds one
+# cut off by the edge of its region. Full scans use pyramid_contours if pyramid_factor is given. Colors are grouped
+# with color_table, if given, so they are only grouped once for the whole video.
+class RegionTracker:
+    def __init__(self, tolerance, bg_color, padding=ROI_PADDING, full_scan_interval=FULL_SCAN_INTERVAL,
+                 pyramid_factor=None, color_table=None):
+        assert tolerance >= 0
+        assert padding >= 0
+        assert full_scan_interval >= 1
+        assert pyramid_factor is None or pyramid_factor >= 1
+        assert color_table is None or color_table.tolerance == tolerance
+
+        self.tolerance = tolerance
+        self.bg_color = bg_color
+        self.padding = padding
+        self.full_scan_interval = full_scan_interval
+        self.pyramid_factor = pyramid_factor
+        self.color_table = color_table
+
+        self.blobs = None
+        self.frames_since_scan = 0
+        self.full_scans = 0
+        self.region_scans = 0
+
+    # Find the contours and blob stats of a frame, the same as label_contours.
+    def detect(self, frame):
+        self.frames_since_scan += 1
+
+        if self.blobs is not None and self.frames_since_scan < self.full_scan_interval:
+            found = self.search_regions(frame)
+            if found is not None:
+                self.region_scans += 1
+                self.blobs = found[1]
+                return found
+
+        self.full_scans += 1
+        self.frames_since_scan = 0
+        if self.pyramid_factor is not None:
+            contours, self.blobs = pyramid_contours(frame, self.tolerance, self.bg_color, self.pyramid_factor,
+                                                    self.color_table)
         else:
-            if not error_shown:
-                print("WARNING: Scene too difficult to draw with given fps. Saved video will be in correct speed.")
-                error_shown = True
-            cv2.waitKey(1)
+            contours, self.blobs = label_contours(frame, self.tolerance, self.bg_color,
+                                                  color_table=self.color_table)
+        return contours, self.blobs
+
+    # Search the regions around the last blobs. Returns None if the frame has to be scanned in full instead.
+    def search_regions(self, frame):
+        height, width = frame.shape[:2]
+        all_contours = []
+        all_blobs = []
+
+        for region in self.get_regions(width, height):
+            x, y, region_width, region_height = region
+            contours, blobs = label_contours(frame[y:y + region_height, x:x + region_width], self.tolerance,
+                                             self.bg_color, (x, y), color_table=self.color_table)
+
+            if any([on_region_edge(blob, region, width, height) for blob in blobs]):
+                return None
+
+            all_contours += contours
+            all_blobs += blobs
+
+        if len(all_blobs) < len(self.blobs):
+            return None
+
+        return all_contours, all_blobs
+
+    # Regions to search as (x, y, width, height): the bounding box of every last blob, padded and clipped to the frame.
+    # Overlapping regions are merged so no blob is found twice.
+    def get_regions(self, width, height):
+        regions = [(blob['bbox'][0] - self.padding, blob['bbox'][1] - self.padding,
+                    blob['bbox'][0] + blob['bbox'][2] + self.padding, blob['bbox'][1] + blob['bbox'][3] + self.padding)
+                   for blob in self.blobs]
+
+        return [(x, y, x_end - x, y_end - y) for x, y, x_end, y_end in merge_regions(regions, width, height)]
+
+
+# Follows balls from frame to frame with persistent ids. Each ball is a Track, whose motion is predicted with the same
+# model that generated the video, so only a small window around each prediction is searched and a ball keeps its id
+# while it is hidden or crosses a ball of the same color. Blobs that no track explains start new tracks.
+class PhysicsTracker(RegionTracker):
+    def __init__(self, tolerance, bg_color, padding=ROI_PADDING, full_scan_interval=FULL_SCAN_INTERVAL,
+                 pyramid_factor=None, color_table=None, max_misses=MAX_MISSES):
+        super().__init__(tolerance, bg_color, padding, full_scan_interval, pyramid_factor, color_table)
+
+        assert max_misses >= 0
+        self.max_misses = max_misses
+
+        self.tracks = []
+        self.next_id = 0
+        self.frame_size = None
+
+    # Find the contours of a frame and the state of every track after it, as a list of dictionaries with the keys
+    # ['id', 'color', 'centroid', 'major', 'minor', 'misses'].
+    def track(self, frame):
+        height, width = frame.shape[:2]
+        self.frame_size = (width, height)
+
+        for track in self.tracks:
+            track.predict()
+
+        contours, blobs = self.detect(frame)
+        self.associate(blobs)
+
+        return contours, [track.get_info(height) for track in self.tracks]
+
+    # Match blobs to the tracks predicted closest to them, nearest pairs first. Only blobs of the track's color and
+    # within its predicted size plus padding of its prediction are considered.
+    def associate(self, blobs):
+        width, height = self.frame_size
+        predictions = [track.get_info(height, predicted=True) for track in self.tracks]
 
-    writer.release()
+        pairs = []
+        for i, prediction in enumerate(predictions):
+            gate = max(prediction['major'], prediction['minor']) + self.padding
+            for j, blob in enumerate(blobs):
+                if np.any(np.abs(np.array(blob['color']) - prediction['color']) > self.tolerance):
+                    continue
+
+                distance = math.hypot(blob['centroid'][0] - prediction['centroid'][0],
+                                      blob['centroid'][1] - prediction['centroid'][1])
+                if distance <= gate:
+                    pairs.append((distance, i, j))
+
+        # Blobs touching another blob are partly hidden behind it, or are two balls of the same color merged together.
+        touching = [any([overlaps(blob['bbox'], other['bbox']) for other in blobs if other is not blob])
+                    for blob in blobs]
+
+        matched_tracks = set()
+        matched_blobs = set()
+        for distance, i, j in sorted(pairs):
+            if i in matched_tracks or j in matched_blobs:
+                continue
+
+            matched_tracks.add(i)
+            matched_blobs.add(j)
+
+            # A hidden or merged ball has a misleading centroid, so it only confirms the track is still there. The
+            # area of a drawn ellipse includes its outline, hence the half pixel added to each axis.
+            prediction = predictions[i]
+            area = blobs[j]['area'] / (math.pi * (prediction['major'] + 0.5) * (prediction['minor'] + 0.5))
+            if touching[j] or not OCCLUSION_RATIO <= area <= 1 / OCCLUSION_RATIO:
+                self.tracks[i].coast(hidden=True)
+            else:
+                self.tracks[i].update(blobs[j], height)
+
+        # Tracks nobody saw keep moving as predicted until they leave the frame or have been missing for too long.
+        tracks = []
+        for i, track in enumerate(self.tracks):
+            if i not in matched_tracks:
+                track.coast()
+
+            x = track.ball.x
+            if track.misses <= self.max_misses and -track.ball.radius <= x <= width + track.ball.radius:
+                tracks.append(track)
+
+        acceleration = self.get_acceleration()
+        for j, blob in enumerate(blobs):
+            if j not in matched_blobs:
+                tracks.append(Track(self.next_id, blob, height, acceleration))
+                self.next_id += 1
+
+        self.tracks = tracks
+
+    # Every ball falls with the same acceleration, so new tracks start from what the others have measured.
+    def get_acceleration(self):
+        accelerations = [track.acceleration for track in self.tracks if track.acceleration is not None]
+        if not accelerations:
+            return None
+
+        return float(np.median(accelerations))
+
+    # Search around the predicted position of every track instead of last frame's blobs.
+    def get_regions(self, width, height):
+        regions = []
+        for track in self.tracks:
+            prediction = track.get_info(height, predicted=True)
+            x, y = prediction['centroid']
+            x_pad = prediction['major'] + self.padding
+            y_pad = prediction['minor'] + self.padding
+            regions.append((int(x - x_pad), int(y - y_pad), int(math.ceil(x + x_pad)) + 1,
+                            int(math.ceil(y + y_pad)) + 1))
+
+        return [(x, y, x_end - x, y_end - y) for x, y, x_end, y_end in merge_regions(regions, width, height)]
+
+
+# One ball followed by PhysicsTracker. The ball is modelled with generate_ball.Ball in units of pixels and frames, with
+# y measured up from the bottom of the frame like the generator. Its radius comes from the area of the blob, since
+# deformation preserves major * minor, and its velocity and acceleration are fit to where it has been seen since its
+# last bounce. How far it deforms is learnt from the first bounce it is seen making.
+class Track:
+    def __init__(self, track_id, blob, frame_height, acceleration=None):
+        major, minor = get_blob_axes(blob)
+        radius = max(math.sqrt(major * minor), 1)
+
+        self.id = track_id
+        self.color = blob['color']
+        self.ball = Ball({
+            'color': list(blob['color']),
+            'radius': radius,
+            'starting_height': radius + 1,
+            'deformation': 0,
+            'hor_vel': 0
+        })
+
+        self.acceleration = acceleration
+        self.fit_frames = 0
+        self.prediction = None
+        self.bounced = False
+
+        self.age = 0
+        self.misses = 0
+        self.min_minor = None
+        self.x_history = []
+        self.y_history = []
+        self.observe(blob, frame_height)
+
+    # Predict the ball one frame ahead. Until its acceleration is known, the ball is assumed to keep its velocity.
+    def predict(self):
+        self.age += 1
+        self.prediction = copy.copy(self.ball)
+
+        if self.acceleration is None:
+            self.prediction.x += self.prediction.hor_vel
+            self.prediction.y = max(self.prediction.y + self.prediction.ver_vel, self.ball.radius)
+            self.bounced = False
+        else:
+            self.bounced = self.prediction.nextFrame(self.acceleration, 1)[1]
+
+    # Move the ball to its prediction without a measurement to correct it.
+    def coast(self, hidden=False):
+        self.ball = self.prediction
+        if self.bounced:
+            self.y_history = []
+        if not hidden:
+            self.misses += 1
+
+    # Correct the ball with the blob matched to it this frame.
+    def update(self, blob, frame_height):
+        # Until the acceleration is known the prediction is only rough, so it can't tell if the ball bounced.
+        x, y = blob['centroid'][0], frame_height - blob['centroid'][1]
+        if self.bounced or (self.acceleration is not None and
+                            math.hypot(self.prediction.x - x, self.prediction.y - y) > RESET_DISTANCE):
+            self.y_history = []
+
+        self.ball = self.prediction
+        self.misses = 0
+        self.observe(blob, frame_height)
+
+    # Record where the blob was seen and fit the motion of the ball to it.
+    def observe(self, blob, frame_height):
+        major, minor = get_blob_axes(blob)
+        x, y = blob['centroid'][0], frame_height - blob['centroid'][1]
+        radius = self.ball.radius
+
+        # Horizontal velocity never changes, so it is fit to every position seen.
+        self.x_history = self.x_history[-FIT_FRAMES * 4 + 1:] + [(self.age, x)]
+        self.ball.x = x
+        if len(self.x_history) >= 2:
+            times, positions = np.array(self.x_history).T
+            self.ball.hor_vel = float(np.polyfit(times, positions, 1)[0])
+
+        # While deforming against the ground, the model carries on with the bounce and the deepest point is recorded.
+        # The bottom row of a deforming ball is just below the frame, so it is added back to the minor axis.
+        if major - minor >= SQUASH_THRESHOLD and blob['bbox'][1] + blob['bbox'][3] >= frame_height:
+            minor = blob['bbox'][3] / 2
+            self.min_minor = minor if self.min_minor is None else min(self.min_minor, minor)
+            self.y_history = []
+            return
+
+        # Frames rarely land on the deepest point of a bounce, so the deepest bounce seen is the best estimate.
+        if self.min_minor is not None and radius > 1:
+            deformation = float(np.clip((radius - self.min_minor) / (radius - 1), 0, 1))
+            self.ball.deformation = max(self.ball.deformation, deformation)
+            self.min_minor = None
+
+        self.y_history.append((self.age, y))
+        times, positions = np.array(self.y_history).T
+        times = times - self.age
+
+        # Acceleration never changes either, so it is only fit again from a longer flight than it was last fit from.
+        if len(self.y_history) >= max(FIT_FRAMES, self.fit_frames):
+            curve = np.polyfit(times, positions, 2)[0]
+            if curve < 0:
+                self.acceleration = float(2 * curve)
+                self.fit_frames = len(self.y_history)
+
+        # Remove the known acceleration, if any, and fit the velocity to what is left.
+        if len(self.y_history) >= 2:
+            if self.acceleration is not None:
+                positions = positions - self.acceleration * times ** 2 / 2
+            ver_vel, y = np.polyfit(times, positions, 1)
+            self.ball.ver_vel = float(ver_vel)
+
+        # The ball was seen in the air, so keep the model out of its deformation phase.
+        self.ball.y = max(float(y), float(np.nextafter(radius, np.inf)))
+
+    # Return the id, color, centroid in image coordinates and axes of the ball, either now or as predicted for the
+    # next frame.
+    def get_info(self, frame_height, predicted=False):
+        ball = self.prediction if predicted else self.ball
+        minor = max(min(ball.y, ball.radius), 1)
+
+        return {
+            'id': self.id,
+            'color': self.color,
+            'centroid': (ball.x, frame_height - ball.y),
+            'major': (ball.radius ** 2) / minor,
+            'minor': minor,
+            'misses': self.misses
+        }
+
+
+# Whether two bounding boxes given as (x, y, width, height) overlap or touch.
+def overlaps(a, b):
+    return a[0] <= b[0] + b[2] and b[0] <= a[0] + a[2] and a[1] <= b[1] + b[3] and b[1] <= a[1] + a[3]
+
+
+# Estimate the axes of the ellipse a blob was drawn as from its bounding box.
+def get_blob_axes(blob):
+    return (blob['bbox'][2] - 1) / 2, (blob['bbox'][3] - 1) / 2
+
+
+# Whether a blob found in a region of (x, y, width, height) touches an edge of the region that isn't an edge of the
+# frame, in which case it may continue outside of the region.
+def on_region_edge(blob, region, width, height):
+    blob_x, blob_y, blob_width, blob_height = blob['bbox']
+    x, y, region_width, region_height = region
+
+    return (blob_x == x > 0) or (blob_y == y > 0) or (blob_x + blob_width == x + region_width < width) or \
+        (blob_y + blob_height == y + region_height < height)
+
+
+# Merge regions given as (x_start, y_start, x_end, y_end) until none overlap, after clipping them to the frame.
+def merge_regions(regions, width, height):
+    regions = [(max(x, 0), max(y, 0), min(x_end, width), min(y_end, height)) for x, y, x_end, y_end in regions]
+    regions = [region for region in regions if region[0] < region[2] and region[1] < region[3]]
+
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(regions)):
+            for j in range(i + 1, len(regions)):
+                a, b = regions[i], regions[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    regions[i] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                    del regions[j]
+                    merged = True
+                    break
+            if merged:
+                break
+
+    return regions
+
+
+# Open a video to read frames from. .npy frame stores don't record their fps, so it has to be given.
+def open_video(path, fps):
+    if path[-4:] == '.npy':
+        return FrameStoreCapture(path, fps)
+
+    return cv2.VideoCapture(path)
 
 
 # Goal is to find the contours of all blobs of color present in the frame.
@@ -90,13 +949,15 @@ def distinct_contours(img, tolerance, bg_color):
     # img = cv2.GaussianBlur(img, (5, 5), 0)
 
     # Filter out background with tolerance.
-    bg_high = np.clip(bg_color.astype('int') + tolerance, 0, 255).astype('uint8')
-    bg_low = np.clip(bg_color.astype('int') - tolerance, 0, 255).astype('uint8')
-    mask = cv2.bitwise_not(cv2.inRange(img, bg_low, bg_high))
-    img = cv2.bitwise_and(img, img, mask=mask)
+    with profiling.stage('mask'):
+        bg_high = np.clip(bg_color.astype('int') + tolerance, 0, 255).astype('uint8')
+        bg_low = np.clip(bg_color.astype('int') - tolerance, 0, 255).astype('uint8')
+        mask = cv2.bitwise_not(cv2.inRange(img, bg_low, bg_high))
+        img = cv2.bitwise_and(img, img, mask=mask)
 
     # Find unique colors from all remaining pixels. These are our potential balls colors.
-    unique_colors, unique_counts = np.unique(img[mask.astype('bool')], return_counts=True, axis=0)
+    with profiling.stage('unique_colors'):
+        unique_colors, unique_counts = count_colors(img[mask.astype('bool')])
 
     all_contours = []
     while len(unique_colors):
@@ -105,11 +966,13 @@ def distinct_contours(img, tolerance, bg_color):
         color = unique_colors[color_ind].astype('int')
         color_high = np.clip(color + tolerance, 0, 255).astype('uint8')
         color_low = np.clip(color - tolerance, 0, 255).astype('uint8')
-        mask = cv2.inRange(img, color_low, color_high)
+        with profiling.stage('mask'):
+            mask = cv2.inRange(img, color_low, color_high)
 
         # We then find contours with a minimum area and record them.
-        contours, hierarchy = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-        contours = [contour for contour in contours if cv2.contourArea(contour) > CONTOUR_THRESHOLD]
+        with profiling.stage('find_contours'):
+            contours, hierarchy = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+            contours = [contour for contour in contours if cv2.contourArea(contour) > CONTOUR_THRESHOLD]
 
         # Finally, we remove colors that fall within the tolerance of the currently iterated color.
         valid_inds = cv2.inRange(unique_colors.reshape(-1, 1, 3), color_low, color_high)
@@ -121,6 +984,408 @@ def distinct_contours(img, tolerance, bg_color):
     return all_contours
 
 
+# Goal is the same as distinct_contours, but every blob is found in a single pass over the frame. Foreground colors are
+# grouped into clusters the same way distinct_contours picks them, every pixel is labelled with its cluster, and blobs
+# are pulled out with one connected components pass. Components where balls of different clusters touch are split
+# again inside their bounding box. Returns the contours in the same format as distinct_contours, and a dictionary for
+# every blob with its cluster 'color', pixel 'area', 'centroid', bounding box 'bbox' as (x, y, width, height) and outer
+# 'contour'. offset is added to every position, for when img is a region of a larger frame. seeds are colors that start
+# clusters before any others, as per group_colors. If a ColorTable is given instead, pixels are labelled with the
+# clusters it has kept from earlier frames.
+#
+# Unlike distinct_contours, a color within tolerance of two clusters only belongs to the first, so blobs never overlap.
+def label_contours(img, tolerance, bg_color, offset=(0, 0), seeds=None, color_table=None):
+    assert type(img) is np.ndarray and len(img.shape) == 3 and img.shape[-1] == 3
+    assert tolerance >= 0
+    assert (type(bg_color) is list or type(bg_color) is np.ndarray) and len(bg_color) == 3
+
+    # Filter out background with tolerance.
+    foreground = foreground_mask(img, tolerance, bg_color)
+    is_foreground = foreground.astype('bool')
+
+    # Group the foreground colors, then label every foreground pixel with its cluster. Labels start from 1 so the
+    # background stays 0.
+    with profiling.stage('unique_colors'):
+        pixels = img[is_foreground]
+        if color_table is not None:
+            assert color_table.tolerance == tolerance
+            pixel_clusters = color_table.classify(pixels) + 1
+            cluster_colors = color_table.colors
+        else:
+            unique_colors, unique_counts = count_colors(pixels)
+            cluster_colors, color_clusters = group_colors(unique_colors, unique_counts, tolerance, seeds)
+            pixel_clusters = color_clusters[np.searchsorted(pack_colors(unique_colors), pack_colors(pixels))] + 1
+
+    clusters = np.zeros(img.shape[:2], dtype=np.int32)
+    clusters[is_foreground] = pixel_clusters
+
+    # Find every connected piece of foreground, and which clusters each piece is made of.
+    num_components, components, stats, centroids = cv2.connectedComponentsWithStats(foreground, connectivity=8)
+    component_clusters = np.bincount(components[is_foreground] * (len(cluster_colors) + 1) + pixel_clusters,
+                                     minlength=num_components * (len(cluster_colors) + 1))
+    component_clusters = component_clusters.reshape(num_components, -1)[:, 1:]
+
+    offset_x, offset_y = offset
+    all_contours = []
+    blobs = []
+    for component in range(1, num_components):
+        x, y, width, height, area = stats[component]
+        in_component = components[y:y + height, x:x + width] == component
+        present = np.flatnonzero(component_clusters[component])
+
+        # Most components are a single ball, and already have their stats.
+        if len(present) == 1:
+            contours = mask_contours(in_component, offset_x + x, offset_y + y)
+            if contours:
+                all_contours += contours
+                blobs.append(blob_stats(cluster_colors[present[0]], area, centroids[component] + offset,
+                                        (offset_x + x, offset_y + y, width, height), outer_contour(contours)))
+            continue
+
+        # Otherwise, split the component into the connected pieces of each of its clusters.
+        in_clusters = clusters[y:y + height, x:x + width]
+        for cluster in present:
+            mask = (in_component & (in_clusters == cluster + 1)).astype('uint8')
+            num_pieces, pieces, piece_stats, piece_centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+
+            for piece in range(1, num_pieces):
+                piece_x, piece_y, piece_width, piece_height, piece_area = piece_stats[piece]
+                in_piece = pieces[piece_y:piece_y + piece_height, piece_x:piece_x + piece_width] == piece
+                piece_x += offset_x + x
+                piece_y += offset_y + y
+
+                contours = mask_contours(in_piece, piece_x, piece_y)
+                if contours:
+                    all_contours += contours
+                    blobs.append(blob_stats(cluster_colors[cluster], piece_area,
+                                            piece_centroids[piece] + (offset_x + x, offset_y + y),
+                                            (piece_x, piece_y, piece_width, piece_height), outer_contour(contours)))
+
+    return all_contours, blobs
+
+
+# Mask of the pixels of img that aren't within tolerance of the background color.
+def foreground_mask(img, tolerance, bg_color):
+    with profiling.stage('mask'):
+        bg_color = np.array(bg_color)
+        bg_high = np.clip(bg_color.astype('int') + tolerance, 0, 255).astype('uint8')
+        bg_low = np.clip(bg_color.astype('int') - tolerance, 0, 255).astype('uint8')
+
+        return cv2.bitwise_not(cv2.inRange(img, bg_low, bg_high))
+
+
+# Goal is the same as label_contours, but blobs and their colors are found on the frame downsampled by factor first, by
+# taking every factor-th pixel like the thumbnail, and contours are then found at full resolution only around them.
+# Each region is padded by factor px, since that's as far as a blob can reach past where it shows in the downsampled
+# frame. If a blob reaches the edge of its region anyway, the whole frame is labelled instead. Balls less than factor
+# px across can fall between the sampled pixels and be missed, which compare_blobs can measure. color_table is passed
+# on to label_contours.
+def pyramid_contours(img, tolerance, bg_color, factor=THUMBNAIL_FACTOR, color_table=None):
+    assert type(factor) is int and factor >= 1
+
+    # Find the connected pieces of foreground in the downsampled frame. Pieces are kept however small, since a ball may
+    # only cover a few sampled pixels.
+    small = img[::factor, ::factor]
+    foreground = foreground_mask(small, tolerance, bg_color)
+    num_components, components, stats, centroids = cv2.connectedComponentsWithStats(foreground, connectivity=8)
+
+    # Every cluster found downsampled starts a cluster at full resolution, so colors are grouped the same everywhere. A
+    # color table already groups them the same everywhere.
+    seeds = None
+    if color_table is None:
+        unique_colors, unique_counts = count_colors(small[foreground.astype('bool')])
+        seeds = group_colors(unique_colors, unique_counts, tolerance)[0]
+
+    height, width = img.shape[:2]
+    regions = merge_regions([((x - 1) * factor, (y - 1) * factor, (x + region_width + 1) * factor,
+                              (y + region_height + 1) * factor)
+                             for x, y, region_width, region_height, area in stats[1:].tolist()], width, height)
+
+    all_contours = []
+    all_blobs = []
+    for x, y, x_end, y_end in regions:
+        contours, blobs = label_contours(img[y:y_end, x:x_end], tolerance, bg_color, (x, y), seeds, color_table)
+        if any([on_region_edge(blob, (x, y, x_end - x, y_end - y), width, height) for blob in blobs]):
+            return label_contours(img, tolerance, bg_color, color_table=color_table)
+
+        all_contours += contours
+        all_blobs += blobs
+
+    return all_contours, all_blobs
+
+
+# Compare blobs to reference blobs found in the same frame, such as those of pyramid_contours to those of
+# label_contours. Each blob is paired with the nearest unpaired reference blob of the same color within the size of the
+# reference blob. Returns the number of 'matched', 'missed' and 'extra' blobs, and the mean and largest 'centroid_error'
+# in px and relative 'area_error' of the matched pairs.
+def compare_blobs(blobs, reference):
+    pairs = []
+    for i, blob in enumerate(blobs):
+        for j, reference_blob in enumerate(reference):
+            distance = math.hypot(blob['centroid'][0] - reference_blob['centroid'][0],
+                                  blob['centroid'][1] - reference_blob['centroid'][1])
+            if blob['color'] == reference_blob['color'] and distance <= max(reference_blob['bbox'][2:]):
+                pairs.append((distance, i, j))
+
+    centroid_errors = []
+    area_errors = []
+    paired_blobs = set()
+    paired_reference = set()
+    for distance, i, j in sorted(pairs):
+        if i in paired_blobs or j in paired_reference:
+            continue
+
+        paired_blobs.add(i)
+        paired_reference.add(j)
+        centroid_errors.append(distance)
+        area_errors.append(abs(blobs[i]['area'] - reference[j]['area']) / reference[j]['area'])
+
+    return {
+        'matched': len(centroid_errors),
+        'missed': len(reference) - len(paired_reference),
+        'extra': len(blobs) - len(paired_blobs),
+        'centroid_error': float(np.mean(centroid_errors)) if centroid_errors else 0.,
+        'max_centroid_error': max(centroid_errors, default=0.),
+        'area_error': float(np.mean(area_errors)) if area_errors else 0.,
+        'max_area_error': max(area_errors, default=0.)
+    }
+
+
+# Remembers the cluster of every color it has seen, in a lookup table indexed by the color packed as per pack_colors, so
+# a video's colors are grouped once rather than every frame. The table is only filled in as colors show up: colors not
+# seen before are grouped as per group_colors, with the clusters found so far starting first, so a color is never
+# moved to another cluster and cluster ids stay the same for the whole video. The table takes 64MB, and is allocated
+# the first time it is used.
+class ColorTable:
+    def __init__(self, tolerance):
+        assert tolerance >= 0
+
+        self.tolerance = tolerance
+        self.table = None
+        self.colors = np.empty((0, 3), dtype=np.uint8)
+
+    # The cluster of each of an (n, 3) array of uint8 pixels.
+    def classify(self, pixels):
+        if self.table is None:
+            self.table = np.full(1 << 24, -1, dtype=np.int32)
+
+        keys = pack_colors(pixels)
+        clusters = self.table[keys]
+
+        unseen = clusters < 0
+        if np.any(unseen):
+            unique_colors, unique_counts = count_colors(pixels[unseen])
+            cluster_colors, color_clusters = group_colors(unique_colors, unique_counts, self.tolerance, self.colors)
+            self.colors = np.concatenate([self.colors, cluster_colors[len(self.colors):]])
+            self.table[pack_colors(unique_colors)] = color_clusters
+            clusters[unseen] = self.table[keys[unseen]]
+
+        return clusters
+
+
+# Group colors into clusters the way distinct_contours does: the color with the most pixels starts a cluster, and takes
+# every remaining color within tolerance of it. If seeds are given, each of them starts a cluster first, in order.
+# Returns the color that started each cluster, and the cluster of each of the given colors.
+def group_colors(colors, counts, tolerance, seeds=None):
+    color_clusters = np.full(len(colors), -1)
+    cluster_colors = []
+
+    remaining = np.ones(len(colors), dtype='bool')
+    seeds = [] if seeds is None else list(seeds)
+    while np.any(remaining):
+        if seeds:
+            color = np.array(seeds.pop(0))
+        else:
+            color = colors[np.argmax(np.where(remaining, counts, -1))]
+        color_high = np.clip(color.astype('int') + tolerance, 0, 255)
+        color_low = np.clip(color.astype('int') - tolerance, 0, 255)
+
+        in_cluster = remaining & np.all((color_low <= colors) & (colors <= color_high), axis=1)
+        color_clusters[in_cluster] = len(cluster_colors)
+        cluster_colors.append(color)
+        remaining &= ~in_cluster
+
+    return np.array(cluster_colors, dtype=colors.dtype).reshape(-1, 3), color_clusters
+
+
+# Find the contours of a boolean mask whose top left corner is at (x, y) in the frame, with a minimum area. The mask is
+# padded so contours touching its edge are traced the same as in the full frame.
+def mask_contours(mask, x, y):
+    with profiling.stage('find_contours'):
+        mask = cv2.copyMakeBorder(mask.astype('uint8'), 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
+        contours, hierarchy = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE,
+                                               offset=(int(x) - 1, int(y) - 1))
+
+        return [contour for contour in contours if cv2.contourArea(contour) > CONTOUR_THRESHOLD]
+
+
+def blob_stats(color, area, centroid, bbox, contour):
+    return {
+        'color': [int(channel) for channel in color],
+        'area': area.item() if type(area) is np.ndarray or isinstance(area, np.generic) else area,
+        'centroid': (float(centroid[0]), float(centroid[1])),
+        'bbox': tuple(int(value) for value in bbox),
+        'contour': contour
+    }
+
+
+# The outer contour of a blob is the one with the largest area, since it surrounds any holes.
+def outer_contour(contours):
+    return max(contours, key=cv2.contourArea)
+
+
+# Saves the blobs found in every frame to a CSV, NPZ or Parquet file, chosen by the extension of path, with the columns
+# in DETECTION_FIELDS. The ellipse axes come from cv2.fitEllipse on the outer contour of each blob. Rows are buffered
+# and written batch_size at a time, so memory use stays the same however long the video is. An NPZ file stores every
+# batch as its own set of arrays, named after the column and the batch number. Parquet files need pyarrow.
+class DetectionSink:
+    def __init__(self, path, batch_size=DETECTION_BATCH):
+        self.extension = path[path.rindex('.'):] if '.' in path else ''
+        assert self.extension in DETECTION_FORMATS and "Detections are saved as .csv, .npz or .parquet."
+        assert self.extension != '.parquet' or pyarrow is not None and "Saving .parquet detections requires pyarrow."
+        assert batch_size > 0
+
+        self.path = path
+        self.batch_size = batch_size
+        self.rows = []
+        self.batches = 0
+
+        if self.extension == '.csv':
+            self.file = open(path, 'w', newline='')
+            self.csv_writer = csv.writer(self.file)
+            self.csv_writer.writerow([name for name, dtype in DETECTION_FIELDS])
+        elif self.extension == '.npz':
+            self.file = zipfile.ZipFile(path, 'w')
+        else:
+            self.file = pyarrow.parquet.ParquetWriter(path, pyarrow.schema([(name, dtype)
+                                                                            for name, dtype in DETECTION_FIELDS]))
+
+    # Save the blobs of frame_num, formatted as per label_contours.
+    def write(self, frame_num, blobs):
+        for blob in blobs:
+            contour = blob['contour']
+            if len(contour) >= 5:
+                axes, angle = cv2.fitEllipse(contour)[1:]
+            else:
+                axes, angle = (blob['bbox'][2], blob['bbox'][3]), 0.
+
+            self.rows.append((frame_num, *blob['color'], *blob['centroid'], blob['area'], *blob['bbox'],
+                              max(axes) / 2, min(axes) / 2, angle))
+
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    # Write every buffered row as a batch.
+    def flush(self):
+        if not self.rows:
+            return
+
+        rows = self.rows
+        self.rows = []
+        if self.extension == '.csv':
+            self.csv_writer.writerows(rows)
+            return
+
+        columns = list(zip(*rows))
+        self.write_batch({name: np.array(columns[i], dtype=dtype) for i, (name, dtype) in enumerate(DETECTION_FIELDS)})
+
+    # Write a batch given as a dictionary of column arrays.
+    def write_batch(self, batch):
+        if self.extension == '.csv':
+            self.csv_writer.writerows(zip(*[batch[name].tolist() for name, dtype in DETECTION_FIELDS]))
+        elif self.extension == '.npz':
+            for name, dtype in DETECTION_FIELDS:
+                with self.file.open(name + '_' + str(self.batches) + '.npy', 'w', force_zip64=True) as member:
+                    np.lib.format.write_array(member, batch[name])
+        else:
+            self.file.write_table(pyarrow.table({name: batch[name] for name, dtype in DETECTION_FIELDS}))
+
+        self.batches += 1
+
+    # Append every detection saved in another file of the same format, one batch at a time.
+    def append_file(self, path):
+        self.flush()
+        for batch in read_detections(path, self.batch_size):
+            self.write_batch(batch)
+
+    def release(self):
+        self.flush()
+        self.file.close()
+
+
+# Read detections saved by a DetectionSink one batch at a time, as dictionaries of column arrays. CSV files are read
+# batch_size rows at a time, and other formats in the batches they were written in.
+def read_detections(path, batch_size=DETECTION_BATCH):
+    if path.endswith('.csv'):
+        with open(path, newline='') as detections_file:
+            reader = csv.reader(detections_file)
+            names = next(reader)
+            assert names == [name for name, dtype in DETECTION_FIELDS]
+
+            while True:
+                rows = [row for row, i in zip(reader, range(batch_size))]
+                if not rows:
+                    return
+
+                columns = list(zip(*rows))
+                yield {name: np.array(columns[i], dtype='float64').astype(dtype)
+                       for i, (name, dtype) in enumerate(DETECTION_FIELDS)}
+
+    elif path.endswith('.npz'):
+        with np.load(path) as detections:
+            for batch in range(len(detections.files) // len(DETECTION_FIELDS)):
+                yield {name: detections[name + '_' + str(batch)] for name, dtype in DETECTION_FIELDS}
+
+    else:
+        assert pyarrow is not None and "Reading .parquet detections requires pyarrow."
+        for record_batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=batch_size):
+            yield {name: record_batch.column(name).to_numpy() for name, dtype in DETECTION_FIELDS}
+
+
+# Read every detection saved by a DetectionSink into a dictionary of column arrays.
+def load_detections(path):
+    batches = list(read_detections(path))
+    return {name: np.concatenate([batch[name] for batch in batches]) if batches else np.empty(0, dtype=dtype)
+            for name, dtype in DETECTION_FIELDS}
+
+
+# Find the unique colors in an (n, 3) array of uint8 pixels and how many pixels have each, exactly like
+# np.unique(pixels, return_counts=True, axis=0). Each color is packed into one 24-bit integer, with the first channel
+# in the highest bits so the order matches, and the integers are counted with a histogram in a single pass. When the
+# packed colors are spread too thinly for a histogram to pay off, they are sorted as plain integers instead, which is
+# still much faster than sorting rows.
+def count_colors(pixels):
+    assert type(pixels) is np.ndarray and len(pixels.shape) == 2 and pixels.shape[-1] == 3
+
+    if len(pixels) == 0:
+        return np.empty((0, 3), dtype=pixels.dtype), np.empty(0, dtype=np.int64)
+
+    keys = pack_colors(pixels)
+    low = keys.min()
+    span = keys.max() - low + 1
+
+    if span <= max(HISTOGRAM_SPAN_FACTOR * len(keys), HISTOGRAM_MIN_SPAN):
+        counts = np.bincount(keys - low)
+        keys = np.flatnonzero(counts)
+        counts = counts[keys]
+        keys += low
+    else:
+        keys, counts = np.unique(keys, return_counts=True)
+
+    return unpack_colors(keys).astype(pixels.dtype), counts
+
+
+# Pack an (n, 3) array of 8-bit colors into n 24-bit integers, first channel highest.
+def pack_colors(colors):
+    colors = colors.astype(np.int64)
+    return (colors[:, 0] << 16) | (colors[:, 1] << 8) | colors[:, 2]
+
+
+# Unpack 24-bit integers made by pack_colors into an (n, 3) array of 8-bit colors.
+def unpack_colors(keys):
+    return np.stack([(keys >> 16) & 255, (keys >> 8) & 255, keys & 255], axis=-1).astype(np.uint8)
+
+
 def parse_args(args):
     parser = argparse.ArgumentParser()
 
@@ -136,6 +1401,55 @@ def parse_args(args):
                         help='Output directory for tracking video')
     parser.add_argument('--save_name', dest='save_name', type=str, default='tracking.avi',
                         help='Name to save video under')
+    parser.add_argument('--fps', dest='fps', type=float, default=60.,
+                        help='Frames per second of .npy frame store inputs, which do not record it.')
+    parser.add_argument('--segmentation', dest='segmentation', type=str, default='color', choices=SEGMENTATIONS,
+                        help='How to find blobs. color masks the frame once per color, label labels every pixel and '
+                             'finds all blobs in one pass, and pyramid finds blobs on a downsampled frame before '
+                             'labelling the pixels around them at full resolution.')
+    parser.add_argument('--pyramid_factor', dest='pyramid_factor', type=int, default=THUMBNAIL_FACTOR,
+                        help='How much the frame is downsampled by to find blobs with pyramid segmentation. Balls '
+                             'smaller than this many pixels across may be missed.')
+    parser.add_argument('--color_table', dest='color_table', action='store_true',
+                        help='Remember which cluster every color belongs to from frame to frame, so colors are only '
+                             'grouped when they first show up. Not used by color segmentation without roi or physics '
+                             'tracking.')
+    parser.add_argument('--tracking', dest='tracking', type=str, default='full', choices=TRACKING_MODES,
+                        help='full finds blobs in the whole of every frame. roi only searches around the blobs found '
+                             'last frame, with label segmentation. physics also predicts where each ball goes next '
+                             'with the bounce model of generate_ball, and labels it with a persistent id.')
+    parser.add_argument('--roi_padding', dest='roi_padding', type=int, default=ROI_PADDING,
+                        help='Pixels to search around each blob from the last frame, or each predicted ball, when '
+                             'tracking with roi or physics.')
+    parser.add_argument('--full_scan_interval', dest='full_scan_interval', type=int, default=FULL_SCAN_INTERVAL,
+                        help='Number of frames between full frame scans when tracking with roi or physics, to catch '
+                             'new balls.')
+    parser.add_argument('--headless', dest='headless', action='store_true',
+                        help='Never show frames or wait to keep time with the fps, and track as fast as the video can '
+                             'be read. For servers without a display.')
+    parser.add_argument('--no_video', dest='no_video', action='store_true',
+                        help='Do not save the tracking video.')
+    parser.add_argument('--queue_size', dest='queue_size', type=int, default=0,
+                        help='Number of frames each stage can queue for the next. If above 0, reading, detecting and '
+                             'drawing frames run on separate threads and report their latency. Requires --headless.')
+    parser.add_argument('--detections', dest='detections', type=str, default=None,
+                        help='Path to save the frame, color, centroid, area, bounding box and ellipse axes of every '
+                             'blob found to, as .csv, .npz or .parquet. Combine with --no_video to only save data.')
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        help='Time every stage of tracking and print the percentiles of each at the end, with the net '
+                             'change in live Python memory blocks, counted for the whole process including other '
+                             'threads. Also turned on by setting the ' + profiling.PROFILE_ENV +
+                             ' environment variable.')
+    parser.add_argument('--profile_report', dest='profile_report', type=str, default=None,
+                        help='Path to save the timings of every stage to as JSON. Turns on --profile.')
+    parser.add_argument('--cprofile', dest='cprofile', type=str, default=None,
+                        help='Path to save cProfile stats of the run to. Turns on --profile.')
+    parser.add_argument('--tracemalloc', dest='tracemalloc', type=str, default=None,
+                        help='Path to save the lines that allocated the most memory to, traced with tracemalloc. '
+                             'Turns on --profile.')
+    parser.add_argument('--workers', dest='workers', type=int, default=1,
+                        help='Number of processes to track the video with. Each tracks its own range of frames, and '
+                             'ball ids are stitched together where the ranges meet. Requires --headless.')
 
     args = parser.parse_args(args)
     assert os.path.exists(args.path)
@@ -145,13 +1459,42 @@ def parse_args(args):
            0 <= args.background_color[2] <= 255
 
     assert args.save_name[-4:] == '.avi' and "Ending is not '.avi'"
+    assert args.fps > 0
+    assert args.roi_padding >= 0
+    assert args.pyramid_factor >= 1
+    assert (not args.color_table or args.segmentation != 'color' or args.tracking != 'full') and \
+        "Color tables require label or pyramid segmentation, or roi or physics tracking."
+    assert args.full_scan_interval >= 1
+    assert args.queue_size >= 0
+    assert (args.queue_size == 0 or args.headless) and "Frames can only be tracked in stages with --headless."
+    assert args.workers > 0
+    assert args.detections is None or args.detections[args.detections.rfind('.'):] in DETECTION_FORMATS
+    assert args.detections is None or args.detections[-8:] != '.parquet' or pyarrow is not None and \
+        "Saving .parquet detections requires pyarrow."
+    assert (args.workers == 1 or args.headless) and "Frames can only be tracked in parallel with --headless."
 
     args = {
         'path': args.path,
         'tolerance': args.tolerance,
         'output_dir': args.output_dir,
         'save_name': args.save_name,
-        'background_color': args.background_color
+        'background_color': args.background_color,
+        'fps': args.fps,
+        'segmentation': args.segmentation,
+        'pyramid_factor': args.pyramid_factor,
+        'color_table': args.color_table,
+        'tracking': args.tracking,
+        'roi_padding': args.roi_padding,
+        'full_scan_interval': args.full_scan_interval,
+        'headless': args.headless,
+        'no_video': args.no_video,
+        'queue_size': args.queue_size,
+        'workers': args.workers,
+        'detections': args.detections,
+        'profile': args.profile,
+        'profile_report': args.profile_report,
+        'cprofile': args.cprofile,
+        'tracemalloc': args.tracemalloc
     }
 
     return args